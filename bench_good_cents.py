@@ -0,0 +1,679 @@
+#!/usr/bin/env python3
+"""
+Good Cents benchmarks
+Microbenchmarks for the hot paths in good_cents_server.py
+
+    python bench_good_cents.py money [--count N]
+    python bench_good_cents.py accounts [--count N]
+    python bench_good_cents.py load [--clients N] [--duration S] [--output FILE]
+    python bench_good_cents.py compare BEFORE.json AFTER.json
+    python bench_good_cents.py startup [--runs N]
+"""
+
+import argparse
+import atexit
+import contextlib
+import http.client
+import http.server
+import itertools
+import json
+import math
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+# The server reads its configuration at import, so the load test's ledger
+# and transaction spill files go to a scratch directory, not goodcents_data
+_BENCH_DATA_DIR = tempfile.mkdtemp(prefix="goodcents-bench-")
+atexit.register(shutil.rmtree, _BENCH_DATA_DIR, ignore_errors=True)
+os.environ.setdefault("GOODCENTS_DATA_DIR", _BENCH_DATA_DIR)
+os.environ.setdefault("GOODCENTS_LOG_LEVEL", "WARNING")
+
+import good_cents_server as server
+
+# =============================================================================
+# MONEY
+# =============================================================================
+
+def float_roundup(amount, round_to_pound):
+    """The roundup as it was computed before the pence engine, kept as the baseline"""
+    if round_to_pound:
+        return round(math.ceil(amount) - amount, 2)
+    return round((math.ceil(amount * 4) / 4) - amount, 2)
+
+def timed(function, repeat=5):
+    """Best wall time over a few runs, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def bench_money(count):
+    """Float roundups and balances against the integer-pence engine on the same amounts"""
+    rng = random.Random(13)
+    pence = [rng.randint(1, 20000) for _ in range(count)]
+    pounds = [p / 100 for p in pence]
+
+    # Both paths must agree with the documented semantics on every amount
+    # before their speed is worth comparing
+    mismatches = 0
+    for p, amount in zip(pence, pounds):
+        for round_to_pound, step in ((True, 100), (False, 25)):
+            if server.to_pence(float_roundup(amount, round_to_pound)) != server.calculate_roundup(p, step):
+                mismatches += 1
+
+    def float_path():
+        balance = 0.0
+        for amount in pounds:
+            balance = round(balance - amount, 2)
+            roundup = float_roundup(amount, True)
+            balance = round(balance - roundup, 2)
+
+    def pence_path():
+        balance = 0
+        for amount in pence:
+            balance -= amount
+            balance -= server.calculate_roundup(amount, 100)
+
+    def pence_batch():
+        return -sum(pence) - sum(server.batch_roundups(pence, 100))
+
+    # Accumulating without the per-step round() is where floats drift
+    float_total = 0.0
+    for amount in pounds:
+        float_total += amount
+    drift = float_total - sum(pence) / 100
+
+    results = {"count": count, "mismatches": mismatches, "unrounded_float_drift_pounds": drift}
+    for name, function in (("float", float_path), ("pence", pence_path), ("pence_batch", pence_batch)):
+        seconds = timed(function)
+        results[name] = {"seconds": round(seconds, 4), "ns_per_payment": round(seconds / count * 1e9, 1)}
+    results["speedup"] = round(results["float"]["seconds"] / results["pence"]["seconds"], 2)
+    results["batch_speedup"] = round(results["float"]["seconds"] / results["pence_batch"]["seconds"], 2)
+    return results
+
+# =============================================================================
+# ACCOUNTS
+# =============================================================================
+
+def bench_accounts(count, transactions=3):
+    """Memory per account in a fresh AccountRegistry, empty and with a few donating transactions"""
+    ids = [f"customer-{i:08d}" for i in range(count)]
+
+    def create():
+        registry = server.AccountRegistry()
+        for account_id in ids:
+            with registry.locked(account_id):
+                pass
+        return registry
+
+    created = timed(create, repeat=1)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    registry = create()
+    empty = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(before, "filename"))
+
+    # Only the ids and the donation rollup are held per account; the rows
+    # themselves live in TRANSACTIONS
+    charities = list(server.CHARITIES)
+    created_at = datetime.now().isoformat(timespec="seconds")
+    for account in registry:
+        for transaction_id in range(transactions):
+            account.add_transaction({
+                "id": transaction_id + 1,
+                "amount": 4.33,
+                "roundup": 0.67,
+                "charity": charities[transaction_id % len(charities)],
+                "created_at": created_at,
+            })
+    with_transactions = sum(stat.size_diff for stat in tracemalloc.take_snapshot().compare_to(before, "filename"))
+    tracemalloc.stop()
+
+    return {
+        "count": count,
+        "shards": registry.metrics(),
+        "create_us_per_account": round(created / count * 1e6, 2),
+        "bytes_per_account": round(empty / count, 1),
+        f"bytes_per_account_with_{transactions}_transactions": round(with_transactions / count, 1),
+    }
+
+# =============================================================================
+# LOAD
+# =============================================================================
+
+# Chains most statements are full of, roughly in order of how often they appear
+CHAIN_MERCHANTS = [
+    "Tesco Express", "Pret A Manger", "Greggs", "Sainsbury's Local", "Costa Coffee", "Amazon UK",
+    "TfL Travel", "Uber Eats", "Deliveroo", "Boots", "Waterstones", "Spotify", "Nando's", "Lidl",
+    "Co-op Food", "Starbucks", "McDonald's", "Steam Games", "Apple Store", "Trainline", "Primark",
+    "WHSmith", "Blackwell's Books", "Holland & Barrett", "Pure Gym", "Oxfam Books", "Cineworld",
+    "Superdrug", "Wagamama", "Timpson",
+]
+# The long tail: independent shops no cache has seen before
+LOCAL_PREFIXES = ["Corner", "Riverside", "Old Town", "Campus", "High Street", "Little", "Green Lane", "Union"]
+LOCAL_TRADES = ["Bakery", "Books", "Cafe", "Pharmacy", "Florist", "Print Shop", "Grocer", "Bike Repair",
+                "Vet Clinic", "Stationers", "Deli", "Launderette"]
+
+BANK_APP_ENDPOINTS = ("/api/account", "/api/transactions", "/api/charities", "/api/settings")
+
+# Scenario name -> payment clients and bank-app pollers as fractions of
+# --clients, and the stub's error rate (None: use --ai-error-rate)
+LOAD_SCENARIOS = {
+    "payments": {"payers": 1.0, "pollers": 0.0, "ai_error_rate": None},
+    "polling": {"payers": 0.0, "pollers": 1.0, "ai_error_rate": None},
+    "mixed": {"payers": 0.25, "pollers": 1.0, "ai_error_rate": None},
+    "ai_errors": {"payers": 1.0, "pollers": 0.0, "ai_error_rate": 0.25},
+    # Many dashboards polling ten times faster than the bank app, around a few payers
+    "flood": {"payers": 0.25, "pollers": 4.0, "ai_error_rate": None, "poll_interval": 0.1},
+}
+
+class MerchantMix:
+    """Zipf-distributed merchants: a few chains dominate, most names are rare"""
+
+    def __init__(self, seed, local_shops=2000, exponent=1.1):
+        rng = random.Random(seed)
+        locals_ = [f"{rng.choice(LOCAL_PREFIXES)} {rng.choice(LOCAL_TRADES)} {i}" for i in range(local_shops)]
+        self.names = CHAIN_MERCHANTS + locals_
+        self.cum_weights = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, len(self.names) + 1)))
+
+    def payment(self, rng):
+        merchant = rng.choices(self.names, cum_weights=self.cum_weights)[0]
+        # Mostly small card payments with the odd big one
+        amount = min(500.0, max(0.5, round(rng.lognormvariate(2.0, 0.9), 2)))
+        return {"merchant": merchant, "amount": amount}
+
+class ClaudeStub:
+    """A local stand-in for the Anthropic Messages API.
+
+    Answers POST /v1/messages after ``latency`` seconds (±50% jitter) with
+    the keyword matcher's charity (a JSON array of them for a batched
+    prompt), or with a 529 overloaded error at ``error_rate``. The server is pointed at it through ANTHROPIC_BASE_URL.
+    """
+
+    def __init__(self, latency=0.3, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.merchants = 0
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                status, response = stub.respond(body)
+                encoded = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(encoded)))
+                self.end_headers()
+                self.wfile.write(encoded)
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def respond(self, body):
+        with self.lock:
+            self.calls += 1
+            delay = self.latency * self.rng.uniform(0.5, 1.5)
+            failed = self.rng.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        time.sleep(delay)
+        if failed:
+            return 529, {"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded (stub)"}}
+        prompt = body["messages"][0]["content"]
+        batch = re.findall(r'^(\d+)\. "(.*)" for £', prompt, re.MULTILINE)
+        if batch:
+            decisions = []
+            for number, merchant in batch:
+                charity, confidence, reasoning = server.fallback_charity_selection(merchant)
+                decisions.append({"id": int(number), "charity": charity, "confidence": confidence,
+                                  "reasoning": f"Stub: {reasoning}"})
+            text = json.dumps(decisions)
+        else:
+            match = re.search(r'purchase at "(.*)" for', prompt)
+            charity, confidence, reasoning = server.fallback_charity_selection(match.group(1) if match else "")
+            text = json.dumps({"charity": charity, "confidence": confidence, "reasoning": f"Stub: {reasoning}"})
+        with self.lock:
+            self.merchants += len(batch) or 1
+        return 200, {
+            "id": f"msg_stub_{self.calls}", "type": "message", "role": "assistant", "model": body.get("model"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {"input_tokens": len(prompt) // 4, "output_tokens": len(text) // 4},
+        }
+
+    def reset(self, error_rate):
+        with self.lock:
+            self.error_rate = error_rate
+            self.calls = 0
+            self.errors = 0
+            self.merchants = 0
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name="claude-stub", daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def rss_bytes(pids=()):
+    """Resident set size of this process (server, stub and clients together) plus any worker processes"""
+    try:
+        total = 0
+        for pid in ["self", *pids]:
+            try:
+                with open(f"/proc/{pid}/statm") as statm:
+                    total += int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            except FileNotFoundError:
+                if pid == "self":
+                    raise
+        return total
+    except (OSError, ValueError):
+        import resource
+        # Peak rather than current where /proc is missing; kilobytes on Linux, bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))]
+
+def latency_summary(seconds):
+    values = sorted(seconds)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 2),
+        "p90_ms": round(percentile(values, 0.90) * 1000, 2),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2),
+        "mean_ms": round(sum(values) / len(values) * 1000, 2),
+    }
+
+class LoadRecorder:
+    """Latencies and status codes from every simulated client, by request kind"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+
+    def record(self, kind, status, seconds):
+        with self.lock:
+            self.latencies.setdefault(kind, []).append(seconds)
+            counts = self.statuses.setdefault(kind, {})
+            counts[status] = counts.get(status, 0) + 1
+
+class LoadClient:
+    """One simulated client's connection: kept open between requests unless ``keep_alive`` is off"""
+
+    def __init__(self, port, recorder, keep_alive=True):
+        self.port = port
+        self.recorder = recorder
+        self.keep_alive = keep_alive
+        self.connection = None
+        self.opened = 0
+
+    def request(self, method, path, kind, body=None, headers=None):
+        """Send one request and record its latency; returns (status, response headers or None)"""
+        started = time.perf_counter()
+        try:
+            status, response_headers = self._send(method, path, body, headers or {})
+        except (OSError, http.client.HTTPException) as e:
+            self.close()
+            status, response_headers = type(e).__name__, None
+        self.recorder.record(kind, status, time.perf_counter() - started)
+        return status, response_headers
+
+    def _send(self, method, path, body, headers):
+        reused = self.connection is not None
+        if not reused:
+            self.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+            self.opened += 1
+        if not self.keep_alive:
+            headers = dict(headers, Connection="close")
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            # The server may close an idle connection just as we reuse it;
+            # like a browser, retry once on a fresh one
+            self.close()
+            if not reused:
+                raise
+            return self._send(method, path, body, headers)
+        response.read()
+        if response.will_close:
+            self.close()
+        return str(response.status), response.headers
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+def payment_client(client, accounts, mix, rng, deadline):
+    """Back-to-back checkouts, each for a random account"""
+    while time.monotonic() < deadline:
+        body = json.dumps(mix.payment(rng)).encode("utf-8")
+        path = f"/api/payment?account={rng.choice(accounts)}"
+        client.request("POST", path, "payment", body, {"Content-Type": "application/json"})
+    client.close()
+
+def polling_client(client, account, interval, rng, deadline):
+    """The bank app's fallback loop: the four read endpoints every interval, revalidating by ETag"""
+    etags = {}
+    # Phones don't open the app in lockstep
+    next_poll = time.monotonic() + rng.uniform(0, interval)
+    while True:
+        time.sleep(max(0.0, next_poll - time.monotonic()))
+        if time.monotonic() >= deadline:
+            client.close()
+            return
+        for endpoint in BANK_APP_ENDPOINTS:
+            headers = {"If-None-Match": etags[endpoint]} if endpoint in etags else {}
+            status, response_headers = client.request("GET", f"{endpoint}?account={account}", "poll", headers=headers)
+            if response_headers is not None and response_headers.get("ETag"):
+                etags[endpoint] = response_headers["ETag"]
+        next_poll += interval
+
+def run_scenario(name, port, stub, clients, duration, poll_interval, ai_error_rate, seed, keep_alive=True,
+                 worker_pids=lambda: ()):
+    """Drive one scenario against the running server; returns its report"""
+    spec = LOAD_SCENARIOS[name]
+    error_rate = ai_error_rate if spec["ai_error_rate"] is None else spec["ai_error_rate"]
+    poll_interval = spec.get("poll_interval", poll_interval)
+    payers = round(clients * spec["payers"])
+    pollers = round(clients * spec["pollers"])
+    # Pollers need something to notice, so a polling-only scenario still gets one payer
+    payers = max(payers, 1)
+    accounts = [f"bench-{name}-{i}" for i in range(max(payers, pollers))]
+
+    # Every scenario starts with a cold decision cache and a closed breaker
+    stub.reset(error_rate)
+    server.DECISION_CACHE.clear()
+    server.AI_BREAKER = server.CircuitBreaker(probe=server.probe_claude)
+    ai_before = server.ai_client_metrics()
+    batcher_before = server.AI_BATCHER.metrics()
+
+    mix = MerchantMix(seed)
+    recorder = LoadRecorder()
+    deadline = time.monotonic() + duration
+    payer_clients = [LoadClient(port, recorder, keep_alive) for _ in range(payers)]
+    poller_clients = [LoadClient(port, recorder, keep_alive) for _ in range(pollers)]
+    threads = [
+        threading.Thread(target=payment_client, daemon=True,
+                         args=(client, accounts, mix, random.Random(f"{seed}-pay-{i}"), deadline))
+        for i, client in enumerate(payer_clients)
+    ] + [
+        threading.Thread(target=polling_client, daemon=True,
+                         args=(client, accounts[i], poll_interval, random.Random(f"{seed}-poll-{i}"), deadline))
+        for i, client in enumerate(poller_clients)
+    ]
+
+    rss_before = rss_bytes(worker_pids())
+    rss_peak = rss_before
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    while any(thread.is_alive() for thread in threads):
+        rss_peak = max(rss_peak, rss_bytes(worker_pids()))
+        time.sleep(0.1)
+    elapsed = time.perf_counter() - started
+    rss_after = rss_bytes(worker_pids())
+
+    ai_after = server.ai_client_metrics()
+    batcher_after = server.AI_BATCHER.metrics()
+    total = sum(len(latencies) for latencies in recorder.latencies.values())
+    payments = len(recorder.latencies.get("payment", ()))
+    return {
+        "clients": {"payers": payers, "pollers": pollers},
+        "seconds": round(elapsed, 2),
+        "requests": total,
+        "connections_opened": sum(client.opened for client in payer_clients + poller_clients),
+        "throughput_rps": round(total / elapsed, 1),
+        "by_kind": {
+            kind: dict(latency_summary(latencies),
+                       throughput_rps=round(len(latencies) / elapsed, 1),
+                       statuses=dict(sorted(recorder.statuses[kind].items())))
+            for kind, latencies in sorted(recorder.latencies.items())
+        },
+        "latency": latency_summary(itertools.chain.from_iterable(recorder.latencies.values())),
+        "memory": {
+            "rss_before_mb": round(rss_before / 2 ** 20, 1),
+            "rss_peak_mb": round(rss_peak / 2 ** 20, 1),
+            "rss_after_mb": round(rss_after / 2 ** 20, 1),
+        },
+        "ai": {
+            "stub_calls": stub.calls,
+            "stub_errors": stub.errors,
+            "stub_merchants": stub.merchants,
+            "llm_calls_per_payment": round(stub.calls / payments, 4) if payments else None,
+            "batches": batcher_after["batches"] - batcher_before["batches"],
+            "batched_merchants": batcher_after["batched_merchants"] - batcher_before["batched_merchants"],
+            "batch_retries": batcher_after["retried_individually"] - batcher_before["retried_individually"],
+            "client_retries": ai_after["retries"] - ai_before["retries"],
+            "client_failures": ai_after["failures"] - ai_before["failures"],
+            "breaker_opened": ai_after["breaker"]["times_opened"],
+        },
+    }
+
+def bench_load(scenarios, clients, duration, poll_interval, ai_latency, ai_error_rate, seed, workers, queue_size,
+               keep_alive=True, processes=1, ai_batch_window=None, ai_batch_size=None):
+    """Start start_server on a free port against a Claude stub and run each scenario in turn"""
+    stub = ClaudeStub(latency=ai_latency, error_rate=ai_error_rate, seed=seed)
+    stub.start()
+    if ai_batch_window is not None:
+        server.AI_BATCHER.window = ai_batch_window / 1000
+    if ai_batch_size is not None:
+        server.AI_BATCHER.max_size = ai_batch_size
+    server.CLAUDE_API_KEY = "bench-stub-key"
+    server.ANTHROPIC_BASE_URL = stub.url
+    server._anthropic_client = None
+
+    listening = threading.Event()
+    running = {}
+
+    def ready(httpd):
+        running["httpd"] = httpd
+        listening.set()
+
+    # start_server's banner goes to stderr so stdout stays pure JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        threading.Thread(target=server.start_server, name="goodcents-bench-server", daemon=True,
+                         kwargs={"port": 0, "workers": workers, "queue_size": queue_size,
+                                 "open_browser": False, "ready": ready, "processes": processes}).start()
+        # Worker processes each import the server before they listen
+        if not listening.wait(90):
+            raise RuntimeError("start_server did not start listening")
+    httpd = running["httpd"]
+    port = httpd.server_address[1]
+
+    try:
+        results = {
+            "config": {
+                "clients": clients, "duration": duration, "poll_interval": poll_interval,
+                "ai_latency": ai_latency, "ai_error_rate": ai_error_rate, "seed": seed,
+                "workers": workers, "queue_size": queue_size, "keep_alive": keep_alive,
+                "processes": processes,
+                "ai_batch_ms": server.AI_BATCHER.window * 1000, "ai_batch_size": server.AI_BATCHER.max_size,
+                "ledger": server.LEDGER_ENABLED, "async_ai": server.ASYNC_AI_CLASSIFICATION,
+                "python": sys.version.split()[0],
+            },
+            "scenarios": {},
+        }
+        for name in scenarios:
+            print(f"Running {name} for {duration}s...", file=sys.stderr)
+            results["scenarios"][name] = run_scenario(
+                name, port, stub, clients, duration, poll_interval, ai_error_rate, seed, keep_alive,
+                lambda: httpd.metrics().get("pids", ()))
+        return results
+    finally:
+        httpd.shutdown()
+        stub.stop()
+
+# Lower is better for these, higher for throughput
+COMPARE_METRICS = (
+    ("throughput_rps", ("throughput_rps",)),
+    ("p50_ms", ("latency", "p50_ms")),
+    ("p99_ms", ("latency", "p99_ms")),
+    ("payment_p99_ms", ("by_kind", "payment", "p99_ms")),
+    ("llm_calls_per_payment", ("ai", "llm_calls_per_payment")),
+    ("rss_peak_mb", ("memory", "rss_peak_mb")),
+)
+
+def compare_results(before, after):
+    """Percentage change of the headline numbers for every scenario present in both runs"""
+    changes = {}
+    for name in sorted(set(before["scenarios"]) & set(after["scenarios"])):
+        changes[name] = {}
+        for label, path in COMPARE_METRICS:
+            old, new = before["scenarios"][name], after["scenarios"][name]
+            for key in path:
+                old, new = (old or {}).get(key), (new or {}).get(key)
+            change = round((new - old) / old * 100, 1) if old and new is not None else None
+            changes[name][label] = {"before": old, "after": new, "change_pct": change}
+    return changes
+
+# =============================================================================
+# STARTUP
+# =============================================================================
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def wait_until_ready(port, process, timeout=60.0):
+    """Poll /readyz until it answers 200; returns its body"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with {process.returncode} before it was ready")
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+        try:
+            connection.request("GET", "/readyz")
+            response = connection.getresponse()
+            body = response.read()
+            if response.status == 200:
+                return json.loads(body)
+        except OSError:
+            pass
+        finally:
+            connection.close()
+        time.sleep(0.005)
+    raise RuntimeError("server did not become ready")
+
+def bench_startup(runs):
+    """Launch-to-ready time of a headless server process, and how long SIGTERM takes to stop it"""
+    ready, reported, stopped, exit_codes = [], [], [], []
+    for run in range(runs):
+        port = free_port()
+        env = dict(os.environ, GOODCENTS_HEADLESS="1", GOODCENTS_DATA_DIR=os.path.join(_BENCH_DATA_DIR, f"startup-{run}"))
+        launched = time.perf_counter()
+        process = subprocess.Popen([sys.executable, server.__file__, str(port)], env=env,
+                                   cwd=os.path.dirname(os.path.abspath(server.__file__)),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            body = wait_until_ready(port, process)
+            ready.append(time.perf_counter() - launched)
+            reported.append(body["startup_seconds"])
+            signalled = time.perf_counter()
+            process.send_signal(signal.SIGTERM)
+            exit_codes.append(process.wait(timeout=60))
+            stopped.append(time.perf_counter() - signalled)
+        finally:
+            if process.poll() is None:
+                process.kill()
+    return {
+        "runs": runs,
+        "launch_to_ready": latency_summary(ready),
+        "server_reported": latency_summary(reported),
+        "sigterm_to_exit": latency_summary(stopped),
+        "exit_codes": exit_codes,
+    }
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Good Cents microbenchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    money = commands.add_parser("money", help="float vs integer-pence roundups and balances")
+    money.add_argument("--count", type=int, default=200000)
+    accounts = commands.add_parser("accounts", help="memory and creation time per account")
+    accounts.add_argument("--count", type=int, default=200000)
+    load = commands.add_parser("load", help="throughput, latency and memory of a live server under simulated clients")
+    load.add_argument("--scenario", action="append", choices=sorted(LOAD_SCENARIOS),
+                      help="scenario to run, repeatable (default: all)")
+    load.add_argument("--clients", type=int, default=20, help="simulated clients per scenario")
+    load.add_argument("--duration", type=float, default=10.0, help="seconds per scenario")
+    load.add_argument("--poll-interval", type=float, default=1.0, help="seconds between bank-app polls")
+    load.add_argument("--ai-latency", type=float, default=0.3, help="mean Claude stub latency in seconds")
+    load.add_argument("--ai-error-rate", type=float, default=0.0, help="fraction of Claude stub calls that fail")
+    load.add_argument("--seed", type=int, default=42)
+    load.add_argument("--workers", type=int, default=server.SERVER_WORKERS)
+    load.add_argument("--queue-size", type=int, default=server.SERVER_QUEUE_SIZE)
+    load.add_argument("--processes", type=int, default=1,
+                      help="worker processes sharing the port; the Claude stub only serves the primary")
+    load.add_argument("--new-connections", action="store_true",
+                      help="open a connection per request instead of keeping one per client")
+    load.add_argument("--ai-batch-ms", type=float,
+                      help="Claude micro-batching window; 0 sends one request per merchant (default: server's)")
+    load.add_argument("--ai-batch-size", type=int, help="most merchants per batched Claude request")
+    load.add_argument("--output", help="also write the JSON report to this file")
+    startup = commands.add_parser("startup", help="launch-to-ready and SIGTERM-to-exit time of a headless server")
+    startup.add_argument("--runs", type=int, default=5)
+    compare = commands.add_parser("compare", help="percentage change between two load reports")
+    compare.add_argument("before")
+    compare.add_argument("after")
+    args = parser.parse_args()
+
+    if args.command == "money":
+        print(json.dumps(bench_money(args.count), indent=2))
+    elif args.command == "accounts":
+        print(json.dumps(bench_accounts(args.count), indent=2))
+    elif args.command == "load":
+        if not server.ANTHROPIC_AVAILABLE:
+            parser.error("the load test drives the real anthropic client; pip install anthropic")
+        report = bench_load(args.scenario or list(LOAD_SCENARIOS), args.clients, args.duration,
+                            args.poll_interval, args.ai_latency, args.ai_error_rate, args.seed,
+                            args.workers, args.queue_size, keep_alive=not args.new_connections, processes=args.processes,
+                            ai_batch_window=args.ai_batch_ms, ai_batch_size=args.ai_batch_size)
+        encoded = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, "w") as output:
+                output.write(encoded + "\n")
+        print(encoded)
+    elif args.command == "startup":
+        print(json.dumps(bench_startup(args.runs), indent=2))
+    elif args.command == "compare":
+        with open(args.before) as before, open(args.after) as after:
+            print(json.dumps(compare_results(json.load(before), json.load(after)), indent=2))
+
+if __name__ == "__main__":
+    main()
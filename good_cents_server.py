@@ -4,9 +4,14 @@ Bank Demo Server with Claude AI Integration
 Complete banking ecosystem with real AI charity selection
 """
 
+import http.client
 import http.server
 import socketserver
+import socket
+import selectors
+import html
 import os
+import sys
 import webbrowser
 import time
 import json
@@ -14,33 +19,357 @@ import math
 import random
 import asyncio
 import threading
-from urllib.parse import urlparse
-from datetime import datetime
+import queue
+import re
+import hashlib
+import hmac
+import atexit
+import concurrent.futures
+import multiprocessing
+import multiprocessing.connection
+import gzip
+import csv
+import io
+import decimal
+import itertools
+import bisect
+import contextlib
+import zlib
+import logging
+import logging.handlers
+import email.utils
+import importlib.util
+import signal
+from array import array
+from collections import OrderedDict, deque
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timedelta
 
-import os
-from dotenv import load_dotenv
+# Start of the startup time /readyz reports; .env, the pages and the caches
+# are all loaded after this
+LAUNCHED_AT = time.monotonic()
+
+# Headless production mode: no .env file, banner or browser. Read before
+# .env is loaded, since it decides whether .env is loaded at all.
+HEADLESS = os.getenv("GOODCENTS_HEADLESS", "0") == "1"
 
-load_dotenv()
+if not HEADLESS:
+    from dotenv import load_dotenv
+    load_dotenv()
+
+# The anthropic SDK takes over a second to import, so it is only imported
+# when the first Claude client is created (see load_anthropic)
+anthropic = None
+ANTHROPIC_AVAILABLE = importlib.util.find_spec("anthropic") is not None
+if not ANTHROPIC_AVAILABLE and not HEADLESS:
+    print("Anthropic not installed. Install with: pip install anthropic")
 
 try:
-    import anthropic
-    ANTHROPIC_AVAILABLE = True
+    import brotli
+    BROTLI_AVAILABLE = True
 except ImportError:
-    print("Anthropic not installed. Install with: pip install anthropic")
-    ANTHROPIC_AVAILABLE = False
+    BROTLI_AVAILABLE = False
 
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
 
 CLAUDE_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+CLAUDE_MODEL = os.getenv("GOODCENTS_CLAUDE_MODEL", "claude-sonnet-4-20250514")
+# Point at a local stub (or proxy) instead of api.anthropic.com
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL")
+
+# One shared Claude client: per-call timeouts, bounded retries with jitter and
+# a circuit breaker that goes straight to keyword matching after repeated failures
+AI_CONNECT_TIMEOUT = float(os.getenv("GOODCENTS_AI_CONNECT_TIMEOUT", "3"))
+AI_READ_TIMEOUT = float(os.getenv("GOODCENTS_AI_READ_TIMEOUT", "10"))
+AI_MAX_RETRIES = int(os.getenv("GOODCENTS_AI_MAX_RETRIES", "2"))
+AI_RETRY_BACKOFF = float(os.getenv("GOODCENTS_AI_RETRY_BACKOFF", "0.25"))
+AI_BREAKER_THRESHOLD = int(os.getenv("GOODCENTS_AI_BREAKER_THRESHOLD", "5"))
+AI_BREAKER_RESET = float(os.getenv("GOODCENTS_AI_BREAKER_RESET", "30"))
+
+# Concurrent serving: worker threads and how many accepted connections may
+# wait for a free worker before new ones are turned away with a 503
+SERVER_WORKERS = int(os.getenv("GOODCENTS_WORKERS", "8"))
+SERVER_QUEUE_SIZE = int(os.getenv("GOODCENTS_QUEUE_SIZE", "64"))
+# Multi-process serving: worker processes sharing the port with SO_REUSEPORT,
+# each following the primary's ledger, and how often they check it when idle
+SERVER_PROCESSES = int(os.getenv("GOODCENTS_PROCESSES", "1"))
+LEDGER_FOLLOW_INTERVAL = float(os.getenv("GOODCENTS_FOLLOW_MS", "50")) / 1000
+
+# HTTP/1.1 keep-alive: idle connections are closed after this many seconds,
+# and every connection after this many requests
+KEEPALIVE_TIMEOUT = float(os.getenv("GOODCENTS_KEEPALIVE_TIMEOUT", "5"))
+KEEPALIVE_MAX_REQUESTS = int(os.getenv("GOODCENTS_KEEPALIVE_MAX_REQUESTS", "1000"))
+# Admission control: queued connections are served writes first, then pages
+# and probes, then /api reads. Reads that waited longer than this for a
+# worker are shed with a 503, and each client may make GOODCENTS_READ_RATE
+# /api reads a second per account, in bursts of up to GOODCENTS_READ_BURST
+# (rate 0 turns the limit off)
+READ_MAX_WAIT = float(os.getenv("GOODCENTS_READ_MAX_WAIT_MS", "500")) / 1000
+READ_RATE = float(os.getenv("GOODCENTS_READ_RATE", "20"))
+READ_BURST = float(os.getenv("GOODCENTS_READ_BURST", "40"))
+# On SIGTERM, how long writes already running may take before the server stops anyway
+DRAIN_TIMEOUT = float(os.getenv("GOODCENTS_DRAIN_TIMEOUT", "25"))
+
+# Non-blocking payments: commit with the keyword-matched charity straight away
+# and let a background pool attach Claude's choice afterwards
+ASYNC_AI_CLASSIFICATION = os.getenv("GOODCENTS_ASYNC_AI", "0") == "1"
+AI_WORKERS = int(os.getenv("GOODCENTS_AI_WORKERS", "4"))
+AI_QUEUE_SIZE = int(os.getenv("GOODCENTS_AI_QUEUE_SIZE", "256"))
+# Micro-batching: while a Claude call is already out, lookups for different
+# merchants arriving within this window are sent as one request of up to
+# GOODCENTS_AI_BATCH_SIZE merchants (0 ms sends one request per merchant)
+AI_BATCH_WINDOW = float(os.getenv("GOODCENTS_AI_BATCH_MS", "20")) / 1000
+AI_BATCH_SIZE = int(os.getenv("GOODCENTS_AI_BATCH_SIZE", "16"))
+AI_BATCH_TOKENS_PER_MERCHANT = 120
+
+# Merchant -> charity decisions from Claude are cached per CHARITIES version.
+# Set GOODCENTS_DECISION_CACHE_FILE to keep them across restarts.
+DECISION_CACHE_SIZE = int(os.getenv("GOODCENTS_DECISION_CACHE_SIZE", "2000"))
+DECISION_CACHE_TTL = float(os.getenv("GOODCENTS_DECISION_CACHE_TTL", str(7 * 24 * 3600)))
+DECISION_CACHE_FILE = os.getenv("GOODCENTS_DECISION_CACHE_FILE")
+
+# On-box classifier trained from cached Claude decisions. Predictions at or
+# above the threshold (in percent) are served locally; the rest go to Claude.
+CLASSIFIER_FILE = os.getenv("GOODCENTS_CLASSIFIER_FILE")
+CLASSIFIER_THRESHOLD = float(os.getenv("GOODCENTS_CLASSIFIER_THRESHOLD", "85"))
+CLASSIFIER_MIN_EXAMPLES = int(os.getenv("GOODCENTS_CLASSIFIER_MIN_EXAMPLES", "20"))
+# Bearer token for POST /api/classifier/retrain and /reload; unset, those
+# endpoints are refused and the classifier is only managed from the CLI
+ADMIN_TOKEN = os.getenv("GOODCENTS_ADMIN_TOKEN")
+
+# /api/stream: server-sent events pushed when payments or settings change
+SSE_HEARTBEAT = float(os.getenv("GOODCENTS_SSE_HEARTBEAT", "15"))
+SSE_HISTORY = int(os.getenv("GOODCENTS_SSE_HISTORY", "500"))
+
+# Transaction history: rows beyond the in-memory limit are spilled to disk
+DATA_DIR = os.getenv("GOODCENTS_DATA_DIR", "goodcents_data")
+TRANSACTION_MEMORY_LIMIT = int(os.getenv("GOODCENTS_TRANSACTION_MEMORY", "10000"))
+TRANSACTION_SPILL_FILE = os.path.join(DATA_DIR, "transactions.jsonl")
+TRANSACTION_PAGE_LIMIT = 50
+TRANSACTION_MAX_PAGE = 500
+# Largest statement import /api/payments/batch accepts in one request; a body
+# longer than BATCH_MAX_ROWS rows of GOODCENTS_BATCH_MAX_ROW_BYTES (plus a CSV
+# header) is turned away with 413 before it is read
+BATCH_MAX_ROWS = int(os.getenv("GOODCENTS_BATCH_MAX_ROWS", "10000"))
+BATCH_MAX_ROW_BYTES = int(os.getenv("GOODCENTS_BATCH_MAX_ROW_BYTES", "512"))
+BATCH_MAX_BYTES = (BATCH_MAX_ROWS + 1) * BATCH_MAX_ROW_BYTES
+
+# Durable ledger: payments, classifications and settings changes are appended
+# to a write-ahead log and fsynced in groups. A payment is acknowledged once
+# its batch is on disk; a longer interval or bigger batch means fewer fsyncs
+# but more waiting per payment.
+LEDGER_ENABLED = os.getenv("GOODCENTS_LEDGER", "1") == "1"
+LEDGER_FSYNC_INTERVAL = float(os.getenv("GOODCENTS_LEDGER_FSYNC_MS", "2")) / 1000
+LEDGER_BATCH_SIZE = int(os.getenv("GOODCENTS_LEDGER_BATCH", "512"))
+LEDGER_SNAPSHOT_EVERY = int(os.getenv("GOODCENTS_LEDGER_SNAPSHOT_EVERY", "20000"))
+
+# Accounts: every /api route takes ?account= or an X-Account-Id header and
+# falls back to the demo account. Accounts are spread over shards, each with
+# its own lock, so payments for different accounts don't wait on each other.
+ACCOUNT_SHARDS = int(os.getenv("GOODCENTS_ACCOUNT_SHARDS", "64"))
+DEFAULT_ACCOUNT_ID = "demo"
+OPENING_BALANCE = 284793  # pence, for every new account
+
+# Idempotency-Key on /api/payment: completed responses are kept this long,
+# so a retried request is answered from the store instead of charging twice
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("GOODCENTS_IDEMPOTENCY_SIZE", "10000"))
+IDEMPOTENCY_TTL = float(os.getenv("GOODCENTS_IDEMPOTENCY_TTL", str(24 * 3600)))
+
+# Static pages (the HTML files and /demo)
+STATIC_MAX_AGE = int(os.getenv("GOODCENTS_STATIC_MAX_AGE", "3600"))
+
+# Logging: levelled, structured records written by a background thread.
+# GOODCENTS_LOG_FORMAT=json emits one JSON object per line.
+LOG_LEVEL = os.getenv("GOODCENTS_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("GOODCENTS_LOG_FORMAT", "text")
 # =============================================================================
-ACCOUNT = {
-    "balance": 2847.93,
-    "monthly_donated": 1.59
-}
 
-SETTINGS = {
+# =============================================================================
+# LOGGING AND METRICS
+# =============================================================================
+
+LOG = logging.getLogger("goodcents")
+
+class StructuredFormatter(logging.Formatter):
+    """``time LEVEL message key=value ...`` lines, or one JSON object per line"""
+
+    def __init__(self, as_json=False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = getattr(record, "fields", {})
+        if self.as_json:
+            entry = {"time": self.formatTime(record), "level": record.levelname, "message": record.getMessage(), **fields}
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        text = f"{self.formatTime(record)} {record.levelname:<7} {record.getMessage()}"
+        if fields:
+            text += " " + " ".join(f"{key}={json.dumps(value, default=str)}" for key, value in fields.items())
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+def log_event(level, message, exc_info=False, **fields):
+    """Log ``message`` with structured ``fields`` (level is a logging constant)"""
+    LOG.log(level, message, exc_info=exc_info, extra={"fields": fields})
+
+def configure_logging(level=LOG_LEVEL, as_json=LOG_FORMAT == "json"):
+    """Write goodcents logs to stderr from a background thread, so request threads never block on output"""
+    if LOG.handlers:
+        return
+    output = logging.StreamHandler()
+    output.setFormatter(StructuredFormatter(as_json))
+    records = queue.SimpleQueue()
+    LOG.addHandler(logging.handlers.QueueHandler(records))
+    LOG.setLevel(level)
+    LOG.propagate = False
+    listener = logging.handlers.QueueListener(records, output)
+    listener.start()
+    atexit.register(listener.stop)
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _metric_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Counter:
+    """A monotonic count per combination of label values"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def lines(self):
+        with self.lock:
+            return [f"{self.name}{_metric_labels(self.labels, key)} {value}" for key, value in self.values.items()]
+
+class Histogram:
+    """Observation counts in fixed buckets plus a running sum, per combination of label values"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [count per bucket..., overflow, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[bisect.bisect_left(self.buckets, value)] += 1
+            series[-1] += value
+
+    def lines(self):
+        lines = []
+        with self.lock:
+            series_list = [(key, list(series)) for key, series in self.values.items()]
+        for key, series in series_list:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_metric_labels(self.labels + ('le',), key + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_metric_labels(self.labels, key)} {series[-1]}")
+            lines.append(f"{self.name}_count{_metric_labels(self.labels, key)} {cumulative}")
+        return lines
+
+class CallbackMetric:
+    """A gauge or counter read from existing state when /metrics is scraped"""
+
+    def __init__(self, kind, name, documentation, read):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def lines(self):
+        return [f"{self.name} {self.read()}"]
+
+class MetricsRegistry:
+    """Everything /metrics exposes, in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, documentation, labels=()):
+        return self.add(Counter(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name, documentation, read, kind="gauge"):
+        return self.add(CallbackMetric(kind, name, documentation, read))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.lines()
+            except Exception as e:
+                log_event(logging.WARNING, "Metric collection failed", metric=metric.name, error=str(e))
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+METRICS = MetricsRegistry()
+HTTP_REQUESTS = METRICS.counter("goodcents_http_requests_total", "HTTP requests handled", ("route", "method", "status"))
+HTTP_LATENCY = METRICS.histogram("goodcents_http_request_duration_seconds", "Time to handle an HTTP request", ("route", "method"))
+PAYMENT_STAGES = METRICS.histogram("goodcents_payment_stage_seconds", "Time /api/payment spends in each stage", ("stage",))
+AI_SELECT_LATENCY = METRICS.histogram(
+    "goodcents_ai_select_seconds",
+    "Time to choose a charity in ai_select_charity_claude, by where the answer came from "
+    "(ai, cache, local, fallback, circuit_open, parse_error, error)",
+    ("outcome",))
+
+class StageTimer:
+    """Wall time per named stage of one request, for Server-Timing and PAYMENT_STAGES"""
+
+    def __init__(self):
+        self.stages = {}
+        self.mark = time.perf_counter()
+
+    def lap(self, stage):
+        """Charge the time since the previous lap to ``stage``"""
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.mark
+        self.mark = now
+
+    def record(self):
+        for stage, seconds in self.stages.items():
+            PAYMENT_STAGES.observe(seconds, stage)
+
+    def server_timing(self):
+        return ", ".join(f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in self.stages.items())
+
+# New accounts start with the default settings; each account keeps its own copy
+DEFAULT_SETTINGS = {
     "roundups_enabled": True,
     "ai_charity_selection": True,
     "round_to_pound": True,
@@ -104,336 +433,3718 @@ CHARITIES = {
     }
 }
 
-TRANSACTIONS = [
+def _seed_time(**ago):
+    return (datetime.now() - timedelta(**ago)).isoformat(timespec="seconds")
+
+# Demo history, oldest first; ids are assigned by the transaction store
+SEED_TRANSACTIONS = [
     {
-        "id": 1,
-        "merchant": "Costa Coffee",
-        "amount": 4.65,
-        "roundup": 0.35,
+        "merchant": "Uber",
+        "amount": 12.30,
+        "roundup": 0.70,
+        "charity": "Crisis",
+        "time": "Yesterday",
+        "created_at": _seed_time(days=1),
+        "type": "purchase",
+        "status": "classified",
+        "ai_confidence": 92
+    },
+    {
+        "merchant": "Tesco Express",
+        "amount": 8.47,
+        "roundup": 0.53,
         "charity": "FareShare",
-        "time": "2 minutes ago",
+        "time": "3 hours ago", 
+        "created_at": _seed_time(hours=3),
         "type": "purchase",
-        "ai_confidence": 89
+        "status": "classified",
+        "ai_confidence": 87
     },
     {
-        "id": 2,
         "merchant": "Amazon Books",
         "amount": 23.99,
         "roundup": 0.01,
         "charity": "Teach First", 
         "time": "1 hour ago",
+        "created_at": _seed_time(hours=1),
         "type": "purchase",
+        "status": "classified",
         "ai_confidence": 95
     },
     {
-        "id": 3,
-        "merchant": "Tesco Express",
-        "amount": 8.47,
-        "roundup": 0.53,
+        "merchant": "Costa Coffee",
+        "amount": 4.65,
+        "roundup": 0.35,
         "charity": "FareShare",
-        "time": "3 hours ago", 
-        "type": "purchase",
-        "ai_confidence": 87
-    },
-    {
-        "id": 4,
-        "merchant": "Uber",
-        "amount": 12.30,
-        "roundup": 0.70,
-        "charity": "Crisis",
-        "time": "Yesterday",
+        "time": "2 minutes ago",
+        "created_at": _seed_time(minutes=2),
         "type": "purchase",
-        "ai_confidence": 92
+        "status": "classified",
+        "ai_confidence": 89
     }
 ]
 
+# =============================================================================
+# MONEY
+# =============================================================================
+
+PENNY = decimal.Decimal(1)
+
+def to_pence(value):
+    """Exact integer pence for a pounds amount given as a number or string (half-pennies round up)"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value * 100
+    try:
+        # str() first so a float like 4.33 is read as "4.33", not its binary expansion
+        pounds = decimal.Decimal(str(value).strip())
+    except decimal.InvalidOperation:
+        raise ValueError(f"Invalid amount: {value!r}") from None
+    if not pounds.is_finite():
+        raise ValueError(f"Invalid amount: {value!r}")
+    try:
+        return int(pounds.scaleb(2).quantize(PENNY, rounding=decimal.ROUND_HALF_UP))
+    except decimal.InvalidOperation:
+        # More digits than the context's precision, e.g. 1e30
+        raise ValueError(f"Amount out of range: {value!r}") from None
+
+def to_pounds(pence):
+    """Pounds as a float, for JSON responses and display"""
+    return pence / 100
+
+# =============================================================================
+# TRANSACTION STORE
+# =============================================================================
+
+class TransactionStore:
+    """Append-only transaction history with monotonic ids.
+
+    The newest ``memory_limit`` rows stay in memory; older ones are spilled
+    in batches to a JSON-lines file, with one file offset per spilled row
+    kept in an ``array`` so any id can still be read back with a single
+    seek. Ids are consecutive from 1, so an id maps straight to a position.
+
+    A ``read_only`` store (in a worker process following the primary's
+    ledger) never writes the spill file: the primary has already spilled
+    the same rows in the same order, so it just indexes them.
+    """
+
+    def __init__(self, memory_limit=TRANSACTION_MEMORY_LIMIT, spill_path=TRANSACTION_SPILL_FILE, read_only=False):
+        self.memory_limit = max(1, memory_limit)
+        self.spill_path = spill_path
+        self.read_only = read_only
+        self.recent = deque()
+        self.spill_offsets = array('q')
+        self.spill_size = 0
+        self.next_id = 1
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return self.next_id - 1
+
+    @property
+    def latest_id(self):
+        return self.next_id - 1
+
+    @property
+    def first_memory_id(self):
+        return len(self.spill_offsets) + 1
+
+    def append(self, transaction):
+        """Store a new row, assigning it the next id; returns the stored dict"""
+        with self.lock:
+            transaction["id"] = self.next_id
+            self.next_id += 1
+            self.recent.append(transaction)
+            if len(self.recent) > self.memory_limit and self.spill_path:
+                self._spill()
+            elif len(self.recent) > self.memory_limit:
+                # Nowhere to spill to: keep memory bounded and drop the oldest rows
+                self.recent.popleft()
+                self.spill_offsets.append(-1)
+            return transaction
+
+    def _spill(self):
+        """Move the oldest tenth of the in-memory rows to the spill file"""
+        count = max(1, self.memory_limit // 10)
+        if self.read_only:
+            self._index_spilled(count)
+            return
+        if not self.spill_offsets:
+            os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+            open(self.spill_path, 'wb').close()
+        with open(self.spill_path, 'ab') as f:
+            for _ in range(min(count, len(self.recent) - 1)):
+                line = json.dumps(self.recent.popleft(), separators=(',', ':')).encode('utf-8') + b"\n"
+                self.spill_offsets.append(self.spill_size)
+                f.write(line)
+                self.spill_size += len(line)
+
+    def _index_spilled(self, count):
+        """Read-only _spill: drop rows from memory that the primary's spill file already holds"""
+        with open(self.spill_path, 'rb') as f:
+            f.seek(self.spill_size)
+            for _ in range(min(count, len(self.recent) - 1)):
+                line = f.readline()
+                if not line.endswith(b"\n"):
+                    break  # not spilled yet; keep the rows in memory until it is
+                self.recent.popleft()
+                self.spill_offsets.append(self.spill_size)
+                self.spill_size += len(line)
+
+    def find(self, transaction_id):
+        """The live in-memory row for an id, for in-place updates (None once spilled)"""
+        with self.lock:
+            index = transaction_id - self.first_memory_id
+            if 0 <= index < len(self.recent):
+                return self.recent[index]
+            return None
+
+    def get(self, transaction_id):
+        rows = self.rows_between(transaction_id, transaction_id)
+        return rows[0] if rows else None
+
+    def rows_between(self, low_id, high_id, limit=None):
+        """Rows with low_id <= id <= high_id, newest first"""
+        with self.lock:
+            high_id = min(high_id, self.latest_id)
+            low_id = max(low_id, 1)
+            if limit is not None:
+                low_id = max(low_id, high_id - limit + 1)
+            if high_id < low_id:
+                return []
+            first_memory_id = self.first_memory_id
+            rows = [self.recent[i - first_memory_id] for i in range(high_id, max(low_id, first_memory_id) - 1, -1)]
+            spilled_high = min(high_id, first_memory_id - 1)
+            if spilled_high >= low_id:
+                rows.extend(self._read_spilled(low_id, spilled_high))
+            return rows
+
+    def _read_spilled(self, low_id, high_id):
+        rows = []
+        offsets = [self.spill_offsets[i - 1] for i in range(high_id, low_id - 1, -1)]
+        if not self.spill_path or all(offset < 0 for offset in offsets):
+            return rows
+        with open(self.spill_path, 'rb') as f:
+            for offset in offsets:
+                if offset >= 0:
+                    f.seek(offset)
+                    rows.append(json.loads(f.readline()))
+        return rows
+
+    def rows_for(self, ids):
+        """Rows for the given ids, in the order given; rows dropped without a spill file are skipped"""
+        with self.lock:
+            first_memory_id = self.first_memory_id
+            rows = []
+            spilled = []
+            for transaction_id in ids:
+                if transaction_id >= first_memory_id:
+                    rows.append(self.recent[transaction_id - first_memory_id])
+                else:
+                    spilled.append((len(rows), self.spill_offsets[transaction_id - 1]))
+                    rows.append(None)
+            if spilled and self.spill_path and any(offset >= 0 for _, offset in spilled):
+                with open(self.spill_path, 'rb') as f:
+                    for position, offset in spilled:
+                        if offset >= 0:
+                            f.seek(offset)
+                            rows[position] = json.loads(f.readline())
+            return [row for row in rows if row is not None]
+
+    def append_existing(self, transaction):
+        """Re-add a row with the id it already has (ledger replay); rows already present are skipped"""
+        with self.lock:
+            if transaction["id"] < self.next_id:
+                return
+            if transaction["id"] != self.next_id:
+                raise ValueError(f"Transaction {transaction['id']} out of order, expected {self.next_id}")
+            self.append(transaction)
+
+    def snapshot_state(self):
+        """Enough to rebuild the store: the in-memory rows plus how much of the spill file is valid"""
+        with self.lock:
+            return {
+                "next_id": self.next_id,
+                "spilled": len(self.spill_offsets),
+                "spill_size": self.spill_size,
+                "recent": [dict(transaction) for transaction in self.recent],
+            }
+
+    def restore_state(self, state):
+        """Reset the store to a snapshot taken by snapshot_state()"""
+        with self.lock:
+            self.recent = deque(state["recent"])
+            self.next_id = state["next_id"]
+            self.spill_offsets = array('q')
+            self.spill_size = 0
+            if not self.spill_path:
+                self.spill_offsets.extend([-1] * state["spilled"])
+                return
+            if not state["spilled"]:
+                return
+            # Rows spilled after the snapshot will be spilled again by replay.
+            # The file is cut after the snapshot's row count rather than at its
+            # byte size, which a spill file rewritten by `reclassify` may not match.
+            with open(self.spill_path, 'rb' if self.read_only else 'r+b') as f:
+                for _ in range(state["spilled"]):
+                    line = f.readline()
+                    if not line:
+                        raise ValueError(f"{self.spill_path} is shorter than the snapshot expects")
+                    self.spill_offsets.append(self.spill_size)
+                    self.spill_size += len(line)
+                if not self.read_only:
+                    f.truncate(self.spill_size)
+
+    def sync(self):
+        """fsync the spill file so a snapshot can rely on it"""
+        with self.lock:
+            if not self.spill_path or not self.spill_size or self.read_only:
+                return
+            with open(self.spill_path, 'ab') as f:
+                os.fsync(f.fileno())
+
+    def __iter__(self):
+        """Every row, oldest first, streamed from the spill file and then memory"""
+        with self.lock:
+            spilled = len(self.spill_offsets)
+            recent = list(self.recent)
+        if spilled and self.spill_path and os.path.exists(self.spill_path):
+            with open(self.spill_path, 'rb') as f:
+                for _ in range(spilled):
+                    line = f.readline()
+                    if not line:
+                        break
+                    yield json.loads(line)
+        yield from recent
+
+    def spilled_rows(self, start_id=1):
+        """Spilled rows from ``start_id`` on, oldest first, streamed from the spill file"""
+        with self.lock:
+            spilled = len(self.spill_offsets)
+            offset = self.spill_offsets[start_id - 1] if start_id <= spilled else -1
+        if offset < 0 or not self.spill_path:
+            return
+        with open(self.spill_path, 'rb') as f:
+            f.seek(offset)
+            for _ in range(spilled - start_id + 1):
+                line = f.readline()
+                if not line:
+                    break
+                yield json.loads(line)
+
+    def replace_spill_file(self, path):
+        """Swap in a rewritten spill file holding the same rows in the same order"""
+        with self.lock:
+            offsets = array('q')
+            size = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    offsets.append(size)
+                    size += len(line)
+            if len(offsets) != len(self.spill_offsets):
+                raise ValueError(f"{path} holds {len(offsets)} rows, expected {len(self.spill_offsets)}")
+            os.replace(path, self.spill_path)
+            self.spill_offsets = offsets
+            self.spill_size = size
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "total": len(self),
+                "in_memory": len(self.recent),
+                "spilled": len(self.spill_offsets),
+                "spill_bytes": self.spill_size,
+            }
+
+TRANSACTIONS = TransactionStore()
+
+# =============================================================================
+# ACCOUNTS
+# =============================================================================
+
+SETTING_NAMES = tuple(DEFAULT_SETTINGS)
+ACCOUNT_ID_PATTERN = re.compile(r"[A-Za-z0-9_.@-]{1,64}")
+
+def settings_flags(settings):
+    """Pack a settings dict into the bit flags AccountState stores"""
+    return sum(1 << bit for bit, name in enumerate(SETTING_NAMES) if settings[name])
+
+class DonationRollup:
+    """Running donation totals for one account: per charity, per day and per month.
+
+    Updated in O(1) as each payment commits and when background
+    classification moves a donation to another charity, so /api/impact never
+    scans history. Days and months are keyed by the transaction's
+    ``created_at`` date; rows from before timestamps existed only count
+    towards the per-charity totals.
+    """
+
+    __slots__ = ("by_charity", "donations", "by_day", "by_month")
+
+    def __init__(self):
+        self.by_charity = {}
+        self.donations = {}
+        self.by_day = {}
+        self.by_month = {}
+
+    def add(self, charity, pence, created_at):
+        self.by_charity[charity] = self.by_charity.get(charity, 0) + pence
+        self.donations[charity] = self.donations.get(charity, 0) + 1
+        if created_at:
+            day, month = created_at[:10], created_at[:7]
+            self.by_day[day] = self.by_day.get(day, 0) + pence
+            self.by_month[month] = self.by_month.get(month, 0) + pence
+
+    def add_row(self, transaction):
+        """Count a stored transaction row, if it donated anything"""
+        pence = to_pence(transaction["roundup"])
+        if pence > 0 and transaction["charity"]:
+            self.add(transaction["charity"], pence, transaction.get("created_at"))
+
+    def move(self, pence, old_charity, new_charity):
+        """Credit a donation to a different charity; day and month totals don't change"""
+        self.by_charity[old_charity] -= pence
+        self.donations[old_charity] -= 1
+        if not self.donations[old_charity]:
+            del self.by_charity[old_charity], self.donations[old_charity]
+        self.by_charity[new_charity] = self.by_charity.get(new_charity, 0) + pence
+        self.donations[new_charity] = self.donations.get(new_charity, 0) + 1
+
+    def to_dict(self):
+        return {"by_charity": self.by_charity, "donations": self.donations, "by_day": self.by_day, "by_month": self.by_month}
+
+    @classmethod
+    def from_dict(cls, data):
+        rollup = cls()
+        for name in cls.__slots__:
+            setattr(rollup, name, dict(data[name]))
+        return rollup
+
+class AccountState:
+    """One customer: balance, settings and the ids of their transactions.
+
+    Kept small so one process can hold hundreds of thousands of them. Money
+    is integer pence, the settings are bit flags, and transactions live in
+    the shared TRANSACTIONS store with only their ids (ascending) kept here
+    in an ``array``. The version counters tell RESPONSE_CACHE when this
+    account's cached responses are stale, and the DonationRollup is only
+    created once the account first donates. Callers hold the account's
+    shard lock.
+    """
+
+    __slots__ = ("id", "balance_pence", "monthly_donated_pence", "flags", "transaction_ids", "rollup",
+                 "account_version", "transactions_version", "settings_version")
+
+    def __init__(self, account_id, balance_pence=OPENING_BALANCE, monthly_donated_pence=0,
+                 flags=settings_flags(DEFAULT_SETTINGS)):
+        self.id = account_id
+        self.balance_pence = balance_pence
+        self.monthly_donated_pence = monthly_donated_pence
+        self.flags = flags
+        self.transaction_ids = array('q')
+        self.rollup = None
+        self.account_version = 0
+        self.transactions_version = 0
+        self.settings_version = 0
+
+    def mark_changed(self, *names):
+        """Record that these parts of the account changed"""
+        for name in names:
+            setattr(self, f"{name}_version", getattr(self, f"{name}_version") + 1)
+
+    def version(self, name):
+        return getattr(self, f"{name}_version")
+
+    def settings(self):
+        return {name: bool(self.flags >> bit & 1) for bit, name in enumerate(SETTING_NAMES)}
+
+    def update_settings(self, values):
+        """Apply the known keys of ``values``; returns the new settings"""
+        settings = self.settings()
+        settings.update((key, bool(value)) for key, value in values.items() if key in settings)
+        self.flags = settings_flags(settings)
+        return settings
+
+    def view(self):
+        """The account as the API shows it, in pounds"""
+        return {
+            "balance": to_pounds(self.balance_pence),
+            "monthly_donated": to_pounds(self.monthly_donated_pence),
+        }
+
+    def balances(self):
+        """Exact totals, as logged to the ledger"""
+        return {"balance_pence": self.balance_pence, "monthly_donated_pence": self.monthly_donated_pence}
+
+    def load_balances(self, data):
+        """Restore totals from a snapshot or log record (older data dirs stored pounds)"""
+        if "balance" in data:
+            data = {"balance_pence": to_pence(data["balance"]), "monthly_donated_pence": to_pence(data["monthly_donated"])}
+        self.balance_pence = data["balance_pence"]
+        self.monthly_donated_pence = data["monthly_donated_pence"]
+
+    def add_transaction(self, transaction):
+        """Record a row stored in TRANSACTIONS; rows replayed from the ledger twice are ignored"""
+        if self.transaction_ids and transaction["id"] <= self.transaction_ids[-1]:
+            return
+        self.transaction_ids.append(transaction["id"])
+        if transaction["roundup"] and transaction["charity"]:
+            if self.rollup is None:
+                self.rollup = DonationRollup()
+            self.rollup.add_row(transaction)
+
+    def reclassify(self, transaction, fields):
+        """Apply a background classification to one of this account's rows, keeping the rollup in step"""
+        old_charity = transaction["charity"]
+        transaction.update(fields)
+        pence = to_pence(transaction["roundup"])
+        if self.rollup is not None and pence > 0 and old_charity and transaction["charity"] != old_charity:
+            self.rollup.move(pence, old_charity, transaction["charity"])
+
+    def rebuild_rollup(self):
+        """Recompute the donation rollup from this account's stored transactions"""
+        rollup = DonationRollup()
+        for start in range(0, len(self.transaction_ids), 1000):
+            for transaction in TRANSACTIONS.rows_for(self.transaction_ids[start:start + 1000]):
+                rollup.add_row(transaction)
+        self.rollup = rollup if rollup.by_charity else None
+
+    def page(self, limit=TRANSACTION_PAGE_LIMIT, before_id=None, since_id=None):
+        """Newest-first page of this account's rows older than ``before_id`` and/or newer than ``since_id``"""
+        ids = self.transaction_ids
+        high = bisect.bisect_left(ids, before_id) if before_id else len(ids)
+        low = bisect.bisect_right(ids, since_id) if since_id else 0
+        start = max(low, high - limit)
+        return {
+            "transactions": TRANSACTIONS.rows_for(reversed(ids[start:high])),
+            "latest_id": ids[-1] if ids else 0,
+            "next_cursor": ids[start] if start > low else None,
+        }
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            **self.balances(),
+            "settings": self.settings(),
+            "transaction_ids": self.transaction_ids.tolist(),
+            "rollup": self.rollup.to_dict() if self.rollup is not None else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        account = cls(data["id"], data["balance_pence"], data["monthly_donated_pence"], settings_flags(data["settings"]))
+        account.transaction_ids.extend(data["transaction_ids"])
+        if "rollup" not in data:
+            account.rebuild_rollup()  # snapshot from before rollups existed
+        elif data["rollup"] is not None:
+            account.rollup = DonationRollup.from_dict(data["rollup"])
+        return account
+
+class AccountRegistry:
+    """Every account, spread over ``shard_count`` dicts by a stable hash of the id.
+
+    Each shard has its own lock: a payment holds only its account's shard,
+    so payments for accounts on different shards run side by side. Accounts
+    are created on their first write; reads of an unknown id see a new
+    account's defaults without creating it, so GETs can't grow the registry.
+    """
+
+    def __init__(self, shard_count=ACCOUNT_SHARDS):
+        self.shards = [({}, threading.RLock()) for _ in range(max(1, shard_count))]
+
+    def _shard(self, account_id):
+        return self.shards[zlib.crc32(account_id.encode('utf-8')) % len(self.shards)]
+
+    def open(self, account_id, create=True):
+        """The account for an id, created if new (caller holds its shard lock).
+
+        With ``create=False`` an unknown id gets a fresh AccountState that is
+        not kept, for read paths.
+        """
+        accounts, _ = self._shard(account_id)
+        account = accounts.get(account_id)
+        if account is None:
+            account = AccountState(account_id)
+            if create:
+                accounts[account_id] = account
+        return account
+
+    @contextlib.contextmanager
+    def locked(self, account_id, create=True):
+        """``with ACCOUNTS.locked(id) as account:`` - the account, with its shard lock held"""
+        _, lock = self._shard(account_id)
+        with lock:
+            yield self.open(account_id, create)
+
+    @contextlib.contextmanager
+    def all_locked(self):
+        """Hold every shard lock, in order, for a consistent view of all accounts"""
+        with contextlib.ExitStack() as stack:
+            for _, lock in self.shards:
+                stack.enter_context(lock)
+            yield
+
+    def __iter__(self):
+        """Every account (caller holds all_locked())"""
+        for accounts, _ in self.shards:
+            yield from accounts.values()
+
+    def __len__(self):
+        return sum(len(accounts) for accounts, _ in self.shards)
+
+    def replace_all(self, accounts):
+        """Swap in accounts restored from a snapshot (caller holds all_locked()).
+
+        Each account's versions carry on from the one it replaces, plus one,
+        so no response cached or ETag sent before the swap matches after it.
+        """
+        previous = {}
+        for shard, _ in self.shards:
+            previous.update(shard)
+            shard.clear()
+        for account in accounts:
+            old = previous.get(account.id)
+            for name in ("account", "transactions", "settings"):
+                setattr(account, f"{name}_version", (old.version(name) if old else 0) + 1)
+            self._shard(account.id)[0][account.id] = account
+
+    def metrics(self):
+        sizes = [len(accounts) for accounts, _ in self.shards]
+        return {"accounts": sum(sizes), "shards": len(sizes), "largest_shard": max(sizes)}
+
+ACCOUNTS = AccountRegistry()
+
+with ACCOUNTS.locked(DEFAULT_ACCOUNT_ID) as _demo:
+    _demo.monthly_donated_pence = 159
+    for _transaction in SEED_TRANSACTIONS:
+        _demo.add_transaction(TRANSACTIONS.append({"id": None, **_transaction}))
+
+# =============================================================================
+# DURABLE LEDGER
+# =============================================================================
+
+class _LedgerCommit:
+    """Completion signal shared by every record written in one fsync batch"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+
+class Ledger:
+    """Write-ahead log with group commit, periodic snapshots and replay on startup.
+
+    ``append`` is called while the account's shard lock is held, so log
+    order matches the order each account changed in; payments are also
+    logged under TRANSACTIONS.lock, so they are logged in the order their
+    transaction ids were handed out. It only queues the record. A writer thread
+    collects everything queued within ``fsync_interval`` (or up to
+    ``batch_size`` records), writes it with a single fsync, and then wakes
+    every request waiting on that batch.
+
+    Every ``snapshot_every`` records the writer snapshots ACCOUNTS and the
+    transaction store and truncates the log. Recovery loads the
+    snapshot and replays only records with a higher sequence number.
+    ``committed_seq`` is the last record known to be on disk; share_commits()
+    publishes it to worker processes following the log.
+    """
+
+    def __init__(self, directory=DATA_DIR, fsync_interval=LEDGER_FSYNC_INTERVAL,
+                 batch_size=LEDGER_BATCH_SIZE, snapshot_every=LEDGER_SNAPSHOT_EVERY):
+        self.wal_path = os.path.join(directory, "ledger.wal")
+        self.snapshot_path = os.path.join(directory, "snapshot.json")
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.batch_size = max(1, batch_size)
+        self.snapshot_every = max(1, snapshot_every)
+        self.cond = threading.Condition()
+        self.pending = []
+        self.commit = _LedgerCommit()
+        self.seq = 0
+        self.committed_seq = 0
+        self.shared_commits = None
+        self.wal = None
+        self.thread = None
+        self.closing = False
+        self.records_since_snapshot = 0
+        self.stats = {
+            "records": 0, "batches": 0, "bytes": 0, "fsync_seconds": 0.0, "max_batch": 0,
+            "snapshots": 0, "last_snapshot_seconds": None, "recovery": None,
+        }
+
+    @property
+    def active(self):
+        return self.wal is not None
+
+    def recover(self):
+        """Rebuild ACCOUNTS and TRANSACTIONS from the snapshot and log; returns replay stats"""
+        started = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot_seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            with ACCOUNTS.all_locked():
+                TRANSACTIONS.restore_state(snapshot["transactions"])
+                ACCOUNTS.replace_all(snapshot_accounts(snapshot))
+            snapshot_seq = snapshot["seq"]
+        
+        replayed = 0
+        self.seq = snapshot_seq
+        if os.path.exists(self.wal_path):
+            with open(self.wal_path, 'r+b') as f, ACCOUNTS.all_locked():
+                end = 0
+                for line in f:
+                    try:
+                        record = json.loads(line) if line.endswith(b"\n") else None
+                    except ValueError:
+                        record = None
+                    if record is None:
+                        break  # torn final write from a crash; nothing after it was acknowledged
+                    end += len(line)
+                    if record["seq"] <= snapshot_seq:
+                        continue
+                    apply_ledger_record(record)
+                    self.seq = record["seq"]
+                    replayed += 1
+                # Cut the torn write off, or the next record appended would be
+                # glued onto it and lost at the following recovery
+                f.truncate(end)
+        
+        self.committed_seq = self.seq
+        self.records_since_snapshot = replayed
+        self.stats["recovery"] = {
+            "snapshot_seq": snapshot_seq,
+            "records_replayed": replayed,
+            "seconds": round(time.perf_counter() - started, 4),
+        }
+        return self.stats["recovery"]
+
+    def start(self):
+        """Open the log for appending and start the group-commit writer"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.wal = open(self.wal_path, 'ab')
+        self.thread = threading.Thread(target=self._run, name="goodcents-ledger", daemon=True)
+        self.thread.start()
+
+    def append(self, record):
+        """Queue a record (caller holds the account's shard lock); returns a handle for wait(), or None if inactive"""
+        if self.wal is None:
+            return None
+        with self.cond:
+            self.seq += 1
+            record["seq"] = self.seq
+            self.pending.append(json.dumps(record, separators=(',', ':')).encode('utf-8') + b"\n")
+            if len(self.pending) == 1 or len(self.pending) >= self.batch_size:
+                self.cond.notify()
+            return self.commit
+
+    def share_commits(self, context=multiprocessing):
+        """A shared counter, for other processes, that the writer sets to ``committed_seq`` after each fsync"""
+        with self.cond:
+            if self.shared_commits is None:
+                self.shared_commits = context.Value('q', self.committed_seq, lock=False)
+            return self.shared_commits
+
+    def wait(self, handle, timeout=10.0):
+        """Block until the record behind ``handle`` is on disk"""
+        if handle is None:
+            return
+        if not handle.done.wait(timeout):
+            raise TimeoutError("Ledger write timed out")
+        if handle.error is not None:
+            raise handle.error
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closing:
+                    self.cond.wait()
+                if not self.pending and self.closing:
+                    return
+                deadline = time.monotonic() + self.fsync_interval
+                while len(self.pending) < self.batch_size and not self.closing:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch, self.pending = self.pending, []
+                commit, self.commit = self.commit, _LedgerCommit()
+                last_seq = self.seq
+            self._write(batch, commit, last_seq)
+            if self.records_since_snapshot >= self.snapshot_every:
+                self.snapshot()
+
+    def _write(self, batch, commit, last_seq):
+        data = b"".join(batch)
+        started = time.perf_counter()
+        try:
+            self.wal.write(data)
+            self.wal.flush()
+            os.fsync(self.wal.fileno())
+        except OSError as e:
+            log_event(logging.ERROR, "Ledger write failed", error=str(e))
+            commit.error = e
+        else:
+            with self.cond:
+                self.committed_seq = last_seq
+                if self.shared_commits is not None:
+                    self.shared_commits.value = last_seq
+        self.stats["fsync_seconds"] += time.perf_counter() - started
+        self.stats["records"] += len(batch)
+        self.stats["batches"] += 1
+        self.stats["bytes"] += len(data)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        self.records_since_snapshot += len(batch)
+        commit.done.set()
+
+    def snapshot(self):
+        """Write a consistent snapshot and truncate the log (runs on the writer thread or at shutdown)"""
+        started = time.perf_counter()
+        with ACCOUNTS.all_locked():
+            snapshot = {
+                "seq": self.seq,
+                "accounts": [account.to_dict() for account in ACCOUNTS],
+                "transactions": TRANSACTIONS.snapshot_state(),
+            }
+        TRANSACTIONS.sync()
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # Everything in the log up to snapshot["seq"] is now covered; records
+        # queued meanwhile are still written after the truncation
+        self.wal.truncate(0)
+        self.wal.seek(0)
+        self.records_since_snapshot = 0
+        self.stats["snapshots"] += 1
+        self.stats["last_snapshot_seconds"] = round(time.perf_counter() - started, 4)
+
+    def close(self):
+        """Flush what is queued, snapshot and stop the writer"""
+        if self.wal is None:
+            return
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join(timeout=10)
+        self.snapshot()
+        self.wal.close()
+        self.wal = None
+
+    def metrics(self):
+        stats = dict(self.stats)
+        stats["enabled"] = self.active
+        stats["seq"] = self.seq
+        stats["committed_seq"] = self.committed_seq
+        stats["pending"] = len(self.pending)
+        if stats["batches"]:
+            stats["avg_batch"] = round(stats["records"] / stats["batches"], 2)
+            stats["avg_fsync_ms"] = round(stats["fsync_seconds"] / stats["batches"] * 1000, 3)
+        return stats
+
+def snapshot_accounts(snapshot):
+    """AccountStates from a snapshot; single-account snapshots become the demo account"""
+    if "accounts" in snapshot:
+        return [AccountState.from_dict(data) for data in snapshot["accounts"]]
+    account = AccountState(DEFAULT_ACCOUNT_ID, flags=settings_flags({**DEFAULT_SETTINGS, **snapshot["settings"]}))
+    account.load_balances(snapshot["account"])
+    account.transaction_ids.extend(range(1, snapshot["transactions"]["next_id"]))
+    account.rebuild_rollup()
+    return [account]
+
+def apply_ledger_record(record):
+    """Re-apply one logged change during recovery (caller holds ACCOUNTS.all_locked())"""
+    kind = record["type"]
+    # Records from before multi-account support all belong to the demo account
+    account = ACCOUNTS.open(record.get("account_id", DEFAULT_ACCOUNT_ID))
+    if kind in ("payment", "payment_batch"):
+        for transaction in record.get("transactions") or [record["transaction"]]:
+            TRANSACTIONS.append_existing(transaction)
+            account.add_transaction(transaction)
+        account.load_balances(record["account"])
+    elif kind == "classification":
+        transaction = TRANSACTIONS.find(record["id"])
+        if transaction is not None:
+            account.reclassify(transaction, record["fields"])
+    elif kind == "settings":
+        account.update_settings(record["settings"])
+
+LEDGER = Ledger()
+
 # =============================================================================
 # AI CHARITY SELECTION
 # =============================================================================
 
+def ai_available():
+    """True when a Claude API key is configured and the SDK is installed"""
+    return bool(CLAUDE_API_KEY and ANTHROPIC_AVAILABLE)
+
 def ai_select_charity_claude(merchant_name, amount):
     """Use Claude AI to select the most appropriate charity"""
-    if not CLAUDE_API_KEY or not ANTHROPIC_AVAILABLE:
-        return fallback_charity_selection(merchant_name)
+    started = time.perf_counter()
+    decision, outcome = _select_charity(merchant_name, amount)
+    AI_SELECT_LATENCY.observe(time.perf_counter() - started, outcome)
+    return decision
+
+def _select_charity(merchant_name, amount):
+    """ai_select_charity_claude's decision and the outcome it is timed under"""
+    if not ai_available():
+        decision = LOCAL_CLASSIFIER.predict(merchant_name)
+        if decision is not None:
+            return decision, "local"
+        return fallback_charity_selection(merchant_name), "fallback"
     
     try:
-        client = anthropic.Anthropic(api_key=CLAUDE_API_KEY)
-        
+        decision, outcome = known_charity_decision(merchant_name)
+        if decision is not None:
+            return decision, outcome
+        return fetch_claude_charity(merchant_name, amount), "ai"
+    except CircuitOpenError:
+        return fallback_charity_selection(merchant_name), "circuit_open"
+    except json.JSONDecodeError as e:
+        log_event(logging.WARNING, "Could not parse AI response", merchant=merchant_name, response=e.doc)
+        return fallback_charity_selection(merchant_name), "parse_error"
+    except Exception as e:
+        log_event(logging.ERROR, "Claude AI error", merchant=merchant_name, error=str(e))
+        return fallback_charity_selection(merchant_name), "error"
+
+def cached_claude_charity(merchant_name, amount):
+    """Claude's decision for this merchant, or a local answer when one is good enough"""
+    decision, _ = known_charity_decision(merchant_name)
+    if decision is not None:
+        return decision
+    return fetch_claude_charity(merchant_name, amount)
+
+def known_charity_decision(merchant_name):
+    """(decision, "cache" or "local") when no Claude call is needed, else (None, None)"""
+    decision = DECISION_CACHE.get(normalise_merchant(merchant_name), charities_version())
+    if decision is not None:
+        return decision, "cache"
+    decision = LOCAL_CLASSIFIER.predict(merchant_name)
+    if decision is not None:
+        return decision, "local"
+    return None, None
+
+def fetch_claude_charity(merchant_name, amount):
+    """Ask Claude (skipping the cache lookup) and remember the answer.
+
+    Concurrent lookups for the same merchant share a single Claude call.
+    """
+    key = normalise_merchant(merchant_name)
+    version = charities_version()
+    
+    def lookup():
+        # A call for this merchant may have finished between our cache miss
+        # and becoming the leader
+        decision = DECISION_CACHE.peek(key, version)
+        if decision is None:
+            decision = AI_BATCHER.request(merchant_name, amount)
+            DECISION_CACHE.put(key, version, decision)
+        return decision
+    
+    return AI_SINGLE_FLIGHT.do(key, lookup)
+
+_charity_prompt_prefix = {"version": None, "system": None}
+
+def charity_prompt_prefix():
+    """System prompt describing the catalogue, shared by every classification request.
+
+    It is byte-for-byte identical between calls (until CHARITIES changes) and
+    marked for prompt caching, so Claude can reuse it instead of re-reading
+    the catalogue for each merchant.
+    """
+    version = charities_version()
+    if _charity_prompt_prefix["version"] != version:
         charities_info = "\n".join([
             f"- {name}: {info['description']} (£{info['costPerImpact']} per {info['unit']})"
             for name, info in CHARITIES.items()
         ])
-        
-        prompt = f"""You are an AI assistant for a banking app that helps students donate spare change to charities.
-
-A student just made a purchase at "{merchant_name}" for £{amount:.2f}.
+        text = f"""You are an AI assistant for a banking app that helps students donate spare change to charities.
 
 Available charities:
 {charities_info}
 
-Based on the merchant type and purchase context, which charity would be most appropriate for this transaction? 
-
-Consider:
+When choosing a charity for a purchase, consider:
 - What type of business this merchant is
 - How the purchase relates to the charity's mission
 - What would make sense to a student
 
-Respond with only a JSON object in this format:
-{{"charity": "Charity Name", "confidence": 85, "reasoning": "Brief explanation"}}
-
 Choose from the exact charity names listed above."""
+        _charity_prompt_prefix["system"] = [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}]
+        _charity_prompt_prefix["version"] = version
+    return _charity_prompt_prefix["system"]
 
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=200,
-            messages=[
-                {"role": "user", "content": prompt}
-            ]
-        )
+def parse_claude_json(message):
+    """The JSON value in a Claude reply, tolerating a ```json fence"""
+    response_text = message.content[0].text.strip()
+    if response_text.startswith('```json'):
+        response_text = response_text.replace('```json', '').replace('```', '').strip()
+    return json.loads(response_text)
+
+def request_claude_charity(merchant_name, amount):
+    """Ask Claude for a charity; raises instead of falling back so callers can tell failures apart"""
+    if not AI_BREAKER.allow():
+        raise CircuitOpenError("Claude circuit breaker is open")
+    
+    prompt = f"""A student just made a purchase at "{merchant_name}" for £{amount:.2f}.
+
+Based on the merchant type and purchase context, which charity would be most appropriate for this transaction? 
+
+Respond with only a JSON object in this format:
+{{"charity": "Charity Name", "confidence": 85, "reasoning": "Brief explanation"}}"""
+
+    message = call_claude(
+        max_tokens=200,
+        system=charity_prompt_prefix(),
+        messages=[
+            {"role": "user", "content": prompt}
+        ]
+    )
+    
+    result = parse_claude_json(message)
+    charity_name = result.get("charity", "Teach First")
+    confidence = result.get("confidence", 85)
+    reasoning = result.get("reasoning", "AI selected based on merchant type")
+    
+    # Validate charity name
+    if charity_name not in CHARITIES:
+        charity_name = "Teach First"  # Fallback
         
-        response_text = message.content[0].text.strip()
+    log_event(logging.INFO, "AI selected charity", merchant=merchant_name, charity=charity_name,
+              confidence=confidence, reasoning=reasoning)
+    return charity_name, confidence, reasoning
+
+def request_claude_charities(purchases):
+    """One Claude request classifying several (merchant, amount) purchases.
+
+    Returns a decision per purchase, in order; an entry is None where Claude's
+    answer was missing or did not name a known charity, so that merchant can
+    be asked about on its own.
+    """
+    if not AI_BREAKER.allow():
+        raise CircuitOpenError("Claude circuit breaker is open")
+    
+    lines = "\n".join(
+        f'{i}. "{merchant_name}" for £{amount:.2f}'
+        for i, (merchant_name, amount) in enumerate(purchases, 1)
+    )
+    prompt = f"""Students just made these purchases:
+{lines}
+
+For each purchase, which charity would be most appropriate based on the merchant type and purchase context?
+
+Respond with only a JSON array holding one object per purchase, in this format:
+[{{"id": 1, "charity": "Charity Name", "confidence": 85, "reasoning": "Brief explanation"}}]"""
+
+    message = call_claude(
+        max_tokens=AI_BATCH_TOKENS_PER_MERCHANT * len(purchases) + 100,
+        system=charity_prompt_prefix(),
+        messages=[
+            {"role": "user", "content": prompt}
+        ]
+    )
+    
+    decisions = [None] * len(purchases)
+    try:
+        results = parse_claude_json(message)
+    except json.JSONDecodeError as e:
+        log_event(logging.WARNING, "Could not parse batched AI response", merchants=len(purchases), response=e.doc)
+        return decisions
+    if not isinstance(results, list):
+        return decisions
+    
+    for result in results:
+        if not isinstance(result, dict):
+            continue
+        index = result.get("id")
+        charity_name = result.get("charity")
+        confidence = result.get("confidence", 85)
+        if (not isinstance(index, int) or not 1 <= index <= len(purchases)
+                or charity_name not in CHARITIES or not isinstance(confidence, (int, float))):
+            continue
+        reasoning = result.get("reasoning") or "AI selected based on merchant type"
+        decisions[index - 1] = (charity_name, confidence, reasoning)
+        log_event(logging.INFO, "AI selected charity", merchant=purchases[index - 1][0], charity=charity_name,
+                  confidence=confidence, reasoning=reasoning, batch=len(purchases))
+    return decisions
+
+class ClaudeBatcher:
+    """Collects Claude lookups for different merchants into one request.
+
+    While no Claude call is out, a lookup is sent at once, so a quiet server
+    pays no batching delay. Otherwise the first lookup opens a window of
+    ``window`` seconds; lookups arriving before it closes, up to
+    ``max_size``, are sent together by request_claude_charities. A merchant
+    the batched answer does not cover is retried with its own
+    request_claude_charity call. A window of 0 turns batching off, and a
+    window holding one merchant uses the single prompt. The circuit breaker
+    is checked by those two functions, once per Claude call.
+    """
+
+    def __init__(self, window=AI_BATCH_WINDOW, max_size=AI_BATCH_SIZE, workers=AI_WORKERS):
+        self.window = window
+        self.max_size = max_size
+        self.workers = workers
+        self.cond = threading.Condition()
+        self.pending = []
+        self.in_flight = 0
+        self.thread = None
+        self.executor = None
+        self.requests = 0
+        self.batches = 0
+        self.batched_merchants = 0
+        self.largest_batch = 0
+        self.retried = 0
+
+    def request(self, merchant_name, amount):
+        """Claude's decision for this merchant, waiting for the batch it joins"""
+        if self.window <= 0 or self.max_size <= 1:
+            return request_claude_charity(merchant_name, amount)
         
-        # Parse JSON response
+        future = concurrent.futures.Future()
+        with self.cond:
+            if self.thread is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="goodcents-ai-batch")
+                self.thread = threading.Thread(target=self._run, name="goodcents-ai-batcher", daemon=True)
+                self.thread.start()
+            self.requests += 1
+            self.pending.append((merchant_name, amount, future))
+            self.cond.notify()
+        return future.result()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                # Only wait for company while another call is out; an idle batcher sends at once
+                deadline = time.monotonic() + self.window if self.in_flight else 0
+                while len(self.pending) < self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch, self.pending = self.pending[:self.max_size], self.pending[self.max_size:]
+                self.in_flight += 1
+            # Sent from the pool so the next window fills while this call is out
+            self.executor.submit(self._send, batch)
+
+    def _send(self, batch):
         try:
-            if response_text.startswith('```json'):
-                response_text = response_text.replace('```json', '').replace('```', '').strip()
-            
-            result = json.loads(response_text)
-            charity_name = result.get("charity", "Teach First")
-            confidence = result.get("confidence", 85)
-            reasoning = result.get("reasoning", "AI selected based on merchant type")
-            
-            # Validate charity name
-            if charity_name not in CHARITIES:
-                charity_name = "Teach First"  # Fallback
-                
-            print(f"🤖 AI selected {charity_name} with {confidence}% confidence: {reasoning}")
-            return charity_name, confidence, reasoning
-            
-        except json.JSONDecodeError:
-            print(f"Could not parse AI response: {response_text}")
-            return fallback_charity_selection(merchant_name)
-            
-    except Exception as e:
-        print(f"Claude AI error: {e}")
-        return fallback_charity_selection(merchant_name)
+            self._send_batch(batch)
+        finally:
+            with self.cond:
+                self.in_flight -= 1
+
+    def _send_batch(self, batch):
+        if len(batch) == 1:
+            self._request_one(*batch[0])
+            return
+        with self.cond:
+            self.batches += 1
+            self.batched_merchants += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+        try:
+            decisions = request_claude_charities([(merchant_name, amount) for merchant_name, amount, _ in batch])
+        except BaseException as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for (merchant_name, amount, future), decision in zip(batch, decisions):
+            if decision is not None:
+                future.set_result(decision)
+                continue
+            with self.cond:
+                self.retried += 1
+            self._request_one(merchant_name, amount, future)
+
+    @staticmethod
+    def _request_one(merchant_name, amount, future):
+        try:
+            future.set_result(request_claude_charity(merchant_name, amount))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def metrics(self):
+        with self.cond:
+            return {
+                "window_ms": round(self.window * 1000, 1),
+                "max_size": self.max_size,
+                "pending": len(self.pending),
+                "in_flight": self.in_flight,
+                "requests": self.requests,
+                "batches": self.batches,
+                "batched_merchants": self.batched_merchants,
+                "mean_batch_size": round(self.batched_merchants / self.batches, 2) if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+                "retried_individually": self.retried,
+            }
+
+AI_BATCHER = ClaudeBatcher()
 
 def fallback_charity_selection(merchant_name):
     """Fallback charity selection when AI is not available"""
-    merchant_lower = merchant_name.lower()
-    
-    # Smart keyword matching
-    if any(word in merchant_lower for word in ['book', 'amazon', 'waterstones', 'study', 'education']):
-        return "Teach First", 89, "Education-related purchase"
-    elif any(word in merchant_lower for word in ['coffee', 'food', 'restaurant', 'tesco', 'cafe']):
-        return "FareShare", 87, "Food-related purchase"
-    elif any(word in merchant_lower for word in ['uber', 'transport', 'travel', 'taxi']):
-        return "Crisis", 85, "Transport-related purchase"
-    elif any(word in merchant_lower for word in ['gym', 'fitness', 'health', 'pharmacy']):
-        return "Mind", 83, "Health/wellness-related purchase"
+    return get_keyword_matcher().classify(merchant_name)
+
+# =============================================================================
+# KEYWORD MATCHING
+# =============================================================================
+
+# Keywords name the merchants a charity fits; focus terms describe its cause
+# and are weaker evidence on their own
+KEYWORD_WEIGHT = 1.0
+FOCUS_WEIGHT = 0.6
+# Patterns this short only count as whole words ("bus" shouldn't hit "business")
+WHOLE_WORD_MAX_LENGTH = 3
+DEFAULT_CHARITY = "Teach First"
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over every keyword and focus term in CHARITIES.
+
+    One pass over the lowercased merchant name finds all terms, each of
+    which must start at a word boundary. A term shared by several charities
+    is split between them. Confidence grows with the total evidence for the
+    winner and with its share of all the evidence found.
+    """
+
+    def __init__(self, charities, version=None):
+        self.version = version
+        self.names = list(charities)
+        owners = {}
+        for index, info in enumerate(charities.values()):
+            for term, weight in [(k, KEYWORD_WEIGHT) for k in info.get("keywords", [])] + \
+                                [(f, FOCUS_WEIGHT) for f in info.get("focus", [])]:
+                term = term.lower().strip()
+                if term:
+                    per_charity = owners.setdefault(term, {})
+                    per_charity[index] = max(per_charity.get(index, 0.0), weight)
+        
+        self.patterns = []
+        for term, per_charity in owners.items():
+            share = 1.0 / len(per_charity)
+            self.patterns.append((term, [(index, weight * share) for index, weight in per_charity.items()]))
+        self.focus = [", ".join(info.get("focus", [])) or "general" for info in charities.values()]
+        self._build()
+
+    def _build(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern_id, (term, _) in enumerate(self.patterns):
+            node = 0
+            for ch in term:
+                next_node = self.goto[node].get(ch)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][ch] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                node = next_node
+            self.output[node].append(pattern_id)
+        
+        # Breadth-first pass to fill in failure links and merge outputs
+        pending = list(self.goto[0].values())
+        while pending:
+            node = pending.pop(0)
+            for ch, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(ch, 0) if node else 0
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+                pending.append(child)
+
+    def scores(self, merchant_name):
+        """Per-charity evidence scores and the terms that matched"""
+        text = merchant_name.lower()
+        original = merchant_name if len(merchant_name) == len(text) else text
+        goto, fail, output = self.goto, self.fail, self.output
+        scores = [0.0] * len(self.names)
+        matched = []
+        node = 0
+        for end, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for pattern_id in output[node]:
+                term, owners = self.patterns[pattern_id]
+                start = end - len(term) + 1
+                if start > 0 and text[start - 1].isalnum() and not _camel_boundary(original, start):
+                    continue
+                if len(term) <= WHOLE_WORD_MAX_LENGTH and end + 1 < len(text) and text[end + 1].isalnum() \
+                        and not _camel_boundary(original, end + 1):
+                    continue
+                if term in matched:
+                    continue
+                matched.append(term)
+                for index, weight in owners:
+                    scores[index] += weight
+        return scores, matched
+
+    def classify(self, merchant_name):
+        """(charity, confidence, reasoning) for a merchant name"""
+        scores, matched = self.scores(merchant_name)
+        total = sum(scores)
+        if not total:
+            default = DEFAULT_CHARITY if DEFAULT_CHARITY in self.names else (self.names[0] if self.names else None)
+            return default, 50, "No keyword match - general education support"
+        
+        best = max(range(len(scores)), key=scores.__getitem__)
+        share = scores[best] / total
+        strength = 1 - math.exp(-scores[best])
+        confidence = int(round(50 + 49 * share * strength))
+        terms = ", ".join(f"'{term}'" for term in matched)
+        return self.names[best], confidence, f"Matched {terms} to {self.names[best]} ({self.focus[best]})"
+
+def _camel_boundary(text, index):
+    """True where a lowercase letter is followed by an uppercase one, as in 'PureGym'"""
+    return text[index].isupper() and text[index - 1].islower()
+
+_keyword_matcher = None
+_keyword_matcher_lock = threading.Lock()
+
+def get_keyword_matcher():
+    """The matcher for the current CHARITIES, rebuilt when the catalogue changes"""
+    global _keyword_matcher
+    version = charities_version()
+    matcher = _keyword_matcher
+    if matcher is None or matcher.version != version:
+        with _keyword_matcher_lock:
+            if _keyword_matcher is None or _keyword_matcher.version != version:
+                _keyword_matcher = KeywordMatcher(CHARITIES, version)
+            matcher = _keyword_matcher
+    return matcher
+
+# =============================================================================
+# CLAUDE CLIENT
+# =============================================================================
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Claude while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Stops calling Claude after repeated failures and probes for recovery in the background.
+
+    After ``threshold`` consecutive failures the breaker opens and every call
+    is refused. Once ``reset_timeout`` has passed, the next refused call
+    starts one background probe; a successful probe closes the breaker,
+    a failed one keeps it open for another ``reset_timeout``.
+    """
+
+    def __init__(self, threshold=AI_BREAKER_THRESHOLD, reset_timeout=AI_BREAKER_RESET, probe=None):
+        self.threshold = max(1, threshold)
+        self.reset_timeout = reset_timeout
+        self.probe = probe
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.times_opened = 0
+        self.short_circuited = 0
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            self.short_circuited += 1
+            start_probe = (
+                self.probe is not None
+                and not self.probing
+                and time.monotonic() - self.opened_at >= self.reset_timeout
+            )
+            if start_probe:
+                self.probing = True
+        if start_probe:
+            threading.Thread(target=self._run_probe, name="goodcents-ai-probe", daemon=True).start()
+        return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                log_event(logging.INFO, "Claude circuit breaker closed")
+            self.state = "closed"
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            if self.state == "closed" and self.consecutive_failures >= self.threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                log_event(logging.WARNING, "Claude circuit breaker opened", failures=self.consecutive_failures)
+
+    def _run_probe(self):
+        try:
+            self.probe()
+        except Exception as e:
+            with self.lock:
+                self.opened_at = time.monotonic()
+            log_event(logging.WARNING, "Claude recovery probe failed", error=str(e))
+        else:
+            self.record_success()
+        finally:
+            with self.lock:
+                self.probing = False
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "times_opened": self.times_opened,
+                "short_circuited": self.short_circuited,
+            }
+
+_anthropic_client = None
+_anthropic_client_lock = threading.Lock()
+AI_CALL_STATS = {"calls": 0, "retries": 0, "failures": 0}
+_ai_call_stats_lock = threading.Lock()
+
+def _count_ai_call(field):
+    with _ai_call_stats_lock:
+        AI_CALL_STATS[field] += 1
+
+def load_anthropic():
+    """The anthropic module, imported on first use"""
+    global anthropic
+    if anthropic is None:
+        import anthropic as sdk
+        anthropic = sdk
+    return anthropic
+
+def get_anthropic_client():
+    """The process-wide Claude client; its HTTP connection pool is reused across payments"""
+    global _anthropic_client
+    if _anthropic_client is None:
+        load_anthropic()
+        with _anthropic_client_lock:
+            if _anthropic_client is None:
+                _anthropic_client = anthropic.Anthropic(
+                    api_key=CLAUDE_API_KEY,
+                    base_url=ANTHROPIC_BASE_URL,
+                    timeout=anthropic.Timeout(AI_READ_TIMEOUT, connect=AI_CONNECT_TIMEOUT),
+                    max_retries=0,  # retried below, with jitter and breaker accounting
+                )
+    return _anthropic_client
+
+def is_retryable_ai_error(error):
+    """Connection problems, timeouts, rate limits and server-side errors are worth retrying"""
+    anthropic = load_anthropic()
+    if isinstance(error, (anthropic.APIConnectionError, anthropic.RateLimitError, anthropic.InternalServerError)):
+        return True
+    return getattr(error, "status_code", None) in (408, 409, 429, 500, 502, 503, 504, 529)
+
+def call_claude(**kwargs):
+    """messages.create on the shared client with bounded, jittered retries"""
+    client = get_anthropic_client()
+    for attempt in range(AI_MAX_RETRIES + 1):
+        _count_ai_call("calls")
+        try:
+            message = client.messages.create(model=CLAUDE_MODEL, **kwargs)
+        except Exception as e:
+            if attempt < AI_MAX_RETRIES and is_retryable_ai_error(e):
+                _count_ai_call("retries")
+                # Full jitter so a burst of failing payments doesn't retry in lockstep
+                time.sleep(random.uniform(0, AI_RETRY_BACKOFF * (2 ** attempt)))
+                continue
+            _count_ai_call("failures")
+            AI_BREAKER.record_failure()
+            raise
+        AI_BREAKER.record_success()
+        return message
+
+def ai_client_metrics():
+    with _ai_call_stats_lock:
+        stats = dict(AI_CALL_STATS)
+    stats["breaker"] = AI_BREAKER.metrics()
+    return stats
+
+def probe_claude():
+    """Smallest possible request, used by the breaker to test whether Claude is back"""
+    get_anthropic_client().messages.create(
+        model=CLAUDE_MODEL,
+        max_tokens=1,
+        messages=[{"role": "user", "content": "ping"}]
+    )
+
+AI_BREAKER = CircuitBreaker(probe=probe_claude)
+
+# =============================================================================
+# DECISION CACHE
+# =============================================================================
+
+def normalise_merchant(merchant_name):
+    """Cache key for a merchant: lowercase words with punctuation and spacing collapsed"""
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", merchant_name.lower()).split())
+
+# How often charities_version() re-hashes CHARITIES to notice in-place edits
+CHARITIES_RECHECK_INTERVAL = 1.0
+_charities_version = {"value": None, "checked_at": 0.0}
+
+def charities_version():
+    """Short hash of CHARITIES so cached decisions and the keyword matcher follow catalogue changes.
+
+    Hashing the catalogue costs far more than a keyword match, so the hash is
+    recomputed at most every CHARITIES_RECHECK_INTERVAL seconds; call
+    refresh_charities() after editing CHARITIES to pick the change up at once.
+    """
+    now = time.monotonic()
+    if _charities_version["value"] is None or now - _charities_version["checked_at"] >= CHARITIES_RECHECK_INTERVAL:
+        return refresh_charities()
+    return _charities_version["value"]
+
+def refresh_charities():
+    """Re-hash CHARITIES now; returns the new version"""
+    digest = hashlib.sha1(json.dumps(CHARITIES, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    _charities_version["value"] = digest
+    _charities_version["checked_at"] = time.monotonic()
+    return digest
+
+class DecisionCache:
+    """LRU + TTL cache of Claude's (charity, confidence, reasoning) per merchant.
+
+    Entries remember the CHARITIES version they were made against and count
+    as misses once the catalogue changes. Expiry uses wall-clock time so a
+    cache loaded from disk keeps its original ages.
+    """
+
+    def __init__(self, max_size=DECISION_CACHE_SIZE, ttl=DECISION_CACHE_TTL, path=DECISION_CACHE_FILE, save_interval=30.0):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.path = path
+        self.save_interval = save_interval
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.dirty = False
+        self.last_save = time.time()
+
+    def get(self, key, version):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["version"] == version and now - entry["stored_at"] < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry["charity"], entry["confidence"], entry["reasoning"]
+            if entry is not None:
+                del self.entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return None
+
+    def peek(self, key, version):
+        """Like get, but without touching counters or LRU order"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["version"] == version and time.time() - entry["stored_at"] < self.ttl:
+                return entry["charity"], entry["confidence"], entry["reasoning"]
+            return None
+
+    def put(self, key, version, decision):
+        charity, confidence, reasoning = decision
+        with self.lock:
+            self.entries[key] = {
+                "charity": charity,
+                "confidence": confidence,
+                "reasoning": reasoning,
+                "version": version,
+                "stored_at": time.time(),
+            }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            self.dirty = True
+            save_due = self.path and time.time() - self.last_save >= self.save_interval
+        if save_due:
+            self.save()
+
+    def items(self):
+        """Snapshot of (merchant key, entry) pairs, oldest first"""
+        with self.lock:
+            return [(key, dict(entry)) for key, entry in self.entries.items()]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.dirty = True
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                stored = json.load(f)
+        except (OSError, ValueError) as e:
+            log_event(logging.WARNING, "Could not load decision cache", path=self.path, error=str(e))
+            return 0
+        now = time.time()
+        with self.lock:
+            for key, entry in stored.get("entries", []):
+                if now - entry.get("stored_at", 0) < self.ttl:
+                    self.entries[key] = entry
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.dirty = False
+            return len(self.entries)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            if not self.dirty:
+                return
+            snapshot = [(key, dict(entry)) for key, entry in self.entries.items()]
+            self.dirty = False
+            self.last_save = time.time()
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"entries": snapshot}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log_event(logging.WARNING, "Could not save decision cache", path=self.path, error=str(e))
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "persistent": bool(self.path),
+            }
+
+DECISION_CACHE = DecisionCache()
+DECISION_CACHE.load()
+atexit.register(DECISION_CACHE.save)
+
+# =============================================================================
+# LOCAL CLASSIFIER
+# =============================================================================
+
+# Share of a merchant's character n-grams the model must have seen before its
+# prediction is trusted; anything less counts as an unseen merchant
+CLASSIFIER_MIN_COVERAGE = 0.5
+
+def merchant_features(merchant_name):
+    """Sparse feature counts: character 2-4 grams plus whole words"""
+    text = f" {normalise_merchant(merchant_name)} "
+    counts = {}
+    for n in (2, 3, 4):
+        for i in range(len(text) - n + 1):
+            gram = text[i:i + n]
+            counts[gram] = counts.get(gram, 0) + 1
+    for word in text.split():
+        key = f"w:{word}"
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+class CharityModel:
+    """Multinomial logistic regression over TF-IDF weighted merchant features.
+
+    Trained with plain SGD on sparse dicts: the training sets are a few
+    thousand merchants at most and inference touches only the few dozen
+    features in one name, so pure Python stays well under a millisecond.
+    """
+
+    def __init__(self, classes, idf, weights, bias, version=None, examples=0, trained_at=None):
+        self.classes = classes
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+        self.version = version
+        self.examples = examples
+        self.trained_at = trained_at
+
+    @classmethod
+    def train(cls, examples, version=None, epochs=25, learning_rate=0.5, l2=1e-4, seed=7):
+        """Fit on (merchant, charity, confidence) triples; confidence weights each example"""
+        classes = sorted({charity for _, charity, _ in examples})
+        class_index = {charity: i for i, charity in enumerate(classes)}
+        
+        raw = [merchant_features(merchant) for merchant, _, _ in examples]
+        document_frequency = {}
+        for counts in raw:
+            for feature in counts:
+                document_frequency[feature] = document_frequency.get(feature, 0) + 1
+        idf = {feature: math.log((1 + len(raw)) / (1 + df)) + 1 for feature, df in document_frequency.items()}
+        
+        model = cls(classes, idf, {}, [0.0] * len(classes), version, len(examples), time.time())
+        data = [
+            (model.vectorise(counts)[0], class_index[charity], max(0.1, min(1.0, (confidence or 0) / 100)))
+            for counts, (_, charity, confidence) in zip(raw, examples)
+        ]
+        
+        rng = random.Random(seed)
+        order = list(range(len(data)))
+        weights, bias, k = model.weights, model.bias, len(classes)
+        for epoch in range(epochs):
+            rng.shuffle(order)
+            rate = learning_rate / (1 + 0.1 * epoch)
+            for i in order:
+                vector, label, sample_weight = data[i]
+                probs = model._probabilities(vector)
+                for c in range(k):
+                    gradient = (probs[c] - (1.0 if c == label else 0.0)) * sample_weight
+                    if not gradient:
+                        continue
+                    bias[c] -= rate * gradient
+                    for feature, value in vector:
+                        row = weights.get(feature)
+                        if row is None:
+                            row = weights[feature] = [0.0] * k
+                        row[c] -= rate * (gradient * value + l2 * row[c])
+        return model
+
+    def vectorise(self, counts):
+        """L2-normalised TF-IDF pairs for known features, plus the share of features known"""
+        vector = []
+        known = 0
+        for feature, count in counts.items():
+            idf = self.idf.get(feature)
+            if idf is not None:
+                known += 1
+                vector.append((feature, (1 + math.log(count)) * idf))
+        norm = math.sqrt(sum(value * value for _, value in vector)) or 1.0
+        return [(feature, value / norm) for feature, value in vector], (known / len(counts) if counts else 0.0)
+
+    def _probabilities(self, vector):
+        logits = list(self.bias)
+        for feature, value in vector:
+            row = self.weights.get(feature)
+            if row is not None:
+                for c, w in enumerate(row):
+                    logits[c] += w * value
+        top = max(logits)
+        exps = [math.exp(logit - top) for logit in logits]
+        total = sum(exps)
+        return [e / total for e in exps]
+
+    def predict(self, merchant_name):
+        """(charity, confidence percent, feature coverage)"""
+        vector, coverage = self.vectorise(merchant_features(merchant_name))
+        probs = self._probabilities(vector)
+        best = max(range(len(probs)), key=probs.__getitem__)
+        return self.classes[best], int(round(probs[best] * 100)), coverage
+
+    def to_dict(self):
+        return {
+            "classes": self.classes,
+            "idf": self.idf,
+            "weights": self.weights,
+            "bias": self.bias,
+            "version": self.version,
+            "examples": self.examples,
+            "trained_at": self.trained_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["classes"], data["idf"], data["weights"], data["bias"],
+                   data.get("version"), data.get("examples", 0), data.get("trained_at"))
+
+def classifier_training_examples():
+    """(merchant, charity, confidence) triples Claude produced for the current catalogue"""
+    version = charities_version()
+    return [
+        (key, entry["charity"], entry["confidence"])
+        for key, entry in DECISION_CACHE.items()
+        if entry["version"] == version and entry["charity"] in CHARITIES
+    ]
+
+def evaluate_classifier(examples, threshold=CLASSIFIER_THRESHOLD, folds=5):
+    """Cross-validated agreement between the local model and Claude's decisions"""
+    examples = list(examples)
+    random.Random(11).shuffle(examples)
+    folds = max(2, min(folds, len(examples)))
+    results = []
+    for fold in range(folds):
+        held_out = examples[fold::folds]
+        training = [example for i, example in enumerate(examples) if i % folds != fold]
+        if not held_out or len({charity for _, charity, _ in training}) < 2:
+            continue
+        model = CharityModel.train(training)
+        for merchant, charity, _ in held_out:
+            predicted, confidence, coverage = model.predict(merchant)
+            results.append((charity, predicted, confidence >= threshold and coverage >= CLASSIFIER_MIN_COVERAGE))
+    
+    served = [r for r in results if r[2]]
+    per_charity = {}
+    for charity, predicted, is_served in results:
+        row = per_charity.setdefault(charity, {"examples": 0, "agreed": 0, "served_locally": 0})
+        row["examples"] += 1
+        row["agreed"] += charity == predicted
+        row["served_locally"] += is_served
+    return {
+        "examples": len(examples),
+        "evaluated": len(results),
+        "folds": folds,
+        "threshold": threshold,
+        "agreement": round(sum(c == p for c, p, _ in results) / len(results), 4) if results else None,
+        "coverage": round(len(served) / len(results), 4) if results else None,
+        "agreement_when_served": round(sum(c == p for c, p, _ in served) / len(served), 4) if served else None,
+        "per_charity": per_charity,
+    }
+
+class LocalClassifier:
+    """Holds the current CharityModel and decides when its answer is good enough to skip Claude"""
+
+    def __init__(self, path=CLASSIFIER_FILE, threshold=CLASSIFIER_THRESHOLD, min_examples=CLASSIFIER_MIN_EXAMPLES):
+        self.path = path
+        self.threshold = threshold
+        self.min_examples = min_examples
+        self.model = None
+        self.lock = threading.Lock()
+        self.served = 0
+        self.escalated = 0
+        self.unseen = 0
+
+    def predict(self, merchant_name):
+        """A (charity, confidence, reasoning) decision, or None to escalate to Claude"""
+        model = self.model
+        if model is None or model.version != charities_version():
+            return None
+        charity, confidence, coverage = model.predict(merchant_name)
+        with self.lock:
+            if coverage < CLASSIFIER_MIN_COVERAGE:
+                self.unseen += 1
+                return None
+            if confidence < self.threshold or charity not in CHARITIES:
+                self.escalated += 1
+                return None
+            self.served += 1
+        return charity, confidence, f"Local model trained on {model.examples} Claude decisions"
+
+    def retrain(self, examples=None):
+        """Train on the decision cache (or given triples), swap the model in and save it"""
+        examples = classifier_training_examples() if examples is None else examples
+        if len(examples) < self.min_examples or len({charity for _, charity, _ in examples}) < 2:
+            raise ValueError(f"Need at least {self.min_examples} decisions covering two charities, have {len(examples)}")
+        model = CharityModel.train(examples, version=charities_version())
+        self.model = model
+        self.save()
+        log_event(logging.INFO, "Local classifier trained", examples=len(examples))
+        return model
+
+    def reload(self):
+        """Load the saved model from disk; returns True if one was loaded"""
+        if not self.path or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.model = CharityModel.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError) as e:
+            log_event(logging.WARNING, "Could not load classifier", path=self.path, error=str(e))
+            return False
+        return True
+
+    def save(self):
+        if not self.path or self.model is None:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.model.to_dict(), f)
+        os.replace(tmp_path, self.path)
+
+    def metrics(self):
+        model = self.model
+        with self.lock:
+            decisions = self.served + self.escalated + self.unseen
+            return {
+                "loaded": model is not None,
+                "current": model is not None and model.version == charities_version(),
+                "examples": model.examples if model else 0,
+                "trained_at": model.trained_at if model else None,
+                "threshold": self.threshold,
+                "served_locally": self.served,
+                "escalated": self.escalated,
+                "unseen": self.unseen,
+                "local_rate": round(self.served / decisions, 4) if decisions else 0.0,
+            }
+
+LOCAL_CLASSIFIER = LocalClassifier()
+LOCAL_CLASSIFIER.reload()
+
+def classifier_command(args):
+    """`python good_cents_server.py classifier {retrain,evaluate}` against the saved decision cache"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="good_cents_server.py classifier")
+    parser.add_argument("action", choices=["retrain", "evaluate"])
+    parser.add_argument("--threshold", type=float, default=CLASSIFIER_THRESHOLD)
+    parser.add_argument("--folds", type=int, default=5)
+    options = parser.parse_args(args)
+    
+    examples = classifier_training_examples()
+    if options.action == "evaluate":
+        print(json.dumps(evaluate_classifier(examples, options.threshold, options.folds), indent=2))
+        return 0
+    if not LOCAL_CLASSIFIER.path:
+        print("Set GOODCENTS_CLASSIFIER_FILE so the trained model can be saved")
+        return 1
+    try:
+        LOCAL_CLASSIFIER.retrain(examples)
+    except ValueError as e:
+        print(e)
+        return 1
+    return 0
+
+# =============================================================================
+# IN-FLIGHT COALESCING
+# =============================================================================
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers wait for its result.
+
+    The first caller for a key (the leader) runs the function. Anyone asking
+    for the same key while it runs blocks and receives the leader's result or
+    exception instead of repeating the work.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.leader_calls = 0
+        self.coalesced_calls = 0
+        self.max_waiters = 0
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _InFlightCall()
+                self.calls[key] = call
+                self.leader_calls += 1
+            else:
+                call.waiters += 1
+                self.coalesced_calls += 1
+                self.max_waiters = max(self.max_waiters, call.waiters)
+        
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "in_flight": len(self.calls),
+                "waiters": {key: call.waiters for key, call in self.calls.items()},
+                "leader_calls": self.leader_calls,
+                "coalesced_calls": self.coalesced_calls,
+                "max_waiters": self.max_waiters,
+            }
+
+AI_SINGLE_FLIGHT = SingleFlight()
+
+# =============================================================================
+# IDEMPOTENCY KEYS
+# =============================================================================
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+class IdempotencyStore:
+    """LRU + TTL store of completed responses per (account, Idempotency-Key).
+
+    The first request for a key runs; a retry after it finished gets the
+    stored (status, body) back without touching any state or calling
+    Claude, and retries that arrive while it is still running wait for it
+    through a SingleFlight. Only responses for requests that changed state
+    are stored (successes, and the 500 for a payment applied but not
+    confirmed on disk), so a request that was refused can be retried with
+    the same key. Reusing a key with a different request body is answered
+    with a 422.
+    """
+
+    STORED_STATUSES = (200, 500)
+
+    def __init__(self, max_size=IDEMPOTENCY_CACHE_SIZE, ttl=IDEMPOTENCY_TTL):
+        self.max_size = max(1, max_size)
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.conflicts = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry["stored_at"] >= self.ttl:
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            elif entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def _put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def run(self, key, fingerprint, execute):
+        """(status, body, replayed): ``execute()`` returns (status, body) and runs at most once per stored key"""
+        executed = []
+        
+        def lead():
+            entry = self._get(key)
+            if entry is None:
+                executed.append(True)
+                status, body = execute()
+                entry = {"fingerprint": fingerprint, "status": status, "body": body, "stored_at": time.monotonic()}
+                if status in self.STORED_STATUSES:
+                    self._put(key, entry)
+            return entry
+        
+        entry = self._get(key) or self.flight.do(key, lead)
+        with self.lock:
+            if entry["fingerprint"] != fingerprint:
+                self.conflicts += 1
+                body = json.dumps({"status": "error", "message": "Idempotency-Key was already used for a different request"})
+                return 422, body.encode('utf-8'), False
+            if executed:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry["status"], entry["body"], not executed
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+                "conflicts": self.conflicts,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "waited_for_in_flight": self.flight.coalesced_calls,
+            }
+
+IDEMPOTENCY_KEYS = IdempotencyStore()
+
+# =============================================================================
+# BACKGROUND CLASSIFICATION
+# =============================================================================
+
+class ClassificationPool:
+    """Worker threads that attach Claude's charity choice to already-committed transactions.
+
+    Transactions are stored as ``pending`` with a provisional keyword-matched
+    charity; a worker then asks Claude and updates the stored row in place to
+    ``classified``, or to ``failed`` (keeping the provisional charity) if the
+    call errors or the queue is full.
+    """
+
+    def __init__(self, workers=AI_WORKERS, queue_size=AI_QUEUE_SIZE):
+        self.workers = max(1, workers)
+        self.jobs = queue.Queue(maxsize=max(1, queue_size))
+        self.lock = threading.Lock()
+        self.threads = []
+        self.in_flight = 0
+        self.max_queue_depth = 0
+        self.submitted = 0
+        self.classified = 0
+        self.failed = 0
+        self.rejected = 0
+        self.spilled = 0
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                worker = threading.Thread(target=self._worker_loop, name=f"goodcents-ai-{i}", daemon=True)
+                worker.start()
+                self.threads.append(worker)
+
+    def submit(self, account_id, transaction_id, merchant, amount):
+        """Queue an account's transaction for classification; returns False if the queue is full"""
+        self.start()
+        try:
+            self.jobs.put_nowait((account_id, transaction_id, merchant, amount))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            self._finish(account_id, transaction_id, None)
+            return False
+        with self.lock:
+            self.submitted += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.jobs.qsize())
+        return True
+
+    def _worker_loop(self):
+        while True:
+            account_id, transaction_id, merchant, amount = self.jobs.get()
+            with self.lock:
+                self.in_flight += 1
+            try:
+                decision = cached_claude_charity(merchant, amount)
+            except Exception as e:
+                log_event(logging.WARNING, "Background classification failed", merchant=merchant, error=str(e))
+                decision = None
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+            self._finish(account_id, transaction_id, decision)
+
+    def _finish(self, account_id, transaction_id, decision):
+        with ACCOUNTS.locked(account_id) as account, TRANSACTIONS.lock:
+            transaction = TRANSACTIONS.find(transaction_id)
+            if transaction is None:
+                # Spilled to disk while queued; the spill file is append-only, so
+                # the row stays pending until `reclassify` rewrites it
+                log_event(logging.WARNING, "Classification dropped for spilled transaction",
+                          account_id=account_id, transaction_id=transaction_id)
+                with self.lock:
+                    self.failed += 1
+                    self.spilled += 1
+                return
+            if decision is None:
+                account.reclassify(transaction, {"status": "failed"})
+            else:
+                charity, confidence, reasoning = decision
+                account.reclassify(transaction, {
+                    "charity": charity,
+                    "ai_confidence": confidence,
+                    "ai_reasoning": reasoning,
+                    "status": "classified",
+                })
+            account.mark_changed("transactions")
+            LEDGER.append({
+                "type": "classification",
+                "account_id": account_id,
+                "id": transaction_id,
+                "fields": {key: transaction[key] for key in ("charity", "ai_confidence", "ai_reasoning", "status")},
+            })
+            EVENT_BROKER.publish(account_id, "transaction", transaction)
+        with self.lock:
+            if decision is None:
+                self.failed += 1
+            else:
+                self.classified += 1
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "workers": self.workers,
+                "queue_depth": self.jobs.qsize(),
+                "queue_limit": self.jobs.maxsize,
+                "max_queue_depth": self.max_queue_depth,
+                "in_flight": self.in_flight,
+                "submitted": self.submitted,
+                "classified": self.classified,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "spilled": self.spilled,
+            }
+
+CLASSIFICATION_POOL = ClassificationPool()
+
+# =============================================================================
+# LIVE UPDATES (SERVER-SENT EVENTS)
+# =============================================================================
+
+# How long one slow subscriber may hold up delivery before it is dropped
+SSE_WRITE_TIMEOUT = 2.0
+
+def state_snapshot(account_id):
+    """Everything the mobile app shows for one account, as one consistent snapshot"""
+    with ACCOUNTS.locked(account_id, create=False) as account:
+        return {
+            "account": account.view(),
+            "transactions": [dict(transaction) for transaction in account.page(TRANSACTION_PAGE_LIMIT)["transactions"]],
+            "charities": CHARITIES,
+            "settings": account.settings(),
+        }
+
+class EventBroker:
+    """Fans state changes out to /api/stream subscribers.
+
+    A single broker thread owns every subscriber socket, so streams don't tie
+    up request workers. Each subscriber follows one account and only gets
+    that account's events. Events carry absolute values (the new account
+    totals, the full updated transaction), so a client that sees one twice
+    after a reconnect ends up in the same state. The last ``history``
+    events are kept for Last-Event-ID replay; clients that fall further
+    behind get a fresh snapshot instead.
+    """
+
+    def __init__(self, heartbeat=SSE_HEARTBEAT, history=SSE_HISTORY):
+        self.heartbeat = heartbeat
+        self.history = deque(maxlen=max(1, history))
+        self.commands = queue.Queue()
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.last_sent_id = 0
+        self.subscribers = {}  # account id -> sockets
+        self.thread = None
+        self.published = 0
+        self.dropped = 0
+        self.replays = 0
+        self.snapshots = 0
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="goodcents-events", daemon=True)
+                self.thread.start()
+
+    def publish(self, account_id, event_type, data):
+        """Queue an event for the account's subscribers; cheap enough to call while holding a shard lock"""
+        if self.thread is None:
+            return  # nobody has subscribed yet; their first event will be a snapshot
+        with self.lock:
+            event_id = self.next_id
+            self.next_id += 1
+            self.published += 1
+        payload = json.dumps(data, separators=(',', ':'))
+        self.commands.put(("event", event_id, account_id, f"id: {event_id}\nevent: {event_type}\ndata: {payload}\n\n".encode('utf-8')))
+
+    def subscribe(self, sock, account_id, last_event_id=None):
+        """Hand a socket whose response headers are already sent over to the broker"""
+        self.start()
+        self.commands.put(("subscribe", sock, account_id, last_event_id))
+
+    def _run(self):
+        while True:
+            try:
+                command = self.commands.get(timeout=self.heartbeat)
+            except queue.Empty:
+                for account_id in list(self.subscribers):
+                    self._broadcast(account_id, b": heartbeat\n\n")
+                continue
+            if command[0] == "event":
+                _, event_id, account_id, encoded = command
+                self.history.append((event_id, account_id, encoded))
+                self.last_sent_id = event_id
+                self._broadcast(account_id, encoded)
+            elif command[0] == "subscribe":
+                self._add_subscriber(*command[1:])
+
+    def _add_subscriber(self, sock, account_id, last_event_id):
+        sock.settimeout(SSE_WRITE_TIMEOUT)
+        if last_event_id is not None and self.history and \
+                self.history[0][0] <= last_event_id + 1 and last_event_id <= self.last_sent_id:
+            chunks = [encoded for event_id, owner, encoded in self.history
+                      if event_id > last_event_id and owner == account_id]
+            self.replays += 1
+        else:
+            payload = json.dumps(state_snapshot(account_id), separators=(',', ':'))
+            chunks = [f"id: {self.last_sent_id}\nevent: snapshot\ndata: {payload}\n\n".encode('utf-8')]
+            self.snapshots += 1
+        if self._send(sock, b"retry: 2000\n\n" + b"".join(chunks)):
+            self.subscribers.setdefault(account_id, []).append(sock)
+
+    def _broadcast(self, account_id, encoded):
+        socks = self.subscribers.get(account_id)
+        if not socks:
+            return
+        socks[:] = [sock for sock in socks if self._send(sock, encoded)]
+        if not socks:
+            del self.subscribers[account_id]
+
+    def _send(self, sock, data):
+        try:
+            sock.sendall(data)
+            return True
+        except OSError:
+            self.dropped += 1
+            try:
+                sock.close()
+            except OSError:
+                pass
+            return False
+
+    def metrics(self):
+        return {
+            "subscribers": sum(len(socks) for socks in list(self.subscribers.values())),
+            "accounts": len(self.subscribers),
+            "published": self.published,
+            "pending": self.commands.qsize(),
+            "replays": self.replays,
+            "snapshots": self.snapshots,
+            "dropped": self.dropped,
+        }
+
+EVENT_BROKER = EventBroker()
+
+# =============================================================================
+# RESPONSE CACHE
+# =============================================================================
+
+# Bodies smaller than this aren't worth compressing
+COMPRESS_MIN_BYTES = 256
+# Cached responses kept across all accounts
+RESPONSE_CACHE_ENTRIES = 10000
+
+def choose_encoding(accept_encoding):
+    """Best supported Content-Encoding for an Accept-Encoding header, or None"""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        token, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if token:
+            accepted[token.lower()] = quality
+    for encoding in (["br"] if BROTLI_AVAILABLE else []) + ["gzip"]:
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+class CachedResponse:
+    """A pre-encoded JSON body with its ETag and lazily built compressed variants"""
+
+    def __init__(self, version, body):
+        self.version = version
+        self.body = body
+        self.etag = f'"{hashlib.sha1(body).hexdigest()[:20]}"'
+        self.encoded = {}
+
+    def variant(self, encoding):
+        """(body, Content-Encoding) for the negotiated encoding"""
+        if encoding is None or len(self.body) < COMPRESS_MIN_BYTES:
+            return self.body, None
+        body = self.encoded.get(encoding)
+        if body is None:
+            body = brotli.compress(self.body) if encoding == "br" else gzip.compress(self.body, compresslevel=6)
+            self.encoded[encoding] = body
+        return body, encoding
+
+class ResponseCache:
+    """Serialised read-endpoint responses per account, rebuilt only when their version moves.
+
+    Entries are keyed by (name, account id) and the least recently used are
+    evicted beyond ``max_entries``, so idle accounts don't pin memory.
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_ENTRIES):
+        self.max_entries = max(1, max_entries)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.rebuilds = 0
+        self.not_modified = 0
+
+    def get(self, name, account_id, build):
+        """The cached response for ``name`` on an account (None for shared data like charities).
+
+        ``build(account)`` returns fresh data and runs under the account's shard lock.
+        """
+        if account_id is None:
+            return self._lookup((name, None), charities_version(), build, None)
+        with ACCOUNTS.locked(account_id, create=False) as account:
+            return self._lookup((name, account_id), account.version(name), build, account)
+
+    def _lookup(self, key, version, build, account):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.version == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        entry = CachedResponse(version, json.dumps(build(account), separators=(',', ':')).encode('utf-8'))
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self.rebuilds += 1
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def metrics(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "rebuilds": self.rebuilds,
+            "not_modified": self.not_modified,
+        }
+
+RESPONSE_CACHE = ResponseCache()
+
+# =============================================================================
+# STATIC ASSETS
+# =============================================================================
+
+# How often a cached file is stat()ed to notice it changed on disk
+STATIC_RECHECK_INTERVAL = 1.0
+
+class StaticAsset(CachedResponse):
+    """A page held in memory with every compressed variant built up front"""
+
+    def __init__(self, version, body, modified):
+        super().__init__(version, body)
+        self.modified = int(modified)
+        self.last_modified = email.utils.formatdate(self.modified, usegmt=True)
+        for encoding in ["gzip"] + (["br"] if BROTLI_AVAILABLE else []):
+            self.variant(encoding)
+
+    def not_modified(self, if_none_match, if_modified_since):
+        """True when the client's conditional headers show its copy is current"""
+        if if_none_match:
+            return self.etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == "*"
+        if if_modified_since:
+            try:
+                return email.utils.parsedate_to_datetime(if_modified_since).timestamp() >= self.modified
+            except (TypeError, ValueError):
+                return False
+        return False
+
+class StaticAssetCache:
+    """The HTML pages, read and compressed once and served from memory.
+
+    Files are reloaded when their mtime or size changes, checked at most
+    every ``recheck_interval`` seconds, so a page load normally touches no
+    disk at all. Generated pages are rebuilt when their version changes.
+    """
+
+    def __init__(self, recheck_interval=STATIC_RECHECK_INTERVAL):
+        self.recheck_interval = recheck_interval
+        self.entries = {}
+        self.checked_at = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.not_modified = 0
+
+    def file(self, filename):
+        """The cached asset for a file; raises FileNotFoundError once it is gone"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None and now - self.checked_at[filename] < self.recheck_interval:
+                self.hits += 1
+                return entry
+        stat = os.stat(filename)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if entry is None or entry.version != version:
+            with open(filename, 'rb') as f:
+                entry = StaticAsset(version, f.read(), stat.st_mtime)
+            with self.lock:
+                self.loads += 1
+                self.entries[filename] = entry
+        else:
+            with self.lock:
+                self.hits += 1
+        with self.lock:
+            self.checked_at[filename] = now
+        return entry
+
+    def page(self, name, version, render):
+        """A generated page, rebuilt by ``render()`` only when ``version`` changes"""
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry.version == version:
+                self.hits += 1
+                return entry
+        entry = StaticAsset(version, render().encode('utf-8'), time.time())
+        with self.lock:
+            self.loads += 1
+            self.entries[name] = entry
+        return entry
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": sum(len(entry.body) + sum(map(len, entry.encoded.values())) for entry in self.entries.values()),
+                "hits": self.hits,
+                "loads": self.loads,
+                "not_modified": self.not_modified,
+            }
+
+STATIC_ASSETS = StaticAssetCache()
+
+# The files GET may serve, by path; nothing else in the working directory is exposed
+STATIC_PAGES = {
+    '/': 'bank_mobile_app.html',
+    '/bank': 'bank_mobile_app.html',
+    '/bank_mobile_app.html': 'bank_mobile_app.html',
+    '/checkout': 'checkout_demo.html',
+    '/checkout_demo.html': 'checkout_demo.html',
+}
+
+# =============================================================================
+# PAYMENT PROCESSING
+# =============================================================================
+
+MONTHLY_CAP = 1000  # pence
+# Batches up to this size push one SSE event per transaction; bigger ones
+# push a single snapshot instead
+BATCH_EVENT_LIMIT = 50
+
+def roundup_step(settings):
+    """Pence to round each payment up to: the next pound or the next 25p"""
+    return 100 if settings["round_to_pound"] else 25
+
+def calculate_roundup(amount, step):
+    """Spare change for one payment in pence; a whole multiple of step rounds up by nothing"""
+    return -amount % step
+
+def batch_roundups(amounts, step):
+    """calculate_roundup over a whole list of pence amounts in one pass"""
+    return [-amount % step for amount in amounts]
+
+def cap_roundups(roundups, donated, cap):
+    """Trim a run of roundups, in order, so donated plus their total never passes cap.
+
+    Same result as capping them one at a time: the running total is clamped
+    at the cap and each roundup becomes the step between clamped totals.
+    """
+    ceiling = max(cap, donated)
+    totals = [min(total, ceiling) for total in itertools.accumulate(roundups, initial=donated)]
+    return [high - low for low, high in zip(totals, totals[1:])]
+
+def apply_monthly_cap(account, roundup, settings):
+    """Trim a roundup so the account's monthly_donated stays within MONTHLY_CAP (caller holds its shard lock)"""
+    if not (settings["roundups_enabled"] and settings["monthly_cap"]):
+        return roundup
+    capped = max(0, min(roundup, MONTHLY_CAP - account.monthly_donated_pence))
+    if capped != roundup:
+        log_event(logging.INFO, "Monthly cap reached", roundup=to_pounds(roundup), capped=to_pounds(capped))
+    return capped
+
+def select_charity(merchant, amount, settings):
+    """(charity, confidence, reasoning, status) for a payment, without holding any lock.
+
+    In async mode, merchants with no cached or local answer get the keyword
+    match now and status "pending" so the caller queues a Claude lookup.
+    """
+    asynchronous = settings["ai_charity_selection"] and ASYNC_AI_CLASSIFICATION and ai_available()
+    if asynchronous:
+        known, _ = known_charity_decision(merchant)
+        if known is not None:
+            return known + ("classified",)
+        return fallback_charity_selection(merchant) + ("pending",)
+    if settings["ai_charity_selection"]:
+        return ai_select_charity_claude(merchant, amount) + ("classified",)
+    return fallback_charity_selection(merchant) + ("classified",)
+
+def record_payment(account, merchant, amount, roundup, charity, ai_confidence, ai_reasoning, status):
+    """Append a purchase and debit the account, amounts in pence; returns the stored row.
+
+    The caller holds the account's shard lock and TRANSACTIONS.lock, and
+    logs the payment before releasing them.
+    """
+    new_transaction = {
+        "id": None,  # assigned by TRANSACTIONS.append
+        "merchant": merchant,
+        "amount": to_pounds(amount),
+        "roundup": to_pounds(roundup),
+        "charity": charity,
+        "time": "Just now",
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "type": "purchase",
+        "status": status,
+        "ai_confidence": ai_confidence if charity else 0,
+        "ai_reasoning": ai_reasoning if charity else "No charity donation"
+    }
+    TRANSACTIONS.append(new_transaction)
+    account.add_transaction(new_transaction)
+    account.balance_pence -= amount
+    account.monthly_donated_pence += roundup
+    return new_transaction
+
+class ChangeNotConfirmed(Exception):
+    """A change was applied in memory but its ledger write failed or timed out.
+
+    It is not rolled back: later payments may already build on the new
+    balance, and the next snapshot writes it out with the rest of memory.
+    ``body`` is the response to send with a 500, and is what a retry with
+    the same Idempotency-Key gets back.
+    """
+
+    def __init__(self, message, body):
+        super().__init__(message)
+        self.body = body
+
+def wait_for_commit(ledger_commit, body, change="Payment"):
+    """LEDGER.wait(); raises ChangeNotConfirmed carrying ``body`` if the record didn't reach disk"""
+    try:
+        LEDGER.wait(ledger_commit)
+    except OSError as e:
+        message = f"{change} not confirmed on disk: {e}"
+        raise ChangeNotConfirmed(message, dict(body, status="unconfirmed", message=message)) from e
+
+def process_payment(account_id, payment_data, timer=None):
+    """Price, classify and commit one payment; returns the response body.
+
+    ``timer`` (a StageTimer) is lapped at the end of the parse, classify and
+    commit stages.
+    """
+    timer = timer or StageTimer()
+    amount_pence = to_pence(payment_data.get("amount", 10))
+    if amount_pence <= 0:
+        raise ValueError("Amount must be positive")
+    amount = to_pounds(amount_pence)
+    merchant = payment_data.get("merchant", "Test Store")
+    timer.lap("parse")
+    
+    with ACCOUNTS.locked(account_id) as account:
+        settings = account.settings()
+    status = "classified"
+    
+    # Check if roundups are enabled
+    if not settings["roundups_enabled"]:
+        roundup = 0
+        charity = None
+        ai_confidence = 0
+        ai_reasoning = "Roundups disabled"
     else:
-        return "Teach First", 75, "General education support"
+        # Calculate roundup
+        roundup = calculate_roundup(amount_pence, roundup_step(settings))
+        
+        # Select charity using AI (outside the lock - this can take seconds)
+        charity, ai_confidence, ai_reasoning, status = select_charity(merchant, amount, settings)
+    timer.lap("classify")
+    
+    with ACCOUNTS.locked(account_id) as account, TRANSACTIONS.lock:
+        # Check monthly cap against the balance as it is now, not as it
+        # was before the AI call
+        roundup = apply_monthly_cap(account, roundup, settings)
+        
+        # Create transaction and update the account
+        new_transaction = record_payment(account, merchant, amount_pence, roundup, charity, ai_confidence, ai_reasoning, status)
+        view = account.view()
+        committed_transaction = dict(new_transaction)
+        account.mark_changed("account", "transactions")
+        ledger_commit = LEDGER.append({
+            "type": "payment",
+            "account_id": account_id,
+            "transaction": committed_transaction,
+            "account": account.balances(),
+        })
+        EVENT_BROKER.publish(account_id, "transaction", committed_transaction)
+        EVENT_BROKER.publish(account_id, "account", view)
+    
+    roundup = committed_transaction["roundup"]
+    response = {
+        "status": "success",
+        "transaction": committed_transaction,
+        "new_balance": view["balance"],
+        "monthly_donated": view["monthly_donated"],
+        "message": f"Payment processed! {f'£{roundup:.2f} donated to {charity}' if roundup > 0 else 'No roundup applied'}"
+    }
+    
+    # Memory already holds the payment, so it is classified either way
+    if status == "pending":
+        CLASSIFICATION_POOL.submit(account_id, new_transaction["id"], merchant, amount)
+    # Don't acknowledge the payment until it is on disk
+    wait_for_commit(ledger_commit, response)
+    timer.lap("commit")
+    
+    log_event(logging.INFO, "Payment processed", account_id=account_id, transaction_id=new_transaction["id"],
+              merchant=merchant, amount=amount, roundup=roundup, charity=charity,
+              confidence=ai_confidence, status=status, balance=view["balance"])
+    
+    return response
+
+def update_settings(account_id, settings_data):
+    """Apply and log a settings change; returns the response body"""
+    with ACCOUNTS.locked(account_id) as account:
+        settings = account.update_settings(settings_data)
+        for key in settings_data:
+            if key in settings:
+                log_event(logging.INFO, "Setting updated", account_id=account_id, setting=key, value=settings[key])
+        account.mark_changed("settings")
+        ledger_commit = LEDGER.append({"type": "settings", "account_id": account_id, "settings": settings})
+        EVENT_BROKER.publish(account_id, "settings", settings)
+    response = {"status": "success", "settings": settings}
+    wait_for_commit(ledger_commit, response, "Settings change")
+    return response
+
+def parse_batch_payments(body, content_type):
+    """Yield (row number, payment dict or None, error message or None) from CSV or JSON lines"""
+    text = body.decode('utf-8-sig')
+    if 'csv' in (content_type or ''):
+        for number, row in enumerate(csv.DictReader(io.StringIO(text)), start=1):
+            yield number, row, None
+        return
+    for number, line in enumerate((line for line in text.splitlines() if line.strip()), start=1):
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield number, None, f"Invalid JSON: {e}"
+            continue
+        if isinstance(row, dict):
+            yield number, row, None
+        else:
+            yield number, None, "Each line must be a JSON object"
+
+def process_payment_batch(account_id, rows):
+    """Validate, price, classify and commit a batch of payments to one account; returns the response body.
+
+    Roundups for the whole batch are computed in one pass and each distinct
+    merchant is classified once. All accepted rows then go through the cap
+    and are committed in order under one hold of the account's lock, with
+    one ledger record.
+    """
+    results = []
+    accepted = []
+    for number, row, error in rows:
+        if len(results) >= BATCH_MAX_ROWS:
+            raise ValueError(f"Batch larger than {BATCH_MAX_ROWS} rows")
+        if error is None:
+            try:
+                amount = to_pence(row.get("amount"))
+                merchant = str(row.get("merchant") or "").strip()
+                if not merchant or amount <= 0:
+                    raise ValueError("needs a merchant and a positive amount")
+            except (TypeError, ValueError) as e:
+                error = f"Invalid payment: {e}"
+        if error is not None:
+            results.append({"row": number, "status": "error", "message": error})
+        else:
+            results.append({"row": number, "status": "success"})
+            accepted.append((len(results) - 1, merchant, amount))
+    
+    with ACCOUNTS.locked(account_id) as account:
+        settings = account.settings()
+    
+    roundups = batch_roundups([amount for _, _, amount in accepted], roundup_step(settings))
+    
+    decisions = {}
+    if settings["roundups_enabled"]:
+        first_amounts = {}
+        for _, merchant, amount in accepted:
+            first_amounts.setdefault(merchant, amount)
+        # Enough lookups in flight at once for the batcher to fill a request
+        workers = max(AI_WORKERS, AI_BATCHER.max_size if AI_BATCHER.window > 0 else 0)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {merchant: executor.submit(select_charity, merchant, to_pounds(amount), settings)
+                       for merchant, amount in first_amounts.items()}
+            decisions = {merchant: future.result() for merchant, future in futures.items()}
+    
+    pending = []
+    with ACCOUNTS.locked(account_id) as account, TRANSACTIONS.lock:
+        if settings["roundups_enabled"] and settings["monthly_cap"]:
+            capped = cap_roundups(roundups, account.monthly_donated_pence, MONTHLY_CAP)
+            if capped != roundups:
+                log_event(logging.INFO, "Monthly cap reached", account_id=account_id,
+                          roundup=to_pounds(sum(roundups)), capped=to_pounds(sum(capped)))
+            roundups = capped
+        committed = []
+        for (index, merchant, amount), roundup in zip(accepted, roundups):
+            if settings["roundups_enabled"]:
+                charity, ai_confidence, ai_reasoning, status = decisions[merchant]
+            else:
+                roundup, charity, ai_confidence, ai_reasoning, status = 0, None, 0, "Roundups disabled", "classified"
+            transaction = dict(record_payment(account, merchant, amount, roundup, charity, ai_confidence, ai_reasoning, status))
+            committed.append(transaction)
+            results[index].update(transaction_id=transaction["id"], amount=transaction["amount"], roundup=transaction["roundup"], charity=charity)
+            if status == "pending":
+                pending.append((transaction["id"], merchant, transaction["amount"]))
+        view = account.view()
+        ledger_commit = None
+        if committed:
+            account.mark_changed("account", "transactions")
+            ledger_commit = LEDGER.append({
+                "type": "payment_batch",
+                "account_id": account_id,
+                "transactions": committed,
+                "account": account.balances(),
+            })
+            if len(committed) <= BATCH_EVENT_LIMIT:
+                for transaction in committed:
+                    EVENT_BROKER.publish(account_id, "transaction", transaction)
+                EVENT_BROKER.publish(account_id, "account", view)
+            else:
+                EVENT_BROKER.publish(account_id, "snapshot", state_snapshot(account_id))
+    
+    response = {
+        "status": "success",
+        "accepted": len(committed),
+        "rejected": len(results) - len(committed),
+        "new_balance": view["balance"],
+        "monthly_donated": view["monthly_donated"],
+        "results": results,
+    }
+    for transaction_id, merchant, amount in pending:
+        CLASSIFICATION_POOL.submit(account_id, transaction_id, merchant, amount)
+    wait_for_commit(ledger_commit, response)
+    
+    log_event(logging.INFO, "Batch processed", account_id=account_id,
+              accepted=len(committed), rejected=len(results) - len(committed))
+    return response
+
+# =============================================================================
+# DONATION IMPACT
+# =============================================================================
+
+IMPACT_DAYS = 30
+IMPACT_MONTHS = 12
+
+def impact_report(account, days=IMPACT_DAYS, months=IMPACT_MONTHS):
+    """/api/impact body from the account's rollup (caller holds its shard lock).
+
+    Work grows with the number of charities and buckets asked for, never
+    with the length of the history.
+    """
+    rollup = account.rollup or DonationRollup()
+    charities = []
+    for name, pence in sorted(rollup.by_charity.items(), key=lambda item: -item[1]):
+        info = CHARITIES.get(name)
+        charities.append({
+            "charity": name,
+            "donated": to_pounds(pence),
+            "donations": rollup.donations[name],
+            "impact": round(pence / 100 / info["costPerImpact"], 2) if info else None,
+            "unit": info["unit"] if info else None,
+        })
+    return {
+        "total_donated": to_pounds(sum(rollup.by_charity.values())),
+        "monthly_donated": to_pounds(account.monthly_donated_pence),
+        "charities": charities,
+        "daily": newest_buckets(rollup.by_day, days),
+        "monthly": newest_buckets(rollup.by_month, months),
+    }
+
+def newest_buckets(buckets, count):
+    """The last ``count`` buckets in pounds, oldest first; bucket dicts fill in date order"""
+    newest = list(itertools.islice(reversed(buckets.items()), count))
+    return {key: to_pounds(pence) for key, pence in reversed(newest)}
+
+def rebuild_rollups():
+    """Recompute every account's rollup from the stored transactions; returns how many accounts were rebuilt"""
+    with ACCOUNTS.all_locked():
+        accounts = list(ACCOUNTS)
+        for account in accounts:
+            account.rebuild_rollup()
+            account.mark_changed("transactions")
+    return len(accounts)
+
+def impact_command(args):
+    """`python good_cents_server.py impact rebuild` - replay the ledger, recompute rollups and snapshot them"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="good_cents_server.py impact")
+    parser.add_argument("action", choices=["rebuild"])
+    parser.parse_args(args)
+    
+    if not LEDGER_ENABLED:
+        print("The ledger is disabled (GOODCENTS_LEDGER=0); there is nothing to rebuild from")
+        return 1
+    started = time.perf_counter()
+    recovery = LEDGER.recover()
+    rebuilt = rebuild_rollups()
+    LEDGER.start()
+    LEDGER.close()  # writes a snapshot holding the rebuilt rollups
+    print(f"Rebuilt donation rollups for {rebuilt} accounts from {recovery['records_replayed']} replayed records "
+          f"in {time.perf_counter() - started:.2f}s")
+    return 0
+
+# =============================================================================
+# RECLASSIFICATION
+# =============================================================================
+
+RECLASSIFY_CHUNK = 1000
+RECLASSIFY_MEMO_SIZE = 10000
+RECLASSIFY_PROGRESS_INTERVAL = 2.0
+RECLASSIFY_CHECKPOINT = os.path.join(DATA_DIR, "reclassify.checkpoint.json")
+RECLASSIFY_SPILL = f"{TRANSACTION_SPILL_FILE}.reclassify"
+# Outcomes that leave a row as it was instead of writing the keyword guess over
+# it; "fallback" (no Claude configured, no confident local answer) only
+# overwrites with --allow-fallback
+RECLASSIFY_FAILED_OUTCOMES = ("parse_error", "error", "fallback")
+
+class ReclassifyStats:
+    """Counters and throughput for one reclassification run, carried across resumes"""
+
+    def __init__(self, total, counts=None):
+        self.total = total
+        self.counts = {"rows": 0, "donations": 0, "changed": 0, "merchants": 0, "failed": 0, **(counts or {})}
+        self.started = time.perf_counter()
+        self.resumed_rows = self.counts["rows"]
+        self.last_report = self.started
+
+    def report(self, force=False):
+        now = time.perf_counter()
+        if not force and now - self.last_report < RECLASSIFY_PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+        rate = (self.counts["rows"] - self.resumed_rows) / max(now - self.started, 1e-9)
+        print(f"{self.counts['rows']}/{self.total} rows ({rate:.0f} rows/s), {self.counts['changed']} changed, "
+              f"{self.counts['merchants']} merchants classified, {self.counts['failed']} failed", file=sys.stderr)
+
+def chunked(rows, size):
+    """Lists of up to ``size`` consecutive items"""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+def reclassified_chunks(chunks, executor, memo, stats, failed_outcomes=RECLASSIFY_FAILED_OUTCOMES):
+    """For each chunk of rows, a list of (row, new fields or None).
+
+    Donation rows are grouped by merchant, so each distinct merchant in a
+    chunk is classified once (cache, then local model, then Claude) on the
+    bounded ``executor``; ``memo`` remembers recent answers across chunks.
+    Rows with no donation, or whose merchant's outcome is in
+    ``failed_outcomes``, get None.
+    """
+    for chunk in chunks:
+        wanted = {}
+        for row in chunk:
+            if row.get("charity") and row.get("roundup"):
+                key = normalise_merchant(row["merchant"])
+                if key not in memo:
+                    wanted.setdefault(key, (row["merchant"], row["amount"]))
+        futures = {key: executor.submit(_select_charity, merchant, amount)
+                   for key, (merchant, amount) in wanted.items()}
+        for key, future in futures.items():
+            decision, outcome = future.result()
+            if outcome == "circuit_open":
+                raise CircuitOpenError("Claude circuit breaker opened during reclassification")
+            stats.counts["merchants"] += 1
+            if outcome in failed_outcomes:
+                stats.counts["failed"] += 1
+                continue
+            memo[key] = decision
+            if len(memo) > RECLASSIFY_MEMO_SIZE:
+                memo.popitem(last=False)
+        
+        results = []
+        for row in chunk:
+            fields = None
+            if row.get("charity") and row.get("roundup"):
+                stats.counts["donations"] += 1
+                decision = memo.get(normalise_merchant(row["merchant"]))
+                if decision is not None:
+                    charity, confidence, reasoning = decision
+                    fields = {"charity": charity, "ai_confidence": confidence, "ai_reasoning": reasoning,
+                              "status": "classified"}
+                    if charity != row["charity"]:
+                        stats.counts["changed"] += 1
+            stats.counts["rows"] += 1
+            results.append((row, fields))
+        yield results
+
+def reclassify_diff(row, fields):
+    """A dry-run line for a row whose charity or confidence would change, else None"""
+    if fields is None or (fields["charity"], fields["ai_confidence"]) == (row["charity"], row.get("ai_confidence")):
+        return None
+    return json.dumps({
+        "id": row["id"],
+        "merchant": row["merchant"],
+        "roundup": row["roundup"],
+        "from": {"charity": row["charity"], "ai_confidence": row.get("ai_confidence")},
+        "to": {"charity": fields["charity"], "ai_confidence": fields["ai_confidence"]},
+    })
+
+def load_reclassify_checkpoint(version):
+    """(next spilled id, bytes of RECLASSIFY_SPILL written, counts) to resume from, or None"""
+    try:
+        with open(RECLASSIFY_CHECKPOINT, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get("version") != version:
+        return None
+    try:
+        if os.path.getsize(RECLASSIFY_SPILL) < checkpoint["spill_bytes"]:
+            return None
+    except OSError:
+        return None
+    return checkpoint["next_id"], checkpoint["spill_bytes"], checkpoint["counts"]
+
+def save_reclassify_checkpoint(version, next_id, spill_bytes, counts):
+    tmp_path = f"{RECLASSIFY_CHECKPOINT}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({"version": version, "next_id": next_id, "spill_bytes": spill_bytes, "counts": counts}, f)
+    os.replace(tmp_path, RECLASSIFY_CHECKPOINT)
+
+def reclassify_command(args):
+    """`python good_cents_server.py reclassify` - re-run charity selection over the stored history.
+
+    Run with the server stopped, after editing CHARITIES. Spilled rows are
+    streamed from the spill file through reclassified_chunks() and written to
+    a new spill file chunk by chunk, with a checkpoint after each chunk so an
+    interrupted run resumes where it stopped. The in-memory rows follow, then
+    the new file replaces the old one, rollups are rebuilt and a snapshot is
+    written. ``--dry-run`` only prints a JSON line per row that would change.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="good_cents_server.py reclassify")
+    parser.add_argument("--dry-run", action="store_true", help="print the changes as JSON lines, write nothing")
+    parser.add_argument("--chunk", type=int, default=RECLASSIFY_CHUNK, help="rows per chunk and checkpoint")
+    parser.add_argument("--concurrency", type=int, default=max(AI_WORKERS, AI_BATCH_SIZE),
+                        help="merchants classified at once")
+    parser.add_argument("--restart", action="store_true", help="ignore any checkpoint and start from the first row")
+    parser.add_argument("--allow-fallback", action="store_true",
+                        help="write keyword-matched charities when neither Claude nor the local model can answer")
+    options = parser.parse_args(args)
+    failed_outcomes = tuple(outcome for outcome in RECLASSIFY_FAILED_OUTCOMES
+                            if not (options.allow_fallback and outcome == "fallback"))
+    
+    if not LEDGER_ENABLED:
+        print("The ledger is disabled (GOODCENTS_LEDGER=0); there is no stored history to reclassify")
+        return 1
+    LEDGER.recover()
+    version = charities_version()
+    spilled = len(TRANSACTIONS.spill_offsets) if TRANSACTIONS.spill_path else 0
+    
+    checkpoint = None
+    if not options.dry_run and not options.restart:
+        checkpoint = load_reclassify_checkpoint(version)
+    next_id, spill_bytes, counts = checkpoint or (1, 0, None)
+    if checkpoint:
+        print(f"Resuming at row {next_id} of {len(TRANSACTIONS)}", file=sys.stderr)
+    stats = ReclassifyStats(len(TRANSACTIONS), counts)
+    memo = OrderedDict()
+    ai_calls_before = ai_client_metrics()["calls"]
+    
+    spill = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, options.concurrency)) as executor:
+        try:
+            if not options.dry_run and spilled:
+                spill = open(RECLASSIFY_SPILL, 'r+b' if checkpoint else 'wb')
+                spill.truncate(spill_bytes)
+                spill.seek(spill_bytes)
+            for results in reclassified_chunks(chunked(TRANSACTIONS.spilled_rows(next_id), max(1, options.chunk)),
+                                               executor, memo, stats, failed_outcomes):
+                if options.dry_run:
+                    for row, fields in results:
+                        line = reclassify_diff(row, fields)
+                        if line:
+                            print(line)
+                else:
+                    for row, fields in results:
+                        row.update(fields or {})
+                        spill.write(json.dumps(row, separators=(',', ':')).encode('utf-8') + b"\n")
+                    spill.flush()
+                    os.fsync(spill.fileno())
+                    save_reclassify_checkpoint(version, results[-1][0]["id"] + 1, spill.tell(), stats.counts)
+                    DECISION_CACHE.save()
+                stats.report()
+            
+            # The in-memory rows are updated in place; they are at most
+            # TRANSACTION_MEMORY_LIMIT rows and are redone in full on resume
+            with TRANSACTIONS.lock:
+                recent = list(TRANSACTIONS.recent)
+            for results in reclassified_chunks(chunked(recent, max(1, options.chunk)), executor, memo, stats,
+                                               failed_outcomes):
+                for row, fields in results:
+                    if options.dry_run:
+                        line = reclassify_diff(row, fields)
+                        if line:
+                            print(line)
+                    elif fields is not None:
+                        row.update(fields)
+                stats.report()
+        except CircuitOpenError as e:
+            stats.report(force=True)
+            print(f"Stopped: {e}. Run the command again to resume from the last checkpoint.", file=sys.stderr)
+            return 1
+        finally:
+            if spill is not None:
+                spill.close()
+    
+    stats.report(force=True)
+    summary = (f"{'Would reclassify' if options.dry_run else 'Reclassified'} {stats.counts['changed']} of "
+               f"{stats.counts['donations']} donations ({stats.counts['rows']} rows, "
+               f"{stats.counts['merchants']} merchants classified, {stats.counts['failed']} failed, "
+               f"{ai_client_metrics()['calls'] - ai_calls_before} Claude calls) "
+               f"in {time.perf_counter() - stats.started:.2f}s")
+    if options.dry_run:
+        print(summary, file=sys.stderr)
+        return 0
+    
+    # The new spill file lands before the snapshot: if the run stops between
+    # the two, the old snapshot still lines up with it row for row
+    if spill is not None:
+        TRANSACTIONS.replace_spill_file(RECLASSIFY_SPILL)
+    rebuild_rollups()
+    LEDGER.start()
+    LEDGER.close()  # writes a snapshot holding the updated rows and rollups
+    DECISION_CACHE.save()
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(RECLASSIFY_CHECKPOINT)
+    print(summary)
+    return 0
 
 # =============================================================================
 # HTTP SERVER
 # =============================================================================
 
+def _register_metrics():
+    """Queue depths and store sizes, read from the live objects on each /metrics scrape"""
+    for name, kind, documentation, read in (
+        ("goodcents_classification_queue_depth", "gauge", "Transactions waiting for background classification",
+         lambda: CLASSIFICATION_POOL.metrics()["queue_depth"]),
+        ("goodcents_classification_in_flight", "gauge", "Background classifications running now",
+         lambda: CLASSIFICATION_POOL.metrics()["in_flight"]),
+        ("goodcents_classification_rejected_total", "counter", "Background classifications dropped because the queue was full",
+         lambda: CLASSIFICATION_POOL.metrics()["rejected"]),
+        ("goodcents_classification_spilled_total", "counter", "Background classifications dropped because the row had spilled to disk",
+         lambda: CLASSIFICATION_POOL.metrics()["spilled"]),
+        ("goodcents_ai_calls_in_flight", "gauge", "Distinct merchants with a Claude call in flight",
+         lambda: AI_SINGLE_FLIGHT.metrics()["in_flight"]),
+        ("goodcents_ai_calls_total", "counter", "Claude API calls", lambda: ai_client_metrics()["calls"]),
+        ("goodcents_ai_failures_total", "counter", "Claude API calls that failed after retries",
+         lambda: ai_client_metrics()["failures"]),
+        ("goodcents_ai_batches_total", "counter", "Claude requests classifying several merchants at once",
+         lambda: AI_BATCHER.metrics()["batches"]),
+        ("goodcents_ai_batched_merchants_total", "counter", "Merchants classified in a batched Claude request",
+         lambda: AI_BATCHER.metrics()["batched_merchants"]),
+        ("goodcents_ai_batch_retries_total", "counter", "Merchants retried alone after a batched answer failed validation",
+         lambda: AI_BATCHER.metrics()["retried_individually"]),
+        ("goodcents_ai_breaker_open", "gauge", "1 while the Claude circuit breaker is not closed",
+         lambda: int(ai_client_metrics()["breaker"]["state"] != "closed")),
+        ("goodcents_ready", "gauge", "1 once the server is serving with warm caches, 0 while starting or draining",
+         lambda: int(LIFECYCLE.ready)),
+        ("goodcents_startup_seconds", "gauge", "Seconds from launch until the server was ready",
+         lambda: LIFECYCLE.startup_seconds or 0),
+        ("goodcents_writes_in_flight", "gauge", "POST requests running now, waited for when draining",
+         lambda: LIFECYCLE.in_flight),
+        ("goodcents_rate_limited_total", "counter", "/api reads refused with 429 by the per-client rate limit",
+         lambda: READ_LIMITER.metrics()["limited"]),
+        ("goodcents_decision_cache_entries", "gauge", "Merchant decisions cached", lambda: DECISION_CACHE.metrics()["size"]),
+        ("goodcents_decision_cache_hits_total", "counter", "Decision cache hits", lambda: DECISION_CACHE.metrics()["hits"]),
+        ("goodcents_decision_cache_misses_total", "counter", "Decision cache misses", lambda: DECISION_CACHE.metrics()["misses"]),
+        ("goodcents_ledger_pending_records", "gauge", "Ledger records waiting to be written",
+         lambda: LEDGER.metrics()["pending"]),
+        ("goodcents_ledger_fsync_seconds_total", "counter", "Time spent writing and syncing the ledger",
+         lambda: LEDGER.metrics()["fsync_seconds"]),
+        ("goodcents_event_stream_subscribers", "gauge", "Open /api/stream connections",
+         lambda: EVENT_BROKER.metrics()["subscribers"]),
+        ("goodcents_event_stream_pending", "gauge", "Events queued for slow subscribers",
+         lambda: EVENT_BROKER.metrics()["pending"]),
+        ("goodcents_transactions", "gauge", "Transactions stored", lambda: TRANSACTIONS.metrics()["total"]),
+        ("goodcents_transactions_in_memory", "gauge", "Transactions held in memory", lambda: TRANSACTIONS.metrics()["in_memory"]),
+        ("goodcents_transactions_spilled", "gauge", "Transactions spilled to disk", lambda: TRANSACTIONS.metrics()["spilled"]),
+        ("goodcents_accounts", "gauge", "Accounts in memory", lambda: len(ACCOUNTS)),
+        ("goodcents_response_cache_entries", "gauge", "Cached GET responses", lambda: RESPONSE_CACHE.metrics()["entries"]),
+        ("goodcents_static_asset_bytes", "gauge", "Static pages and their compressed variants held in memory",
+         lambda: STATIC_ASSETS.metrics()["bytes"]),
+        ("goodcents_idempotency_keys", "gauge", "Idempotency keys remembered", lambda: IDEMPOTENCY_KEYS.metrics()["size"]),
+        ("goodcents_idempotency_replays_total", "counter", "Payments answered from a stored idempotent response",
+         lambda: IDEMPOTENCY_KEYS.metrics()["hits"]),
+    ):
+        METRICS.gauge(name, documentation, read, kind)
+
+_register_metrics()
+
+# Paths reported under their own route label; everything else is "other"
+# so stray URLs can't grow the metrics without bound
+METRIC_ROUTES = frozenset({
+    "/", "/bank", "/checkout", "/demo", "/metrics",
+    "/api/account", "/api/transactions", "/api/charities", "/api/settings", "/api/stream",
+    "/api/impact", "/api/impact/rebuild", "/api/stats", "/api/payment", "/api/payments/batch",
+    "/api/classifier/evaluate", "/api/classifier/retrain", "/api/classifier/reload",
+})
+
+# Request header asking /api/payment for a Server-Timing breakdown of its stages
+TRACE_HEADER = "X-Goodcents-Trace"
+
+# Longest a worker waits for the rest of a request that has started arriving
+REQUEST_READ_TIMEOUT = 30
+
 class BankHandler(http.server.SimpleHTTPRequestHandler):
+    # Persistent connections, so a dashboard's polls reuse one socket;
+    # every response therefore needs a Content-Length
+    protocol_version = "HTTP/1.1"
+    timeout = REQUEST_READ_TIMEOUT
+    # Headers and body go out as separate writes; without TCP_NODELAY the
+    # body of a reused connection's response waits ~40ms for a delayed ACK
+    disable_nagle_algorithm = True
+    
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=os.getcwd(), **kwargs)
     
     def log_message(self, format, *args):
         pass
     
+    def handle(self):
+        """Serve the requests already sent on this connection, then give it back to the server.
+
+        Under ThreadPoolHTTPServer an idle keep-alive connection waits in the
+        server's selector rather than holding a worker.
+        """
+        if not isinstance(self.server, ThreadPoolHTTPServer):
+            super().handle()
+            return
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.pipelined_request_waiting():
+            self.handle_one_request()
+        if not self.close_connection:
+            self.server.keep_alive(self.request)
+    
+    def pipelined_request_waiting(self):
+        """True when the next request has already arrived, without blocking if it hasn't"""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+    
+    def parse_request(self):
+        self.request_parsed = super().parse_request()
+        return self.request_parsed
+    
+    def handle_one_request(self):
+        """Handle one request, counting and timing it by route"""
+        self.response_status = None
+        self.request_parsed = False
+        if isinstance(self.server, ThreadPoolHTTPServer):
+            self.request_number = self.server.count_request(self.request)
+        started = time.perf_counter()
+        try:
+            super().handle_one_request()
+        finally:
+            if self.response_status is not None:
+                # A malformed request line is rejected before path and command are parsed
+                path = urlparse(getattr(self, "path", "")).path
+                route = path if path in METRIC_ROUTES else "other"
+                command = getattr(self, "command", None)
+                method = command if command in ("GET", "POST", "OPTIONS", "HEAD") else "other"
+                HTTP_REQUESTS.inc(route, method, str(self.response_status))
+                HTTP_LATENCY.observe(time.perf_counter() - started, route, method)
+    
+    def send_response(self, code, message=None):
+        self.response_status = code
+        super().send_response(code, message)
+        if getattr(self, "request_number", 0) >= KEEPALIVE_MAX_REQUESTS:
+            self.send_header('Connection', 'close')
+    
+    def send_error(self, code, message=None, explain=None):
+        """send_error that keeps a GET's connection open; the base class closes after every error"""
+        reusable = (
+            self.request_parsed and not self.close_connection and code < 500
+            and self.command in ('GET', 'HEAD')
+            and 'Content-Length' not in self.headers and 'Transfer-Encoding' not in self.headers
+        )
+        if not reusable:
+            super().send_error(code, message, explain)
+            return
+        short, long = self.responses.get(code, ('???', '???'))
+        body = (self.error_message_format % {
+            'code': code,
+            'message': html.escape(message or short, quote=False),
+            'explain': html.escape(explain or long, quote=False),
+        }).encode('UTF-8', 'replace')
+        self.send_response(code, message or short)
+        self.send_header('Content-Type', self.error_content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+    
+    def account_id(self, query):
+        """The account a request is for: ?account=, then X-Account-Id, then the demo account"""
+        account_id = query.get('account', [None])[0] or self.headers.get('X-Account-Id') or DEFAULT_ACCOUNT_ID
+        if not ACCOUNT_ID_PATTERN.fullmatch(account_id):
+            raise ValueError("Account ids are 1-64 letters, digits or . _ @ -")
+        return account_id
+    
     def do_GET(self):
         try:
             parsed_path = urlparse(self.path)
             path = parsed_path.path
+            query = parse_qs(parsed_path.query)
+            if path == '/healthz':
+                self.serve_json({"status": "ok"})
+                return
+            if path == '/readyz':
+                self.serve_json(LIFECYCLE.readiness(), 200 if LIFECYCLE.ready else 503)
+                return
+            try:
+                account_id = self.account_id(query)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            if path.startswith('/api/'):
+                retry_after = READ_LIMITER.allow(self.client_address[0], account_id)
+                if retry_after:
+                    self.send_rate_limited(retry_after)
+                    return
+            if FOLLOWER is not None and path.startswith('/api/'):
+                if path == '/api/classifier/evaluate':
+                    self.forward_to_primary()  # the decision cache lives in the primary
+                    return
+                # Reads see every write the primary has acknowledged
+                FOLLOWER.catch_up()
             
-            if path == '/' or path == '/bank':
-                self.serve_file('bank_mobile_app.html')
-            elif path == '/checkout':
-                self.serve_file('checkout_demo.html')
+            if path in STATIC_PAGES:
+                self.serve_file(STATIC_PAGES[path])
             elif path == '/demo':
                 self.serve_demo_page()
             elif path == '/api/account':
-                self.serve_json(ACCOUNT)
+                self.serve_cached_json("account", account_id, lambda account: account.view())
             elif path == '/api/transactions':
-                self.serve_json({"transactions": TRANSACTIONS})
+                self.serve_transactions(account_id, query)
             elif path == '/api/charities':
-                self.serve_json({"charities": CHARITIES})
+                self.serve_cached_json("charities", None, lambda _: {"charities": CHARITIES})
             elif path == '/api/settings':
-                self.serve_json({"settings": SETTINGS})
+                self.serve_cached_json("settings", account_id, lambda account: {"settings": account.settings()})
+            elif path == '/api/stream':
+                self.serve_event_stream(account_id)
+            elif path == '/api/impact':
+                self.serve_impact(account_id, query)
+            elif path == '/api/stats':
+                self.serve_json(self.collect_stats())
+            elif path == '/metrics':
+                self.serve_metrics()
+            elif path == '/api/classifier/evaluate':
+                self.serve_json(evaluate_classifier(classifier_training_examples()))
             else:
-                super().do_GET()
+                # Only the pages above are served: the working directory also
+                # holds the data dir (ledger, snapshot, spill file)
+                self.send_error(404)
         except Exception as e:
-            print(f"GET Error: {e}")
+            log_event(logging.ERROR, "GET error", path=self.path, error=str(e), exc_info=True)
             self.send_error(500)
     
     def do_POST(self):
+        with LIFECYCLE.write() as admitted:
+            if admitted:
+                self.route_post()
+            else:
+                self.refuse_while_draining()
+    
+    def route_post(self):
         try:
+            if PRIMARY is not None:
+                if urlparse(self.path).path == '/api/payments/batch' and self.reject_oversized_batch():
+                    return
+                self.forward_to_primary()  # every write goes through the primary's ledger
+                return
             parsed_path = urlparse(self.path)
             path = parsed_path.path
+            try:
+                account_id = self.account_id(parse_qs(parsed_path.query))
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
             
             if path == '/api/payment':
-                self.handle_payment()
+                self.handle_payment(account_id)
+            elif path == '/api/payments/batch':
+                self.handle_payment_batch(account_id)
+            elif path == '/api/classifier/retrain':
+                self.handle_classifier_command("retrain")
+            elif path == '/api/classifier/reload':
+                self.handle_classifier_command("reload")
             elif path == '/api/settings':
-                self.handle_settings_update()
+                self.handle_settings_update(account_id)
+            elif path == '/api/impact/rebuild':
+                with ACCOUNTS.locked(account_id) as account:
+                    account.rebuild_rollup()
+                    account.mark_changed("transactions")
+                    report = impact_report(account)
+                self.serve_json({"status": "success", "impact": report})
             else:
                 self.send_error(404)
         except Exception as e:
-            print(f"POST Error: {e}")
+            log_event(logging.ERROR, "POST error", path=self.path, error=str(e), exc_info=True)
             self.send_error(500)
     
+    def send_rate_limited(self, retry_after):
+        """429 for a client polling faster than READ_LIMITER allows; the connection stays open"""
+        body = json.dumps({"status": "error", "message": "Too many requests, slow down"}).encode('utf-8')
+        self.send_response(429)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Retry-After', str(max(1, math.ceil(retry_after))))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def refuse_while_draining(self):
+        """503 for a write that arrives after SIGTERM; its body is left unread, so the connection closes"""
+        body = json.dumps({"status": "error", "message": "Server is shutting down, please retry"}).encode('utf-8')
+        self.send_response(503)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Retry-After', '1')
+        self.send_header('Connection', 'close')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def forward_to_primary(self):
+        """Relay this request to the primary process and send back its response (worker processes only)"""
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else None
+        headers = {name: value for name, value in self.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        try:
+            status, response_headers, response_body = PRIMARY.forward(self.command, self.path, body, headers)
+        except (http.client.HTTPException, OSError) as e:
+            log_event(logging.ERROR, "Primary unavailable", path=self.path, error=str(e))
+            self.send_error(502, "Primary process unavailable")
+            return
+        self.send_response(status)
+        for name, value in response_headers:
+            if name.lower() not in HOP_BY_HOP_HEADERS:
+                self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(response_body)
+    
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers',
+                         f'Content-Type, X-Account-Id, Idempotency-Key, Authorization, {TRACE_HEADER}')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def serve_json(self, data, status=200):
+        body = json.dumps(data, indent=2).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
+        self.wfile.write(body)
     
-    def serve_json(self, data):
+    def serve_cached_json(self, name, account_id, build):
+        """Serve a read endpoint from RESPONSE_CACHE, answering 304 when the client's copy is current"""
+        entry = RESPONSE_CACHE.get(name, account_id, build)
+        
+        if entry.etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            RESPONSE_CACHE.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', entry.etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            return
+        
+        body, encoding = entry.variant(choose_encoding(self.headers.get('Accept-Encoding')))
         self.send_response(200)
         self.send_header('Content-type', 'application/json')
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Cache-Control', 'no-cache')
+        self.send_header('ETag', entry.etag)
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(json.dumps(data, indent=2).encode('utf-8'))
+        self.wfile.write(body)
     
-    def serve_file(self, filename):
+    def serve_transactions(self, account_id, query):
+        """/api/transactions?limit=&cursor=&since_id= - the account's rows, newest first, one page at a time"""
         try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
+            limit = min(int(query.get('limit', [TRANSACTION_PAGE_LIMIT])[0]), TRANSACTION_MAX_PAGE)
+            cursor = int(query['cursor'][0]) if 'cursor' in query else None
+            since_id = int(query['since_id'][0]) if 'since_id' in query else None
+        except ValueError:
+            self.send_error(400, "limit, cursor and since_id must be integers")
+            return
+        if limit < 1:
+            self.send_error(400, "limit must be positive")
+            return
+        
+        if limit == TRANSACTION_PAGE_LIMIT and cursor is None and since_id is None:
+            # The default first page is what every dashboard polls
+            self.serve_cached_json("transactions", account_id, lambda account: account.page(TRANSACTION_PAGE_LIMIT))
+        else:
+            with ACCOUNTS.locked(account_id, create=False) as account:
+                page = account.page(limit, before_id=cursor, since_id=since_id)
+                body = json.dumps(page, separators=(',', ':')).encode('utf-8')
             self.send_response(200)
-            self.send_header('Content-type', 'text/html; charset=utf-8')
+            self.send_header('Content-type', 'application/json')
             self.send_header('Access-Control-Allow-Origin', '*')
             self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            self.wfile.write(content.encode('utf-8'))
+            self.wfile.write(body)
+    
+    def serve_impact(self, account_id, query):
+        """/api/impact?days=&months= - donation totals per charity, day and month with impact units"""
+        try:
+            days = int(query.get('days', [IMPACT_DAYS])[0])
+            months = int(query.get('months', [IMPACT_MONTHS])[0])
+        except ValueError:
+            self.send_error(400, "days and months must be integers")
+            return
+        with ACCOUNTS.locked(account_id, create=False) as account:
+            report = impact_report(account, max(0, days), max(0, months))
+        self.serve_json(report)
+    
+    def serve_event_stream(self, account_id):
+        """Start an SSE response for one account and hand the connection to the event broker"""
+        detach = getattr(self.server, "detach_request", None)
+        if detach is None:
+            self.send_error(501, "Event stream needs ThreadPoolHTTPServer")
+            return
+        try:
+            last_event_id = int(self.headers.get('Last-Event-ID', ''))
+        except ValueError:
+            last_event_id = None
+        if FOLLOWER is not None:
+            # Event ids are per process and a reconnect may land on another
+            # worker, so start every stream from a snapshot
+            last_event_id = None
+        
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('X-Accel-Buffering', 'no')
+        # The stream has no length, so it ends the connection rather than being reused
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+        detach(self.request)
+        EVENT_BROKER.subscribe(self.request, account_id, last_event_id)
+    
+    def collect_stats(self):
+        """Operational counters for the worker pools"""
+        server = self.server
+        stats = {
+            "classification": CLASSIFICATION_POOL.metrics(),
+            "decision_cache": DECISION_CACHE.metrics(),
+            "ai_in_flight": AI_SINGLE_FLIGHT.metrics(),
+            "ai_batcher": AI_BATCHER.metrics(),
+            "local_classifier": LOCAL_CLASSIFIER.metrics(),
+            "event_stream": EVENT_BROKER.metrics(),
+            "response_cache": RESPONSE_CACHE.metrics(),
+            "static_assets": STATIC_ASSETS.metrics(),
+            "transaction_store": TRANSACTIONS.metrics(),
+            "accounts": ACCOUNTS.metrics(),
+            "idempotency": IDEMPOTENCY_KEYS.metrics(),
+            "ledger": LEDGER.metrics(),
+            "ai_client": ai_client_metrics(),
+            "lifecycle": LIFECYCLE.metrics(),
+            "read_rate_limit": READ_LIMITER.metrics(),
+        }
+        if isinstance(server, ThreadPoolHTTPServer):
+            stats["server"] = server.metrics()
+        if FOLLOWER is not None:
+            stats["process"] = {"pid": os.getpid(), "follower": FOLLOWER.metrics(), "primary": PRIMARY.metrics()}
+        return stats
+    
+    def serve_metrics(self):
+        """GET /metrics - Prometheus text exposition"""
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def serve_file(self, filename):
+        try:
+            self.serve_static(STATIC_ASSETS.file(filename))
         except FileNotFoundError:
-            print(f"File not found: {filename}")
+            log_event(logging.WARNING, "File not found", filename=filename)
             self.send_error(404, f"File {filename} not found")
         except Exception as e:
-            print(f"Error serving file {filename}: {e}")
+            log_event(logging.ERROR, "Error serving file", filename=filename, error=str(e))
             self.send_error(500)
     
-    def handle_payment(self):
+    def serve_static(self, asset):
+        """Send a cached page, or 304 when the client already has it"""
+        if asset.not_modified(self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')):
+            STATIC_ASSETS.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', asset.etag)
+            self.send_header('Last-Modified', asset.last_modified)
+            self.send_header('Cache-Control', f'public, max-age={STATIC_MAX_AGE}')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            return
+        
+        body, encoding = asset.variant(choose_encoding(self.headers.get('Accept-Encoding')))
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', f'public, max-age={STATIC_MAX_AGE}')
+        self.send_header('ETag', asset.etag)
+        self.send_header('Last-Modified', asset.last_modified)
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def payment_response(self, account_id, body, timer):
+        """(HTTP status, encoded body) for one /api/payment request"""
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            if content_length > 0:
-                post_data = self.rfile.read(content_length)
-                payment_data = json.loads(post_data.decode('utf-8'))
-            else:
-                payment_data = {}
-            
-            amount = float(payment_data.get("amount", 10.0))
-            merchant = payment_data.get("merchant", "Test Store")
-            
-            print(f"💳 Processing payment: £{amount:.2f} at {merchant}")
-            
-            # Check if roundups are enabled
-            if not SETTINGS["roundups_enabled"]:
-                roundup = 0.0
-                charity = None
-                ai_confidence = 0
-                ai_reasoning = "Roundups disabled"
-                print("Roundups disabled - no charity donation")
-            else:
-                # Calculate roundup
-                if SETTINGS["round_to_pound"]:
-                    roundup = round(math.ceil(amount) - amount, 2)
-                else:
-                    roundup = round((math.ceil(amount * 4) / 4) - amount, 2)  # Round to nearest 25p
-                
-                # Select charity using AI
-                if SETTINGS["ai_charity_selection"]:
-                    charity, ai_confidence, ai_reasoning = ai_select_charity_claude(merchant, amount)
-                else:
-                    charity, ai_confidence, ai_reasoning = fallback_charity_selection(merchant)
-                
-                # Check monthly cap
-                if SETTINGS["monthly_cap"] and (ACCOUNT["monthly_donated"] + roundup) > 10.00:
-                    old_roundup = roundup
-                    roundup = max(0, 10.00 - ACCOUNT["monthly_donated"])
-                    if roundup != old_roundup:
-                        print(f"⚠️  Monthly cap reached. Roundup reduced from £{old_roundup:.2f} to £{roundup:.2f}")
-            
-            # Create transaction
-            new_transaction = {
-                "id": len(TRANSACTIONS) + 1,
-                "merchant": merchant,
-                "amount": amount,
-                "roundup": roundup,
-                "charity": charity,
-                "time": "Just now",
-                "type": "purchase",
-                "ai_confidence": ai_confidence if charity else 0,
-                "ai_reasoning": ai_reasoning if charity else "No charity donation"
-            }
-            
-            # Update global state
-            TRANSACTIONS.insert(0, new_transaction)
-            ACCOUNT["balance"] = round(ACCOUNT["balance"] - amount, 2)
-            if roundup > 0:
-                ACCOUNT["monthly_donated"] = round(ACCOUNT["monthly_donated"] + roundup, 2)
-            
-            # Log the transaction
-            if roundup > 0:
-                print(f"Payment processed: £{amount:.2f} to {merchant}")
-                print(f"AI selected {charity} (confidence: {ai_confidence}%)")
-                print(f"Roundup: £{roundup:.2f} donated to {charity}")
-                print(f"New balance: £{ACCOUNT['balance']:.2f}")
-            else:
-                print(f"Payment processed: £{amount:.2f} to {merchant} (no roundup)")
-            
-            # Send response
-            response_data = {
-                "status": "success",
-                "transaction": new_transaction,
-                "new_balance": ACCOUNT["balance"],
-                "monthly_donated": ACCOUNT["monthly_donated"],
-                "message": f"Payment processed! {f'£{roundup:.2f} donated to {charity}' if roundup > 0 else 'No roundup applied'}"
-            }
-            
-            self.serve_json(response_data)
-            
+            payment_data = json.loads(body.decode('utf-8')) if body else {}
+            response = json.dumps(process_payment(account_id, payment_data, timer), indent=2).encode('utf-8')
+            timer.lap("serialise")
+            return 200, response
+        except ChangeNotConfirmed as e:
+            log_event(logging.ERROR, "Payment not confirmed", account_id=account_id, error=str(e))
+            return 500, json.dumps(e.body, indent=2).encode('utf-8')
         except Exception as e:
-            print(f"Payment error: {e}")
+            log_event(logging.WARNING, "Payment error", account_id=account_id, error=str(e))
             error_response = {
                 "status": "error",
                 "message": f"Payment failed: {str(e)}"
             }
-            self.send_response(400)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            self.wfile.write(json.dumps(error_response).encode('utf-8'))
+            return 400, json.dumps(error_response).encode('utf-8')
+    
+    def handle_payment(self, account_id):
+        content_length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(content_length) if content_length > 0 else b""
+        key = self.headers.get('Idempotency-Key')
+        timer = StageTimer()
+        if key is None:
+            status, response = self.payment_response(account_id, body, timer)
+        elif not 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH:
+            self.send_error(400, f"Idempotency-Key must be 1-{IDEMPOTENCY_KEY_MAX_LENGTH} characters")
+            return
+        else:
+            # Keys are per account, and a key only matches a retry with the same body
+            status, response, replayed = IDEMPOTENCY_KEYS.run(
+                (account_id, key), hashlib.sha1(body).hexdigest(),
+                lambda: self.payment_response(account_id, body, timer))
+        # A replay runs no stages, so it has nothing to record
+        timer.record()
+        
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'no-cache')
+        if key is not None:
+            self.send_header('Idempotent-Replayed', 'true' if replayed else 'false')
+        if self.headers.get(TRACE_HEADER) and timer.stages:
+            self.send_header('Server-Timing', timer.server_timing())
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
     
-    def handle_settings_update(self):
+    def handle_payment_batch(self, account_id):
+        """POST /api/payments/batch - JSON lines or CSV (merchant,amount) statement import"""
+        if self.reject_oversized_batch():
+            return
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(content_length) if content_length > 0 else b""
+            response_data = process_payment_batch(account_id, parse_batch_payments(body, self.headers.get('Content-Type')))
+            self.serve_json(response_data)
+        except ChangeNotConfirmed as e:
+            log_event(logging.ERROR, "Batch payment not confirmed", account_id=account_id, error=str(e))
+            self.serve_json(e.body, 500)
+        except Exception as e:
+            log_event(logging.WARNING, "Batch payment error", account_id=account_id, error=str(e))
+            self.send_error(400, f"Batch failed: {str(e)}")
+    
+    def reject_oversized_batch(self):
+        """413 for a batch whose Content-Length is over BATCH_MAX_BYTES, before any of it is read; True if sent"""
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            return False  # reported as a bad batch once the handler reads it
+        if content_length <= BATCH_MAX_BYTES:
+            return False
+        log_event(logging.WARNING, "Batch too large", content_length=content_length, limit=BATCH_MAX_BYTES)
+        # The body is left unread, so send_error closes the connection
+        self.send_error(413, f"Batch body larger than {BATCH_MAX_BYTES} bytes")
+        return True
+    
+    def admin_authorized(self):
+        """True if the request carries GOODCENTS_ADMIN_TOKEN as a bearer token; otherwise sends 403"""
+        if not ADMIN_TOKEN:
+            self.send_error(403, "Classifier commands are disabled; set GOODCENTS_ADMIN_TOKEN or use the CLI")
+            return False
+        scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+        if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode(), ADMIN_TOKEN.encode()):
+            log_event(logging.WARNING, "Classifier command refused", client=self.client_address[0])
+            self.send_error(403, "Admin token required")
+            return False
+        return True
+    
+    def handle_classifier_command(self, action):
+        if not self.admin_authorized():
+            return
+        try:
+            if action == "retrain":
+                LOCAL_CLASSIFIER.retrain()
+            elif not LOCAL_CLASSIFIER.reload():
+                raise ValueError("No saved classifier to load")
+            self.serve_json({"status": "success", "classifier": LOCAL_CLASSIFIER.metrics()})
+        except ValueError as e:
+            self.send_error(400, str(e))
+    
+    def handle_settings_update(self, account_id):
         try:
             content_length = int(self.headers.get('Content-Length', 0))
             if content_length > 0:
                 post_data = self.rfile.read(content_length)
                 settings_data = json.loads(post_data.decode('utf-8'))
-                
-                # Update settings
-                for key, value in settings_data.items():
-                    if key in SETTINGS:
-                        SETTINGS[key] = value
-                        print(f"Setting updated: {key} = {value}")
-                
-                self.serve_json({"status": "success", "settings": SETTINGS})
+                self.serve_json(update_settings(account_id, settings_data))
             else:
-                self.serve_json({"settings": SETTINGS})
+                with ACCOUNTS.locked(account_id, create=False) as account:
+                    settings = account.settings()
+                self.serve_json({"settings": settings})
             
+        except ChangeNotConfirmed as e:
+            # The settings themselves were fine; the disk wasn't
+            log_event(logging.ERROR, "Settings not confirmed", account_id=account_id, error=str(e))
+            self.serve_json(e.body, 500)
         except Exception as e:
-            print(f"Settings error: {e}")
+            log_event(logging.WARNING, "Settings error", account_id=account_id, error=str(e))
             self.send_error(400, f"Invalid settings data: {str(e)}")
     
     def serve_demo_page(self):
         ai_status = "Claude AI Enabled" if (CLAUDE_API_KEY and ANTHROPIC_AVAILABLE) else "⚠️ Claude AI Disabled (Add API key)"
-        
+        # The page only changes with AI availability, so it is built once per status
+        version = (ai_status, bool(CLAUDE_API_KEY))
+        self.serve_static(STATIC_ASSETS.page("demo", version, lambda: self.demo_page_html(ai_status)))
+    
+    def demo_page_html(self, ai_status):
         html = f"""
 <!DOCTYPE html>
 <html lang="en">
@@ -537,19 +4248,917 @@ class BankHandler(http.server.SimpleHTTPRequestHandler):
 </body>
 </html>
         """
-        
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(html.encode('utf-8'))
+        return html
+
+# =============================================================================
+# ADMISSION CONTROL
+# =============================================================================
+
+# Served in this order; only reads are ever shed
+ADMISSION_CLASSES = ("write", "other", "read")
+WRITE_METHODS = (b"POST", b"PUT", b"PATCH", b"DELETE")
+
+ADMISSION_WAIT = METRICS.histogram("goodcents_admission_wait_seconds",
+                                   "Time a connection waited for a worker, by priority class", ("class",))
+ADMISSION_SHED = METRICS.counter("goodcents_admission_shed_total",
+                                 "Requests turned away with 503 by admission control, by priority class", ("class",))
+
+def admission_class(sock):
+    """Priority class of the request waiting on ``sock``, from a peek at its request line.
+
+    A connection whose request hasn't arrived yet (or a platform without
+    MSG_DONTWAIT) counts as "other".
+    """
+    if not hasattr(socket, "MSG_DONTWAIT"):
+        return "other"
+    try:
+        head = sock.recv(256, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+    except OSError:
+        return "other"
+    method, _, target = head.partition(b" ")
+    if method in WRITE_METHODS:
+        return "write"
+    if method in (b"GET", b"HEAD") and target.startswith(b"/api/"):
+        return "read"
+    return "other"
+
+class AdmissionQueue:
+    """Connections waiting for a worker, handed out by priority class.
+
+    Writes (payments, settings) go first, then pages, probes and anything
+    not yet readable, then /api reads, so a flood of dashboard polls can't
+    hold up a payment. When the queue is full a new read is refused, while
+    any other request takes the place of the newest queued read. A read that
+    has waited longer than ``read_max_wait`` is shed rather than served, as
+    the dashboard will have polled again by then. Shed connections are
+    passed to ``on_shed``.
+    """
+
+    def __init__(self, maxsize, on_shed, read_max_wait=READ_MAX_WAIT):
+        self.maxsize = max(1, maxsize)
+        self.on_shed = on_shed
+        self.read_max_wait = read_max_wait
+        self.cond = threading.Condition()
+        self.queues = {name: deque() for name in ADMISSION_CLASSES}
+        self.stopping = 0
+        self.admitted = dict.fromkeys(ADMISSION_CLASSES, 0)
+        self.shed = dict.fromkeys(ADMISSION_CLASSES, 0)
+        self.wait_seconds = dict.fromkeys(ADMISSION_CLASSES, 0.0)
+        self.max_wait = dict.fromkeys(ADMISSION_CLASSES, 0.0)
+
+    def qsize(self):
+        with self.cond:
+            return sum(len(waiting) for waiting in self.queues.values())
+
+    def put_nowait(self, item):
+        """Queue a (request, client_address) pair; raises queue.Full if there is no room for its class"""
+        name = admission_class(item[0])
+        evicted = None
+        with self.cond:
+            if sum(len(waiting) for waiting in self.queues.values()) >= self.maxsize:
+                if name == "read" or not self.queues["read"]:
+                    self.shed[name] += 1
+                    ADMISSION_SHED.inc(name)
+                    raise queue.Full
+                _, evicted = self.queues["read"].pop()
+                self.shed["read"] += 1
+            self.queues[name].append((time.monotonic(), item))
+            self.cond.notify()
+        if evicted is not None:
+            ADMISSION_SHED.inc("read")
+            self.on_shed(evicted)
+
+    def get(self):
+        """The next (request, client_address) to serve, or None once a worker should stop"""
+        while True:
+            with self.cond:
+                while not any(self.queues.values()) and not self.stopping:
+                    self.cond.wait()
+                name = next((name for name in ADMISSION_CLASSES if self.queues[name]), None)
+                if name is None:
+                    self.stopping -= 1
+                    return None
+                enqueued, item = self.queues[name].popleft()
+                waited = time.monotonic() - enqueued
+                stale = name == "read" and waited > self.read_max_wait
+                if stale:
+                    self.shed[name] += 1
+                else:
+                    self.admitted[name] += 1
+                    self.wait_seconds[name] += waited
+                    self.max_wait[name] = max(self.max_wait[name], waited)
+            if stale:
+                ADMISSION_SHED.inc(name)
+                self.on_shed(item)
+                continue
+            ADMISSION_WAIT.observe(waited, name)
+            return item
+
+    def stop_worker(self):
+        """Make one get() return None once the queue is empty"""
+        with self.cond:
+            self.stopping += 1
+            self.cond.notify()
+
+    def metrics(self):
+        with self.cond:
+            return {
+                name: {
+                    "queued": len(self.queues[name]),
+                    "admitted": self.admitted[name],
+                    "shed": self.shed[name],
+                    "mean_wait_ms": round(self.wait_seconds[name] / self.admitted[name] * 1000, 3)
+                    if self.admitted[name] else 0.0,
+                    "max_wait_ms": round(self.max_wait[name] * 1000, 3),
+                }
+                for name in ADMISSION_CLASSES
+            }
+
+class ReadRateLimiter:
+    """Per-client token buckets for /api reads.
+
+    Each client (remote address and account) earns ``rate`` tokens a second,
+    up to ``burst``, and every read spends one. Past ``max_clients`` the
+    least recently seen client's bucket is dropped, which only ever
+    forgives it. A ``rate`` of 0 turns the limit off.
+    """
+
+    def __init__(self, rate=READ_RATE, burst=READ_BURST, max_clients=10000):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_clients = max_clients
+        self.buckets = OrderedDict()  # (address, account) -> [tokens, updated_at]
+        self.lock = threading.Lock()
+        self.limited = 0
+
+    def allow(self, address, account_id):
+        """0 if the read may go ahead, otherwise the seconds until it would be"""
+        if self.rate <= 0:
+            return 0
+        key = (address, account_id)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+                if len(self.buckets) > self.max_clients:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            self.limited += 1
+            return (1 - bucket[0]) / self.rate
+
+    def metrics(self):
+        with self.lock:
+            return {"rate": self.rate, "burst": self.burst, "clients": len(self.buckets), "limited": self.limited}
+
+READ_LIMITER = ReadRateLimiter()
 
 # =============================================================================
 # MAIN SERVER
 # =============================================================================
 
-def start_server(port=8000):
+class IdleConnections:
+    """Keep-alive connections between requests, watched by a single thread.
+
+    A parked connection holds no worker. When its next request arrives it is
+    passed to ``on_ready``; one that stays quiet for ``timeout`` seconds is
+    passed to ``on_expired`` instead.
+    """
+
+    def __init__(self, on_ready, on_expired, timeout=KEEPALIVE_TIMEOUT):
+        self.on_ready = on_ready
+        self.on_expired = on_expired
+        self.timeout = timeout
+        self.selector = selectors.DefaultSelector()
+        self.parked = OrderedDict()  # socket -> (client address, parked at), oldest first
+        self.arrivals = queue.SimpleQueue()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="goodcents-keepalive", daemon=True)
+        self.thread.start()
+
+    def park(self, sock, client_address):
+        """Watch a connection for its next request; safe to call from any thread"""
+        self.arrivals.put((sock, client_address))
+        self._wake()
+
+    def _wake(self):
+        try:
+            self.wake_writer.send(b"\0")
+        except OSError:
+            pass  # the wake-up buffer is full, so the selector is about to run anyway
+
+    def __len__(self):
+        return len(self.parked)
+
+    def _run(self):
+        while not self.closed:
+            for key, _ in self.selector.select(timeout=min(1.0, self.timeout)):
+                if key.fileobj is self.wake_reader:
+                    try:
+                        while self.wake_reader.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                self.selector.unregister(key.fileobj)
+                client_address, _ = self.parked.pop(key.fileobj)
+                self.on_ready(key.fileobj, client_address)
+            now = time.monotonic()
+            while not self.arrivals.empty():
+                sock, client_address = self.arrivals.get()
+                try:
+                    self.selector.register(sock, selectors.EVENT_READ)
+                except (ValueError, OSError):
+                    self.on_expired(sock)  # closed while it was being handed over
+                    continue
+                self.parked[sock] = (client_address, now)
+            while self.parked:
+                sock, (client_address, parked_at) = next(iter(self.parked.items()))
+                if now - parked_at < self.timeout:
+                    break
+                del self.parked[sock]
+                self.selector.unregister(sock)
+                self.on_expired(sock)
+
+    def close(self):
+        """Stop watching and close every parked connection"""
+        self.closed = True
+        self._wake()
+        self.thread.join(timeout=2)
+        for sock in list(self.parked):
+            self.on_expired(sock)
+        self.parked.clear()
+        while not self.arrivals.empty():
+            self.on_expired(self.arrivals.get()[0])
+        self.selector.close()
+        self.wake_reader.close()
+        self.wake_writer.close()
+
+class ThreadPoolHTTPServer(socketserver.TCPServer):
+    """TCPServer that hands accepted connections to a bounded pool of worker threads.
+
+    Connections wait in an AdmissionQueue of at most ``queue_size`` entries,
+    served by priority class; once that is full new connections get an
+    immediate 503 instead of piling up behind a slow AI lookup. Between requests, keep-alive connections are parked in
+    an IdleConnections selector so open dashboards don't pin workers.
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, workers=SERVER_WORKERS, queue_size=SERVER_QUEUE_SIZE):
+        super().__init__(server_address, handler_class)
+        self.pending = AdmissionQueue(queue_size, lambda item: self.reject_request(item[0]))
+        self.rejected = 0
+        self.detached = set()
+        self.reusable = set()
+        self.detached_lock = threading.Lock()
+        self.requests_served = {}  # socket -> requests handled on that connection
+        self.connections_accepted = 0
+        self.keepalive_requests = 0
+        self.idle_closed = 0
+        self.idle = IdleConnections(self.resume_request, self.close_idle_request)
+        self.workers = []
+        for i in range(max(1, workers)):
+            worker = threading.Thread(target=self._worker_loop, name=f"goodcents-worker-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        with self.detached_lock:
+            self.connections_accepted += 1
+            self.requests_served[request] = 0
+        try:
+            self.pending.put_nowait((request, client_address))
+        except queue.Full:
+            self.reject_request(request)
+
+    def resume_request(self, request, client_address):
+        """A parked connection has sent its next request; queue it like a new one"""
+        try:
+            self.pending.put_nowait((request, client_address))
+        except queue.Full:
+            self.reject_request(request)
+
+    def close_idle_request(self, request):
+        with self.detached_lock:
+            self.idle_closed += 1
+        self.shutdown_request(request)
+
+    def count_request(self, request):
+        """Number this request is on its connection, starting from 1"""
+        with self.detached_lock:
+            served = self.requests_served.get(request, 0) + 1
+            self.requests_served[request] = served
+            if served > 1:
+                self.keepalive_requests += 1
+        return served
+
+    def keep_alive(self, request):
+        """Park the connection for its next request once the handler returns"""
+        with self.detached_lock:
+            self.reusable.add(request)
+
+    def reject_request(self, request):
+        """Tell the client we are saturated and close the connection"""
+        self.rejected += 1
+        body = json.dumps({"status": "error", "message": "Server busy, please retry"}).encode('utf-8')
+        response = (
+            "HTTP/1.0 503 Service Unavailable\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Retry-After: 1\r\n"
+            "Access-Control-Allow-Origin: *\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode('ascii') + body
+        try:
+            request.sendall(response)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def detach_request(self, request):
+        """Keep the socket open after the handler returns; its new owner closes it"""
+        with self.detached_lock:
+            self.detached.add(request)
+            self.requests_served.pop(request, None)
+
+    def shutdown_request(self, request):
+        with self.detached_lock:
+            self.requests_served.pop(request, None)
+        super().shutdown_request(request)
+
+    def _worker_loop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+                with self.detached_lock:
+                    self.reusable.discard(request)
+            finally:
+                with self.detached_lock:
+                    detached = request in self.detached
+                    reusable = request in self.reusable
+                    self.detached.discard(request)
+                    self.reusable.discard(request)
+                if reusable:
+                    self.idle.park(request, client_address)
+                elif not detached:
+                    self.shutdown_request(request)
+
+    def metrics(self):
+        return {
+            "workers": len(self.workers),
+            "queue_depth": self.pending.qsize(),
+            "queue_limit": self.pending.maxsize,
+            "rejected": self.rejected,
+            "connections_open": len(self.requests_served),
+            "connections_idle": len(self.idle),
+            "connections_accepted": self.connections_accepted,
+            "keepalive_requests": self.keepalive_requests,
+            "idle_closed": self.idle_closed,
+            "admission": self.pending.metrics(),
+        }
+
+    def server_close(self):
+        super().server_close()
+        self.idle.close()
+        for _ in self.workers:
+            self.pending.stop_worker()
+
+# =============================================================================
+# MULTI-PROCESS SERVING
+# =============================================================================
+
+# Headers that describe one hop and are not copied when relaying to the primary
+HOP_BY_HOP_HEADERS = frozenset({
+    "connection", "keep-alive", "proxy-connection", "te", "trailer", "transfer-encoding", "upgrade",
+    "host", "server", "date",
+})
+# Longest a worker waits for the primary; payments can include a Claude call
+PRIMARY_TIMEOUT = 60
+# Crash-looping worker processes are restarted after at most this many seconds
+WORKER_RESTART_MAX_DELAY = 30.0
+
+class LedgerFollower:
+    """Keeps a worker process's ACCOUNTS and TRANSACTIONS in step with the primary's ledger.
+
+    The primary acknowledges a write only once it is fsynced to ledger.wal,
+    and then sets ``committed`` (its Ledger.share_commits() counter) to the
+    write's seq. A worker that calls catch_up() before a read therefore sees
+    every write that has been acknowledged to anyone, and nothing that is
+    only written: records past ``committed`` are left until it moves. While
+    it hasn't moved, catch_up() returns without a lock or a stat. A
+    background thread also catches up every ``interval`` seconds so
+    /api/stream subscribers hear about changes. When the primary snapshots
+    and truncates the log, the follower reloads from the new snapshot.
+    Without ``committed``, every complete record in the log is applied.
+    """
+
+    def __init__(self, ledger=LEDGER, interval=LEDGER_FOLLOW_INTERVAL, committed=None):
+        self.wal_path = ledger.wal_path
+        self.snapshot_path = ledger.snapshot_path
+        self.interval = interval
+        self.committed = committed
+        self.lock = threading.Lock()
+        self.snapshot_id = None
+        self.offset = 0
+        self.seq = 0
+        self.applied = 0
+        self.reloads = 0
+        self.thread = None
+
+    def start(self):
+        TRANSACTIONS.read_only = True
+        self.catch_up()
+        self.thread = threading.Thread(target=self._run, name="goodcents-follower", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.catch_up()
+            except Exception as e:
+                log_event(logging.ERROR, "Ledger follow failed", error=str(e), exc_info=True)
+
+    def _snapshot_id(self):
+        try:
+            stat = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def catch_up(self):
+        """Apply everything the primary has committed since the last call"""
+        committed = self.committed.value if self.committed is not None else None
+        if committed is not None and committed <= self.seq:
+            return
+        with self.lock:
+            snapshot_id = self._snapshot_id()
+            if snapshot_id != self.snapshot_id:
+                self._load_snapshot(snapshot_id, committed)
+            try:
+                size = os.path.getsize(self.wal_path)
+            except FileNotFoundError:
+                size = 0
+            if size < self.offset:
+                self.offset = 0  # truncated; the snapshot check above has the rows it dropped
+            if size > self.offset and not self._read_log(committed) and self._snapshot_id() != self.snapshot_id:
+                # The log moved on past a snapshot taken while we were reading
+                self._load_snapshot(self._snapshot_id(), committed)
+                self._read_log(committed)
+
+    def _load_snapshot(self, snapshot_id, committed=None):
+        if snapshot_id is not None:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            if committed is not None and snapshot["seq"] > committed:
+                # It holds writes still on their way to disk; load it once they are acknowledged
+                return
+            if snapshot["seq"] > self.seq:
+                with ACCOUNTS.all_locked():
+                    TRANSACTIONS.restore_state(snapshot["transactions"])
+                    ACCOUNTS.replace_all(snapshot_accounts(snapshot))
+                self.seq = snapshot["seq"]
+                self.reloads += 1
+        self.snapshot_id = snapshot_id
+        self.offset = 0
+
+    def _read_log(self, committed=None):
+        """Apply the complete records after ``offset`` up to ``committed``; False if they don't follow on from ``seq``"""
+        with open(self.wal_path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        # A record is only complete once its newline is written
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines(keepends=True):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                return False
+            if committed is not None and record["seq"] > committed:
+                break  # written but not yet fsynced or acknowledged
+            if record["seq"] > self.seq + 1:
+                return False
+            if record["seq"] == self.seq + 1:
+                self._apply(record)
+                self.seq = record["seq"]
+                self.applied += 1
+            self.offset += len(line)
+        return True
+
+    def _apply(self, record):
+        """apply_ledger_record, plus the cache invalidation and events the primary did at the time"""
+        account_id = record.get("account_id", DEFAULT_ACCOUNT_ID)
+        kind = record["type"]
+        with ACCOUNTS.locked(account_id) as account, TRANSACTIONS.lock:
+            apply_ledger_record(record)
+            if kind in ("payment", "payment_batch"):
+                account.mark_changed("account", "transactions")
+                transactions = record.get("transactions") or [record["transaction"]]
+                if len(transactions) <= BATCH_EVENT_LIMIT:
+                    for transaction in transactions:
+                        EVENT_BROKER.publish(account_id, "transaction", transaction)
+                    EVENT_BROKER.publish(account_id, "account", account.view())
+                else:
+                    EVENT_BROKER.publish(account_id, "snapshot", state_snapshot(account_id))
+            elif kind == "classification":
+                account.mark_changed("transactions")
+                transaction = TRANSACTIONS.find(record["id"])
+                if transaction is not None:
+                    EVENT_BROKER.publish(account_id, "transaction", transaction)
+            elif kind == "settings":
+                account.mark_changed("settings")
+                EVENT_BROKER.publish(account_id, "settings", account.settings())
+
+    def metrics(self):
+        return {"seq": self.seq, "applied": self.applied, "reloads": self.reloads, "offset": self.offset,
+                "committed_seq": self.committed.value if self.committed is not None else None}
+
+class PrimaryClient:
+    """Relays requests from a worker process to the primary, one kept-alive connection per thread"""
+
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+        self.forwarded = 0
+        self.failed = 0
+
+    def forward(self, method, path, body, headers):
+        """(status, headers, body) from the primary; one retry if a reused connection was closed"""
+        self.forwarded += 1
+        for attempt in range(2):
+            connection = getattr(self.local, "connection", None)
+            reused = connection is not None
+            if connection is None:
+                connection = self.local.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=PRIMARY_TIMEOUT)
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response_body = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                self.local.connection = None
+                # Only a request that never reached the primary is safe to resend
+                if reused and attempt == 0:
+                    continue
+                self.failed += 1
+                raise
+            if response.will_close:
+                connection.close()
+                self.local.connection = None
+            return response.status, response.getheaders(), response_body
+
+    def metrics(self):
+        return {"port": self.port, "forwarded": self.forwarded, "failed": self.failed}
+
+# Set in worker processes only
+FOLLOWER = None
+PRIMARY = None
+
+class ReusePortHTTPServer(ThreadPoolHTTPServer):
+    """A ThreadPoolHTTPServer that shares its port with the other worker processes"""
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+def run_worker_process(port, primary_port, workers, queue_size, started=None, committed=None):
+    """Entry point of one worker process: follow the ledger and serve the shared port.
+
+    ``started`` (a multiprocessing queue) is told this process's pid once it is listening.
+    ``committed`` is the primary's Ledger.share_commits() counter.
+    """
+    global FOLLOWER, PRIMARY
+    configure_logging()
+    PRIMARY = PrimaryClient(primary_port)
+    FOLLOWER = LedgerFollower(committed=committed)
+    FOLLOWER.start()
+    warm_caches()
+    with ReusePortHTTPServer(("", port), BankHandler, workers=workers, queue_size=queue_size) as httpd:
+        register_server_metrics(httpd)
+        # The supervisor passes SIGTERM on, so each worker fails its own /readyz while it drains
+        install_drain_handler(httpd)
+        LIFECYCLE.mark_ready()
+        log_event(logging.INFO, "Worker process serving", pid=os.getpid(), port=port, ledger_seq=FOLLOWER.seq)
+        if started is not None:
+            started.put(os.getpid())
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass  # Ctrl+C reaches the whole process group; the supervisor reports it
+
+class ProcessSupervisor:
+    """Runs the primary in this process and keeps ``processes`` workers serving the public port.
+
+    The primary owns all state and the ledger, and listens only on a private
+    loopback port. Workers share the public port through SO_REUSEPORT, answer
+    reads from their own copy of the state and relay writes to the primary.
+    A worker that exits is restarted, with a growing delay if it keeps
+    crashing. On SIGTERM, drain_workers() passes the signal on and waits for
+    every worker to drain its own writes and exit. ``server_address`` and
+    ``shutdown()`` mirror the single-process server for start_server's
+    ``ready`` callback.
+    """
+
+    def __init__(self, port, processes, workers=SERVER_WORKERS, queue_size=SERVER_QUEUE_SIZE):
+        # Holding the port bound (but not listening) reserves it, and lets port 0 pick one
+        self.placeholder = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.placeholder.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.placeholder.bind(("", port))
+        self.server_address = self.placeholder.getsockname()
+        self.primary = ThreadPoolHTTPServer(("127.0.0.1", 0), BankHandler, workers=workers, queue_size=queue_size)
+        self.processes = max(1, processes)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.context = multiprocessing.get_context("spawn")
+        self.started = self.context.SimpleQueue()
+        self.committed = LEDGER.share_commits(self.context)
+        self.children = {}  # slot -> (process, started at, consecutive quick exits)
+        self.stopping = threading.Event()
+        self.draining = threading.Event()
+        self.restarts = 0
+
+    def _spawn(self, slot, quick_exits=0):
+        process = self.context.Process(
+            target=run_worker_process, name=f"goodcents-http-{slot}", daemon=True,
+            args=(self.server_address[1], self.primary.server_address[1], self.workers, self.queue_size, self.started,
+                  self.committed))
+        process.start()
+        self.children[slot] = (process, time.monotonic(), quick_exits)
+
+    def start(self, timeout=60.0):
+        """Start the primary and every worker, returning once the workers are listening"""
+        threading.Thread(target=self.primary.serve_forever, name="goodcents-primary", daemon=True).start()
+        for slot in range(self.processes):
+            self._spawn(slot)
+        deadline = time.monotonic() + timeout
+        listening = 0
+        while listening < self.processes and time.monotonic() < deadline:
+            processes = [process for process, _, _ in self.children.values()]
+            multiprocessing.connection.wait([self.started._reader] + [p.sentinel for p in processes], timeout=0.5)
+            while not self.started.empty():
+                self.started.get()
+                listening += 1
+            if any(process.exitcode is not None for process in processes):
+                break  # let serve_forever report and restart it
+        return listening
+
+    def serve_forever(self):
+        try:
+            self._supervise()
+        finally:
+            for process, _, _ in self.children.values():
+                process.terminate()
+            for process, _, _ in self.children.values():
+                process.join(timeout=5)
+
+    def _supervise(self):
+        restart_at = {}
+        while not self.stopping.is_set():
+            if self.draining.is_set():
+                # Workers exit on their own once drained; none are restarted
+                self.stopping.wait(0.5)
+                continue
+            while not self.started.empty():
+                self.started.get()  # restarted workers announce themselves too
+            sentinels = {process.sentinel: slot for slot, (process, _, _) in self.children.items()
+                         if slot not in restart_at}
+            ready = multiprocessing.connection.wait(list(sentinels), timeout=0.5)
+            now = time.monotonic()
+            for sentinel in ready:
+                slot = sentinels[sentinel]
+                process, started_at, quick_exits = self.children[slot]
+                process.join()
+                quick_exits = quick_exits + 1 if now - started_at < 5 else 0
+                delay = min(WORKER_RESTART_MAX_DELAY, 0.5 * (2 ** quick_exits) if quick_exits else 0)
+                log_event(logging.ERROR, "Worker process exited", slot=slot, pid=process.pid,
+                          exitcode=process.exitcode, restart_in=delay)
+                restart_at[slot] = (now + delay, quick_exits)
+            for slot, (due, quick_exits) in list(restart_at.items()):
+                if now >= due and not self.stopping.is_set():
+                    del restart_at[slot]
+                    self.restarts += 1
+                    self._spawn(slot, quick_exits)
+
+    def drain_workers(self, timeout=DRAIN_TIMEOUT):
+        """Send every worker SIGTERM and wait for them to drain and exit; True if they all did in time"""
+        self.draining.set()
+        processes = [process for process, _, _ in self.children.values() if process.is_alive()]
+        for process in processes:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(process.pid, signal.SIGTERM)
+        # A worker's own drain is bounded by the same timeout; allow it time to exit after that
+        deadline = time.monotonic() + timeout + 5
+        for process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+        return not any(process.is_alive() for process in processes)
+
+    def shutdown(self):
+        self.stopping.set()
+        self.primary.shutdown()
+
+    def metrics(self):
+        return {
+            "processes": self.processes,
+            "alive": sum(process.is_alive() for process, _, _ in self.children.values()),
+            "restarts": self.restarts,
+            "pids": [process.pid for process, _, _ in self.children.values()],
+        }
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopping.set()
+        self.primary.server_close()
+        self.placeholder.close()
+
+def register_server_metrics(httpd):
+    """Gauges for one ThreadPoolHTTPServer's queue and connections"""
+    METRICS.gauge("goodcents_server_queue_depth", "Accepted connections waiting for a worker",
+                  lambda: httpd.pending.qsize())
+    METRICS.gauge("goodcents_server_rejected_total", "Connections turned away with 503 because the queue was full",
+                  lambda: httpd.rejected, kind="counter")
+    METRICS.gauge("goodcents_server_connections_open", "Client connections open, busy or idle",
+                  lambda: len(httpd.requests_served))
+    METRICS.gauge("goodcents_server_connections_idle", "Keep-alive connections waiting for their next request",
+                  lambda: len(httpd.idle))
+    METRICS.gauge("goodcents_server_connections_accepted_total", "Client connections accepted",
+                  lambda: httpd.connections_accepted, kind="counter")
+    METRICS.gauge("goodcents_server_keepalive_requests_total", "Requests that arrived on an already open connection",
+                  lambda: httpd.keepalive_requests, kind="counter")
+
+# =============================================================================
+# LIFECYCLE
+# =============================================================================
+
+class Lifecycle:
+    """Readiness for /readyz, and draining of in-flight writes on SIGTERM.
+
+    The server is ready once it is listening with its caches warm. Draining
+    makes /readyz fail so load balancers stop sending traffic, turns new
+    writes away with 503 (payments carry Idempotency-Key, so clients can
+    safely retry elsewhere) and waits for the writes already running.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.ready_at = None
+        self.draining = False
+        self.in_flight = 0
+        self.refused = 0
+
+    @property
+    def ready(self):
+        return self.ready_at is not None and not self.draining
+
+    @property
+    def startup_seconds(self):
+        """Seconds from the first import to ready"""
+        return round(self.ready_at - LAUNCHED_AT, 4) if self.ready_at is not None else None
+
+    def mark_ready(self):
+        with self.cond:
+            self.ready_at = time.monotonic()
+        log_event(logging.INFO, "Server ready", startup_ms=round(self.startup_seconds * 1000, 1))
+
+    @contextlib.contextmanager
+    def write(self):
+        """``with LIFECYCLE.write() as admitted:`` - a write counted as in flight, or refused while draining"""
+        with self.cond:
+            admitted = not self.draining
+            if admitted:
+                self.in_flight += 1
+            else:
+                self.refused += 1
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                with self.cond:
+                    self.in_flight -= 1
+                    if not self.in_flight:
+                        self.cond.notify_all()
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Stop admitting writes and wait for running ones; True if they all finished in time"""
+        with self.cond:
+            self.draining = True
+            return self.cond.wait_for(lambda: not self.in_flight, timeout)
+
+    def readiness(self):
+        status = "draining" if self.draining else "ready" if self.ready_at is not None else "starting"
+        return {"status": status, "startup_seconds": self.startup_seconds}
+
+    def metrics(self):
+        with self.cond:
+            return {
+                **self.readiness(),
+                "headless": HEADLESS,
+                "writes_in_flight": self.in_flight,
+                "writes_refused": self.refused,
+            }
+
+LIFECYCLE = Lifecycle()
+
+def warm_caches():
+    """Build what the first requests would otherwise build: the keyword matcher, pages and charities JSON"""
+    get_keyword_matcher()
+    for filename in set(STATIC_PAGES.values()):
+        if os.path.exists(filename):
+            STATIC_ASSETS.file(filename)
+    RESPONSE_CACHE.get("charities", None, lambda _: {"charities": CHARITIES})
+
+def warm_claude_client():
+    """Import the SDK and build the Claude client off the request path, once the server is ready"""
+    if ai_available():
+        threading.Thread(target=get_anthropic_client, name="goodcents-ai-warmup", daemon=True).start()
+
+def install_drain_handler(httpd):
+    """On SIGTERM, drain in-flight writes and then stop ``httpd`` (main thread only)"""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    
+    def drain_and_stop():
+        log_event(logging.INFO, "SIGTERM received, draining", writes_in_flight=LIFECYCLE.in_flight)
+        if isinstance(httpd, ProcessSupervisor):
+            # Workers first: they stop taking traffic and still pass their last writes here
+            workers_drained = httpd.drain_workers()
+            log_event(logging.INFO if workers_drained else logging.WARNING, "Workers drained",
+                      drained=workers_drained)
+        drained = LIFECYCLE.drain()
+        log_event(logging.INFO if drained else logging.WARNING, "Drain finished", drained=drained,
+                  writes_in_flight=LIFECYCLE.in_flight)
+        httpd.shutdown()
+    
+    # serve_forever runs on this thread, so the wait and shutdown() happen on another
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(
+        target=drain_and_stop, name="goodcents-drain", daemon=True).start())
+
+def start_ledger():
+    """Replay the ledger into memory and start logging; no-op when GOODCENTS_LEDGER=0"""
+    if not LEDGER_ENABLED or LEDGER.active:
+        return
+    recovery = LEDGER.recover()
+    LEDGER.start()
+    atexit.register(LEDGER.close)
+    log_event(logging.INFO, "Ledger recovered", records_replayed=recovery["records_replayed"],
+              snapshot_seq=recovery["snapshot_seq"], milliseconds=round(recovery["seconds"] * 1000, 1))
+
+def start_server(port=8000, workers=SERVER_WORKERS, queue_size=SERVER_QUEUE_SIZE, open_browser=True, ready=None,
+                 processes=SERVER_PROCESSES, headless=HEADLESS):
+    """Serve until interrupted, shut down or drained by SIGTERM.
+
+    ``port`` 0 picks a free port. ``ready``, if given, is called with the
+    listening server just before it starts serving, so a caller running
+    this in a thread can read the port and later call ``shutdown()``.
+    With ``processes`` above 1, that many worker processes serve the port
+    and this process supervises them (see ProcessSupervisor). ``headless``
+    skips the banner and the browser.
+    """
+    configure_logging()
+    start_ledger()
+    warm_caches()
+    if processes > 1 and not LEDGER.active:
+        log_event(logging.WARNING, "Worker processes follow the ledger, which is disabled; serving from one process",
+                  processes=processes)
+        processes = 1
+    if processes > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        log_event(logging.WARNING, "SO_REUSEPORT is not available here; serving from one process", processes=processes)
+        processes = 1
     try:
-        with socketserver.TCPServer(("", port), BankHandler) as httpd:
+        if processes > 1:
+            server = ProcessSupervisor(port, processes, workers=workers, queue_size=queue_size)
+        else:
+            server = ThreadPoolHTTPServer(("", port), BankHandler, workers=workers, queue_size=queue_size)
+        with server as httpd:
+            port = httpd.server_address[1]
+            register_server_metrics(httpd.primary if processes > 1 else httpd)
+            install_drain_handler(httpd)
+            LIFECYCLE.mark_ready()
+            warm_claude_client()
+            if ready is not None:
+                ready(httpd)
+            if headless:
+                log_event(logging.INFO, "Serving headless", port=port, workers=workers, processes=processes)
+                httpd.serve_forever()
+                return
             ai_status = "Claude AI Ready" if (CLAUDE_API_KEY and ANTHROPIC_AVAILABLE) else "⚠️ No AI (add API key)"
             
             print(f"""
@@ -558,6 +5167,7 @@ GoodCents Banking Demo Server
 
 ✅ Server running at: http://localhost:{port}
 {ai_status}
+⚙️  Workers: {workers} (queue limit {queue_size}) × {processes} process{"es" if processes > 1 else ""}
 
 📱 Quick Links:
    • Demo Overview: http://localhost:{port}/demo
@@ -583,12 +5193,10 @@ GoodCents Banking Demo Server
 Press Ctrl+C to stop.
             """)
             
-            # Try to open browser
-            try:
-                time.sleep(1)
-                webbrowser.open(f'http://localhost:{port}/demo')
-            except:
-                pass
+            # Open the browser from another thread so it never holds up serving
+            if open_browser:
+                threading.Thread(target=webbrowser.open, args=(f'http://localhost:{port}/demo',),
+                                 name="goodcents-browser", daemon=True).start()
             
             httpd.serve_forever()
             
@@ -602,10 +5210,16 @@ Press Ctrl+C to stop.
         print("\nServer stopped")
 
 if __name__ == "__main__":
-    import sys
+    configure_logging()
+    if len(sys.argv) > 1 and sys.argv[1] == "classifier":
+        sys.exit(classifier_command(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "impact":
+        sys.exit(impact_command(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "reclassify":
+        sys.exit(reclassify_command(sys.argv[2:]))
     
     # Check for API key
-    if not CLAUDE_API_KEY:
+    if not CLAUDE_API_KEY and not HEADLESS:
         print("""
 ⚠️  Claude API Key Not Set
 ========================
@@ -0,0 +1,1708 @@
+"""Unit tests for good_cents_server: `python -m unittest` from this directory"""
+
+import contextlib
+import decimal
+import gzip
+import http.client
+import io
+import json
+import logging
+import math
+import os
+import queue
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+# The server reads its configuration at import, so anything written under
+# the default data directory goes to a scratch directory, not goodcents_data
+_TEST_DATA_DIR = tempfile.mkdtemp(prefix="goodcents-test-")
+os.environ["GOODCENTS_DATA_DIR"] = _TEST_DATA_DIR
+
+import good_cents_server as server
+
+
+def setUpModule():
+    # The server logs every payment and breaker transition; keep the test
+    # output to unittest's
+    server.LOG.setLevel(logging.CRITICAL)
+
+
+def tearDownModule():
+    shutil.rmtree(_TEST_DATA_DIR, ignore_errors=True)
+
+
+class FakeClock:
+    """Stands in for time.monotonic(); tests move it with advance()"""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class InlineThread:
+    """Runs the target on start(), so the breaker's probe finishes before allow() returns"""
+
+    def __init__(self, target, name=None, daemon=None):
+        self.target = target
+
+    def start(self):
+        self.target()
+
+
+class APIError(Exception):
+    """An SDK-style error carrying an HTTP status"""
+
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class StubMessages:
+    """messages.create that raises or returns the scripted outcomes in order"""
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def create(self, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class StubClient:
+    def __init__(self, *outcomes):
+        self.messages = StubMessages(outcomes)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.probe_error = None
+        self.probes = 0
+        patches = [
+            mock.patch.object(server.time, "monotonic", self.clock),
+            mock.patch.object(server.threading, "Thread", InlineThread),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.breaker = server.CircuitBreaker(threshold=3, reset_timeout=30, probe=self.probe)
+
+    def probe(self):
+        self.probes += 1
+        if self.probe_error is not None:
+            raise self.probe_error
+
+    def open_breaker(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+
+    def test_opens_after_threshold_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.metrics()["state"], "open")
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.metrics()["times_opened"], 1)
+        self.assertEqual(self.breaker.metrics()["short_circuited"], 1)
+
+    def test_success_resets_the_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.metrics()["state"], "closed")
+        self.assertTrue(self.breaker.allow())
+
+    def test_no_probe_before_reset_timeout(self):
+        self.open_breaker()
+        self.clock.advance(29.9)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.probes, 0)
+
+    def test_successful_probe_closes_the_breaker(self):
+        self.open_breaker()
+        self.clock.advance(30)
+        # The call that starts the probe is still refused
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.probes, 1)
+        self.assertEqual(self.breaker.metrics()["state"], "closed")
+        self.assertEqual(self.breaker.metrics()["consecutive_failures"], 0)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_keeps_it_open_for_another_timeout(self):
+        self.open_breaker()
+        self.probe_error = APIError(529)
+        self.clock.advance(30)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.probes, 1)
+        self.assertEqual(self.breaker.metrics()["state"], "open")
+
+        self.clock.advance(29)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.probes, 1)
+
+        self.probe_error = None
+        self.clock.advance(1)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.probes, 2)
+        self.assertTrue(self.breaker.allow())
+
+    def test_without_a_probe_it_stays_open(self):
+        breaker = server.CircuitBreaker(threshold=1, reset_timeout=30)
+        breaker.record_failure()
+        self.clock.advance(60)
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.metrics()["state"], "open")
+
+
+@unittest.skipUnless(server.ANTHROPIC_AVAILABLE, "the anthropic SDK is not installed")
+class CallClaudeRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.breaker = server.CircuitBreaker(threshold=2, reset_timeout=30)
+        patches = [
+            mock.patch.object(server, "AI_MAX_RETRIES", 2),
+            mock.patch.object(server, "AI_RETRY_BACKOFF", 0.25),
+            mock.patch.object(server, "AI_BREAKER", self.breaker),
+            mock.patch.object(server, "AI_CALL_STATS", {"calls": 0, "retries": 0, "failures": 0}),
+            mock.patch.object(server.time, "sleep", self.sleeps.append),
+            # The top of each jitter range, so the backoff is visible
+            mock.patch.object(server.random, "uniform", lambda low, high: high),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def use_client(self, client):
+        patch = mock.patch.object(server, "_anthropic_client", client)
+        patch.start()
+        self.addCleanup(patch.stop)
+        return client
+
+    def test_retries_retryable_errors_with_backoff(self):
+        client = self.use_client(StubClient(APIError(529), APIError(503), "message"))
+        self.assertEqual(server.call_claude(max_tokens=1, messages=[]), "message")
+        self.assertEqual(client.messages.calls, 3)
+        self.assertEqual(self.sleeps, [0.25, 0.5])
+        self.assertEqual(server.AI_CALL_STATS, {"calls": 3, "retries": 2, "failures": 0})
+        self.assertEqual(self.breaker.metrics()["consecutive_failures"], 0)
+
+    def test_gives_up_after_max_retries(self):
+        client = self.use_client(StubClient(APIError(500), APIError(500), APIError(500)))
+        with self.assertRaises(APIError):
+            server.call_claude(max_tokens=1, messages=[])
+        self.assertEqual(client.messages.calls, 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertEqual(server.AI_CALL_STATS["failures"], 1)
+        # One failed call counts once towards the breaker, not once per attempt
+        self.assertEqual(self.breaker.metrics()["consecutive_failures"], 1)
+
+    def test_does_not_retry_client_errors(self):
+        client = self.use_client(StubClient(APIError(400)))
+        with self.assertRaises(APIError):
+            server.call_claude(max_tokens=1, messages=[])
+        self.assertEqual(client.messages.calls, 1)
+        self.assertEqual(self.sleeps, [])
+
+    def test_failed_calls_open_the_breaker(self):
+        self.use_client(StubClient(APIError(400), APIError(400)))
+        for _ in range(2):
+            with self.assertRaises(APIError):
+                server.call_claude(max_tokens=1, messages=[])
+        self.assertEqual(self.breaker.metrics()["state"], "open")
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_closes_an_open_breaker(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.use_client(StubClient("message"))
+        server.call_claude(max_tokens=1, messages=[])
+        self.assertEqual(self.breaker.metrics()["state"], "closed")
+
+
+class ClaudeBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = server.CircuitBreaker(threshold=1, reset_timeout=30)
+        self.allow = mock.patch.object(self.breaker, "allow", wraps=self.breaker.allow).start()
+        self.charity = next(iter(server.CHARITIES))
+        self.prompts = []
+        self.release = threading.Event()
+        self.release.set()
+        patches = [
+            mock.patch.object(server, "AI_BREAKER", self.breaker),
+            mock.patch.object(server, "call_claude", self.call_claude),
+        ]
+        for patch in patches:
+            patch.start()
+        self.addCleanup(mock.patch.stopall)
+
+    def call_claude(self, **kwargs):
+        prompt = kwargs["messages"][0]["content"]
+        self.prompts.append(prompt)
+        self.release.wait(10)
+        if "these purchases" in prompt:
+            answer = [{"id": i, "charity": self.charity, "confidence": 90} for i in range(1, prompt.count(" for £") + 1)]
+        else:
+            answer = {"charity": self.charity, "confidence": 90}
+        return types.SimpleNamespace(content=[types.SimpleNamespace(text=json.dumps(answer))])
+
+    def test_idle_lookup_does_not_wait_for_the_window(self):
+        batcher = server.ClaudeBatcher(window=5, max_size=16, workers=2)
+        started = time.monotonic()
+        self.assertEqual(batcher.request("Tesco", 4.33)[0], self.charity)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(len(self.prompts), 1)
+
+    def test_lookups_while_a_call_is_out_share_one_request_and_one_breaker_check(self):
+        batcher = server.ClaudeBatcher(window=0.3, max_size=16, workers=4)
+        self.release.clear()
+        results = {}
+
+        def lookup(merchant_name):
+            results[merchant_name] = batcher.request(merchant_name, 1.0)
+
+        threads = [threading.Thread(target=lookup, args=(name,)) for name in ("Shop A", "Shop B", "Shop C", "Shop D")]
+        threads[0].start()
+        deadline = time.monotonic() + 5
+        while not self.prompts and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for thread in threads[1:]:
+            thread.start()
+        self.release.set()
+        for thread in threads:
+            thread.join(timeout=10)
+
+        self.assertEqual(len(self.prompts), 2)
+        self.assertEqual(self.prompts[1].count(" for £"), 3)
+        self.assertEqual({decision[0] for decision in results.values()}, {self.charity})
+        self.assertEqual(len(results), 4)
+        self.assertEqual(self.allow.call_count, 2)
+
+    def test_open_breaker_short_circuits_once(self):
+        batcher = server.ClaudeBatcher(window=5, max_size=16, workers=2)
+        self.breaker.record_failure()
+        with self.assertRaises(server.CircuitOpenError):
+            batcher.request("Tesco", 4.33)
+        self.assertEqual(self.breaker.metrics()["short_circuited"], 1)
+        self.assertEqual(self.prompts, [])
+
+
+class MoneyTest(unittest.TestCase):
+    def test_parses_numbers_and_strings(self):
+        self.assertEqual(server.to_pence(4), 400)
+        self.assertEqual(server.to_pence(4.33), 433)
+        self.assertEqual(server.to_pence("4.33"), 433)
+        self.assertEqual(server.to_pence("0.01"), 1)
+        self.assertEqual(server.to_pence("0"), 0)
+
+    def test_strips_whitespace(self):
+        self.assertEqual(server.to_pence("  12.50 "), 1250)
+        self.assertEqual(server.to_pence("\t3.2\n"), 320)
+
+    def test_half_pennies_round_away_from_zero(self):
+        self.assertEqual(server.to_pence("4.335"), 434)
+        self.assertEqual(server.to_pence("4.3349"), 433)
+        self.assertEqual(server.to_pence("0.005"), 1)
+        self.assertEqual(server.to_pence("0.004"), 0)
+        self.assertEqual(server.to_pence("-4.335"), -434)
+
+    def test_float_is_read_as_written_not_as_binary(self):
+        # 1.005 is stored as 1.00499999999999989..., but was typed as 1.005
+        self.assertEqual(server.to_pence(1.005), 101)
+        self.assertEqual(server.to_pence(0.1 + 0.2), 30)
+
+    def test_negatives_parse_but_payments_refuse_them(self):
+        self.assertEqual(server.to_pence(-5), -500)
+        self.assertEqual(server.to_pence("-0.01"), -1)
+        for amount in (-5, "-0.01", 0, "0.004"):
+            with self.subTest(amount=amount), self.assertRaisesRegex(ValueError, "positive"):
+                server.process_payment(server.DEFAULT_ACCOUNT_ID, {"merchant": "Tesco", "amount": amount})
+
+    def test_rejects_non_finite_and_non_numbers(self):
+        for value in ("nan", "NaN", "sNaN", "inf", "-Infinity", float("nan"), float("inf"),
+                      "", "   ", "abc", "£4.33", "4,33", None, True, [4]):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                server.to_pence(value)
+
+    def test_huge_amounts(self):
+        self.assertEqual(server.to_pence(10 ** 30), 10 ** 32)
+        self.assertEqual(server.to_pence("1e20"), 10 ** 22)
+        for value in ("1e30", 1e30, "1e100", "-1e30", "123456789012345678901234567.89"):
+            with self.subTest(value=value), self.assertRaisesRegex(ValueError, "out of range"):
+                server.to_pence(value)
+
+    def test_pounds_round_trip(self):
+        for pence in [*range(0, 100001, 7), 999999999, 10 ** 15 + 1, -1, -4335]:
+            with self.subTest(pence=pence):
+                self.assertEqual(server.to_pence(server.to_pounds(pence)), pence)
+        self.assertEqual(server.to_pounds(433), 4.33)
+        self.assertEqual(server.to_pounds(0), 0)
+
+    def test_sums_are_exact(self):
+        self.assertNotEqual(sum([0.1] * 10), 1.0)
+        self.assertEqual(sum(server.to_pence("0.10") for _ in range(10)), server.to_pence("1.00"))
+        amounts = [server.to_pence(value) for value in ("4.33", "0.99", "12.01", "7")]
+        self.assertEqual(sum(amounts), 2433)
+        self.assertEqual(server.to_pounds(sum(amounts)), 24.33)
+
+    def test_roundups(self):
+        self.assertEqual(server.calculate_roundup(server.to_pence("4.33"), 100), 67)
+        self.assertEqual(server.calculate_roundup(server.to_pence("4.33"), 25), 17)
+        self.assertEqual(server.calculate_roundup(server.to_pence("4.00"), 100), 0)
+        amounts = [433, 400, 1, 99, 12501]
+        self.assertEqual(server.batch_roundups(amounts, 100), [server.calculate_roundup(a, 100) for a in amounts])
+        capped = server.cap_roundups([67, 50, 99, 30], donated=900, cap=1000)
+        self.assertEqual(capped, [67, 33, 0, 0])
+        self.assertEqual(900 + sum(capped), 1000)
+
+
+class MoneyPropertyTest(unittest.TestCase):
+    """Randomized checks across the pence range; the seed is fixed so a failure reproduces"""
+
+    samples = 2000
+
+    def setUp(self):
+        self.random = random.Random(13)
+
+    def random_pence(self, limit=10 ** 15):
+        # Spread over every order of magnitude, not just the large ones
+        return self.random.randrange(-limit, limit) // 10 ** self.random.randrange(16)
+
+    def test_decimal_strings_round_trip(self):
+        for _ in range(self.samples):
+            pence = self.random_pence()
+            text = str(decimal.Decimal(pence).scaleb(-2))
+            with self.subTest(text=text):
+                self.assertEqual(server.to_pence(text), pence)
+                self.assertEqual(server.to_pence(f" {text}000 "), pence)
+
+    def test_half_pennies_round_up_at_every_boundary(self):
+        for _ in range(self.samples // 100):
+            pounds = abs(self.random_pence()) // 100 * 100
+            for pence in (pounds + cents for cents in range(100)):
+                for sign in ("", "-"):
+                    text = sign + str(decimal.Decimal(pence).scaleb(-2))
+                    with self.subTest(text=text):
+                        # Half a penny rounds away from zero; anything less rounds back
+                        self.assertEqual(server.to_pence(text + "5"), int(f"{sign}{pence + 1}"))
+                        self.assertEqual(server.to_pence(text + "4999"), int(f"{sign}{pence}"))
+
+    def test_batch_roundups_match_per_item_roundups(self):
+        for _ in range(self.samples // 10):
+            step = self.random.choice((25, 100))
+            amounts = [self.random.randrange(1, 10 ** self.random.randrange(1, 8))
+                       for _ in range(self.random.randrange(1, 50))]
+            singles = [server.calculate_roundup(amount, step) for amount in amounts]
+            roundups = server.batch_roundups(amounts, step)
+            self.assertEqual(roundups, singles)
+            self.assertEqual(sum(roundups), sum(singles))
+            self.assertTrue(all(0 <= roundup < step for roundup in roundups))
+            self.assertTrue(all((amount + roundup) % step == 0 for amount, roundup in zip(amounts, roundups)))
+
+            donated = self.random.randrange(0, 1200)
+            capped = server.cap_roundups(roundups, donated, cap=1000)
+            total = donated
+            for roundup, kept in zip(roundups, capped):
+                # What capping one payment at a time would keep
+                self.assertEqual(kept, max(0, min(roundup, 1000 - total)))
+                total += kept
+
+
+class KeywordMatcherTest(unittest.TestCase):
+    charities = {
+        "Teach First": {"keywords": ["book", "school"], "focus": ["education"]},
+        "FareShare": {"keywords": ["food", "grocer", "cafe"], "focus": ["hunger"]},
+        "Mind": {"keywords": ["gym", "sport", "cafe"], "focus": ["mental health"]},
+        "Shelter": {"keywords": ["home", "homeware", "port"], "focus": ["housing"]},
+    }
+
+    def setUp(self):
+        self.matcher = server.KeywordMatcher(self.charities)
+
+    def matched(self, merchant_name):
+        return self.matcher.scores(merchant_name)[1]
+
+    def test_overlapping_terms_all_count(self):
+        scores, matched = self.matcher.scores("Homeware Hub")
+        self.assertEqual(sorted(matched), ["home", "homeware"])
+        self.assertEqual(scores[3], 2 * server.KEYWORD_WEIGHT)
+        self.assertEqual(sorted(self.matched("Food & Grocer")), ["food", "grocer"])
+
+    def test_terms_inside_other_words_do_not_match(self):
+        # "port" sits inside "Sportswear" but does not start a word
+        self.assertEqual(self.matched("Sportswear"), ["sport"])
+        # Terms of three letters or fewer must be whole words
+        self.assertEqual(self.matched("Gymnasium Supplies"), [])
+        self.assertEqual(self.matched("The Gym Group"), ["gym"])
+
+    def test_case_and_punctuation_are_normalised(self):
+        for merchant_name in ("FOOD HALL", "food hall", "Tesco's Food!", "food-hall", "(food)", "Food_Hall"):
+            with self.subTest(merchant_name=merchant_name):
+                self.assertEqual(self.matched(merchant_name), ["food"])
+                self.assertEqual(self.matcher.classify(merchant_name)[0], "FareShare")
+        # A lowercase-to-uppercase step is a word boundary too
+        self.assertEqual(self.matched("PureGym"), ["gym"])
+        self.assertEqual(self.matched("Puregym"), [])
+
+    def test_repeated_terms_count_once(self):
+        self.assertEqual(self.matcher.classify("Food Food Food"), self.matcher.classify("Food"))
+
+    def test_shared_term_is_split_and_ties_go_to_the_first_charity(self):
+        scores, _ = self.matcher.scores("Cafe")
+        self.assertEqual((scores[1], scores[2]), (0.5, 0.5))
+        charity, confidence, _ = self.matcher.classify("Cafe")
+        self.assertEqual(charity, "FareShare")
+        self.assertEqual(confidence, round(50 + 49 * 0.5 * (1 - math.exp(-0.5))))
+        reordered = server.KeywordMatcher({name: self.charities[name] for name in ("Mind", "FareShare")})
+        self.assertEqual(reordered.classify("Cafe")[0], "Mind")
+
+    def test_more_evidence_means_more_confidence(self):
+        one = self.matcher.classify("Grocer")[1]
+        two = self.matcher.classify("Food Grocer")[1]
+        mixed = self.matcher.classify("Food Gym")[1]
+        self.assertLess(one, two)
+        self.assertLess(mixed, one)
+        self.assertLessEqual(two, 99)
+
+    def test_no_match_falls_back_with_confidence_50(self):
+        self.assertEqual(self.matcher.classify("Zzqx Ltd"),
+                         ("Teach First", 50, "No keyword match - general education support"))
+        without_default = server.KeywordMatcher({name: self.charities[name] for name in ("Mind", "Shelter")})
+        self.assertEqual(without_default.classify("Zzqx Ltd")[:2], ("Mind", 50))
+        self.assertEqual(server.KeywordMatcher({}).classify("Zzqx Ltd")[:2], (None, 50))
+        self.assertEqual(self.matcher.classify("")[:2], ("Teach First", 50))
+
+
+class DecisionCacheTest(unittest.TestCase):
+    decision = ("FareShare", 90, "Supermarket")
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patch = mock.patch.object(server.time, "time", self.clock)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.cache = server.DecisionCache(max_size=2, ttl=60, path=None)
+
+    def test_hit_until_the_ttl_passes(self):
+        self.cache.put("tesco", "v1", self.decision)
+        self.clock.advance(59.9)
+        self.assertEqual(self.cache.get("tesco", "v1"), self.decision)
+        self.clock.advance(0.1)
+        self.assertIsNone(self.cache.get("tesco", "v1"))
+        self.assertEqual(self.cache.metrics()["expirations"], 1)
+        self.assertEqual((self.cache.metrics()["hits"], self.cache.metrics()["misses"]), (1, 1))
+
+    def test_catalogue_version_change_is_a_miss(self):
+        self.cache.put("tesco", "v1", self.decision)
+        self.assertIsNone(self.cache.get("tesco", "v2"))
+        # The stale entry is dropped, not kept for the old version
+        self.assertIsNone(self.cache.get("tesco", "v1"))
+        self.assertEqual(self.cache.metrics()["size"], 0)
+
+    def test_editing_the_catalogue_invalidates_cached_decisions(self):
+        with mock.patch.object(server, "DECISION_CACHE", self.cache), \
+                mock.patch.object(server, "LOCAL_CLASSIFIER", server.LocalClassifier(path=None)):
+            self.cache.put("tesco", server.charities_version(), self.decision)
+            self.assertEqual(server.known_charity_decision("TESCO"), (self.decision, "cache"))
+            edited = {**server.CHARITIES, "New Charity": {"description": "", "keywords": []}}
+            with mock.patch.object(server, "CHARITIES", edited), \
+                    mock.patch.dict(server._charities_version, {"value": None, "checked_at": 0.0}):
+                self.assertEqual(server.known_charity_decision("TESCO"), (None, None))
+
+    def test_least_recently_used_merchant_is_evicted(self):
+        self.cache.put("tesco", "v1", self.decision)
+        self.cache.put("boots", "v1", self.decision)
+        self.cache.get("tesco", "v1")
+        self.cache.put("greggs", "v1", self.decision)
+        self.assertIsNone(self.cache.peek("boots", "v1"))
+        self.assertEqual(self.cache.peek("tesco", "v1"), self.decision)
+        self.assertEqual(self.cache.peek("greggs", "v1"), self.decision)
+        self.assertEqual(self.cache.metrics()["evictions"], 1)
+
+    def test_saved_entries_load_with_their_original_age(self):
+        directory = tempfile.mkdtemp(prefix="goodcents-test-", dir=_TEST_DATA_DIR)
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, "decisions.json")
+        cache = server.DecisionCache(max_size=10, ttl=60, path=path)
+        cache.put("tesco", "v1", self.decision)
+        self.clock.advance(30)
+        cache.put("boots", "v1", self.decision)
+        cache.save()
+
+        self.clock.advance(45)
+        loaded = server.DecisionCache(max_size=10, ttl=60, path=path)
+        self.assertEqual(loaded.load(), 1)
+        self.assertIsNone(loaded.peek("tesco", "v1"))
+        self.assertEqual(loaded.peek("boots", "v1"), self.decision)
+
+
+class SingleFlightTest(unittest.TestCase):
+    callers = 8
+
+    def setUp(self):
+        self.single_flight = server.SingleFlight()
+        self.release = threading.Event()
+        self.upstream_calls = 0
+
+    def wait_for_waiters(self, key, count):
+        deadline = time.monotonic() + 5
+        while self.single_flight.metrics()["waiters"].get(key, 0) < count:
+            self.assertLess(time.monotonic(), deadline, "callers never joined the call in flight")
+            time.sleep(0.005)
+
+    def run_callers(self, key, fn):
+        """Results (or exceptions) of ``callers`` threads asking for ``key`` at once"""
+        outcomes = [None] * self.callers
+
+        def call(index):
+            try:
+                outcomes[index] = self.single_flight.do(key, fn)
+            except Exception as e:
+                outcomes[index] = e
+
+        threads = [threading.Thread(target=call, args=(index,)) for index in range(self.callers)]
+        for thread in threads:
+            thread.start()
+        self.wait_for_waiters(key, self.callers - 1)
+        self.release.set()
+        for thread in threads:
+            thread.join(timeout=10)
+        return outcomes
+
+    def upstream(self, result=None, error=None):
+        def fn():
+            self.upstream_calls += 1
+            self.release.wait(10)
+            if error is not None:
+                raise error
+            return result
+        return fn
+
+    def test_concurrent_callers_share_one_call(self):
+        decision = ("FareShare", 90, "Supermarket")
+        self.assertEqual(self.run_callers("tesco", self.upstream(decision)), [decision] * self.callers)
+        self.assertEqual(self.upstream_calls, 1)
+        metrics = self.single_flight.metrics()
+        self.assertEqual((metrics["leader_calls"], metrics["coalesced_calls"]), (1, self.callers - 1))
+        self.assertEqual(metrics["in_flight"], 0)
+
+    def test_every_caller_gets_the_exception(self):
+        error = server.CircuitOpenError("open")
+        outcomes = self.run_callers("tesco", self.upstream(error=error))
+        self.assertTrue(all(outcome is error for outcome in outcomes))
+        self.assertEqual(self.upstream_calls, 1)
+        # Nothing is remembered: the next caller runs the function again
+        self.assertEqual(self.single_flight.do("tesco", lambda: "again"), "again")
+
+    def test_different_keys_do_not_wait_for_each_other(self):
+        self.release.set()
+        self.assertEqual(self.single_flight.do("tesco", self.upstream("a")), "a")
+        self.assertEqual(self.single_flight.do("boots", self.upstream("b")), "b")
+        self.assertEqual(self.upstream_calls, 2)
+
+    def test_spellings_of_one_merchant_make_one_claude_call(self):
+        decision = ("FareShare", 90, "Supermarket")
+        batcher = mock.Mock()
+        batcher.request.side_effect = lambda merchant_name, amount: self.upstream(decision)()
+        patches = [
+            mock.patch.object(server, "AI_SINGLE_FLIGHT", self.single_flight),
+            mock.patch.object(server, "AI_BATCHER", batcher),
+            mock.patch.object(server, "DECISION_CACHE", server.DecisionCache(path=None)),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        spellings = ["Tesco", "TESCO", "tesco ", "Tesco!"]
+        outcomes = [None] * len(spellings)
+
+        def fetch(index):
+            outcomes[index] = server.fetch_claude_charity(spellings[index], 4.33)
+
+        threads = [threading.Thread(target=fetch, args=(index,)) for index in range(len(spellings))]
+        for thread in threads:
+            thread.start()
+        self.wait_for_waiters("tesco", len(spellings) - 1)
+        self.release.set()
+        for thread in threads:
+            thread.join(timeout=10)
+        self.assertEqual(outcomes, [decision] * len(spellings))
+        self.assertEqual(batcher.request.call_count, 1)
+        self.assertEqual(server.DECISION_CACHE.peek("tesco", server.charities_version()), decision)
+
+
+# =============================================================================
+# SERVER STATE
+# =============================================================================
+
+class ServerStateTest(unittest.TestCase):
+    """Each test gets empty accounts, transactions and caches, and a ledger in a scratch directory.
+
+    The module globals are patched for the test, so code under test (and
+    the ledger's snapshots) only ever sees this test's state. Claude is
+    switched off; charities come from the local model and keywords.
+    """
+
+    memory_limit = 1000
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="goodcents-test-", dir=_TEST_DATA_DIR)
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.patch(server, "CLAUDE_API_KEY", None)
+        self.reset_state()
+
+    def patch(self, target, name, value):
+        patcher = mock.patch.object(target, name, value)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return value
+
+    def reset_state(self):
+        """Fresh, empty in-memory state over this test's directory, as a restarted process has"""
+        self.patch(server, "ACCOUNTS", server.AccountRegistry())
+        self.patch(server, "TRANSACTIONS", server.TransactionStore(
+            self.memory_limit, os.path.join(self.directory, "transactions.jsonl")))
+        self.patch(server, "RESPONSE_CACHE", server.ResponseCache())
+        self.patch(server, "IDEMPOTENCY_KEYS", server.IdempotencyStore())
+        self.patch(server, "EVENT_BROKER", server.EventBroker())
+        self.ledger = self.patch(server, "LEDGER", server.Ledger(self.directory, fsync_interval=0.001))
+
+    def start_ledger(self):
+        self.ledger.start()
+        self.addCleanup(self.ledger.close)
+
+    def restart(self, crash=False):
+        """Stop the ledger, cleanly or as kill -9 would, and recover fresh state from disk"""
+        if crash:
+            stop_writer(self.ledger)
+        else:
+            self.ledger.close()
+        self.reset_state()
+        recovery = self.ledger.recover()
+        self.start_ledger()
+        return recovery
+
+    def pay(self, account_id, amount, merchant="Tesco"):
+        return server.process_payment(account_id, {"merchant": merchant, "amount": amount})
+
+    def account_state(self, account_id):
+        """Everything stored for an account: balances, settings and transactions, newest first"""
+        with server.ACCOUNTS.locked(account_id, create=False) as account:
+            return {
+                "balances": account.balances(),
+                "settings": account.settings(),
+                "transactions": [dict(row) for row in account.page(100)["transactions"]],
+            }
+
+
+def stop_writer(ledger):
+    """Stop a ledger's writer without the snapshot close() takes, as a crash would"""
+    with ledger.cond:
+        ledger.closing = True
+        ledger.cond.notify()
+    ledger.thread.join(timeout=10)
+    ledger.wal.close()
+    ledger.wal = None
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(port, process, timeout=30.0):
+    """Poll a server subprocess's /readyz until it answers 200"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with {process.returncode} before it was ready")
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+        try:
+            connection.request("GET", "/readyz")
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        finally:
+            connection.close()
+        time.sleep(0.05)
+    raise RuntimeError("server was not ready in time")
+
+
+def start_server_process(directory, port, test, **settings):
+    """Run the server headless in a subprocess over ``directory``; it is killed when ``test`` ends.
+
+    ``settings`` are extra GOODCENTS_* environment variables, without the prefix.
+    """
+    environment = {key: value for key, value in os.environ.items() if not key.startswith("ANTHROPIC_")}
+    environment.update(GOODCENTS_DATA_DIR=directory, GOODCENTS_HEADLESS="1", GOODCENTS_PROCESSES="1",
+                       GOODCENTS_LOG_LEVEL="ERROR")
+    environment.update({f"GOODCENTS_{name}": str(value) for name, value in settings.items()})
+    process = subprocess.Popen([sys.executable, server.__file__, str(port)], env=environment,
+                               cwd=os.path.dirname(os.path.abspath(server.__file__)),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    test.addCleanup(process.wait)
+    test.addCleanup(process.kill)
+    wait_until_ready(port, process)
+    return process
+
+
+def http_json(port, method, path, data=None):
+    """(status, decoded JSON body) for one request to a server subprocess"""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    try:
+        connection.request(method, path, body=None if data is None else json.dumps(data),
+                           headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+class ServerTest(ServerStateTest):
+    """ServerStateTest with the ledger running and a server on a free local port"""
+
+    workers = 4
+    queue_size = 16
+
+    def setUp(self):
+        super().setUp()
+        self.start_ledger()
+        self.patch(server, "READ_LIMITER", server.ReadRateLimiter(rate=0))
+        self.httpd = server.ThreadPoolHTTPServer(("127.0.0.1", 0), server.BankHandler,
+                                                 workers=self.workers, queue_size=self.queue_size)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.addCleanup(self.httpd.server_close)
+        self.addCleanup(self.httpd.shutdown)
+        self.port = self.httpd.server_address[1]
+
+    def connect(self):
+        connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        self.addCleanup(connection.close)
+        return connection
+
+    def request(self, method, path, body=None, headers=None, connection=None):
+        """(status, headers, body bytes) for one request, on a new connection unless one is given"""
+        connection = connection or self.connect()
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode("utf-8")
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, response.headers, response.read()
+
+    def post_json(self, path, data, headers=None):
+        status, headers, body = self.request("POST", path, data, {"Content-Type": "application/json", **(headers or {})})
+        return status, headers, json.loads(body)
+
+    def get_json(self, path):
+        status, _, body = self.request("GET", path)
+        self.assertEqual(status, 200)
+        return json.loads(body)
+
+
+class LedgerTest(ServerStateTest):
+    def setUp(self):
+        super().setUp()
+        self.start_ledger()
+
+    def write_history(self):
+        self.pay("alice", "4.33")
+        self.pay("bob", "12.01", merchant="Waterstones")
+        server.update_settings("alice", {"round_to_pound": False})
+        self.pay("alice", "0.99", merchant="Greggs")
+        server.process_payment_batch("bob", server.parse_batch_payments(
+            b"merchant,amount\nTfL Travel,2.80\nBoots,7.15\n", "text/csv"))
+        return {account_id: self.account_state(account_id) for account_id in ("alice", "bob")}
+
+    def test_replays_the_log_after_a_crash(self):
+        before = self.write_history()
+        recovery = self.restart(crash=True)
+        self.assertEqual(recovery["snapshot_seq"], 0)
+        self.assertEqual(recovery["records_replayed"], 5)
+        for account_id, state in before.items():
+            self.assertEqual(self.account_state(account_id), state)
+        self.assertFalse(self.account_state("alice")["settings"]["round_to_pound"])
+        self.assertEqual(len(self.account_state("bob")["transactions"]), 3)
+
+    def test_clean_shutdown_recovers_from_the_snapshot_alone(self):
+        before = self.write_history()
+        recovery = self.restart()
+        self.assertEqual(recovery["records_replayed"], 0)
+        self.assertEqual(recovery["snapshot_seq"], 5)
+        for account_id, state in before.items():
+            self.assertEqual(self.account_state(account_id), state)
+
+    def test_snapshot_then_tail_replay(self):
+        self.ledger.snapshot_every = 2
+        self.pay("alice", "4.33")
+        self.pay("alice", "1.50")
+        # The writer snapshots after the batch that reached snapshot_every
+        for _ in range(1000):
+            if self.ledger.stats["snapshots"]:
+                break
+            time.sleep(0.005)
+        self.assertEqual(self.ledger.stats["snapshots"], 1)
+        self.ledger.snapshot_every = 1000
+        self.pay("alice", "2.10")
+        server.update_settings("alice", {"monthly_cap": True})
+        before = self.account_state("alice")
+
+        recovery = self.restart(crash=True)
+        self.assertEqual(recovery["snapshot_seq"], 2)
+        self.assertEqual(recovery["records_replayed"], 2)
+        self.assertEqual(self.account_state("alice"), before)
+        # Ids carry on after the replayed rows
+        self.assertEqual(self.pay("alice", "1.00")["transaction"]["id"], 4)
+
+    def test_torn_final_record_is_ignored(self):
+        self.pay("alice", "4.33")
+        before = self.account_state("alice")
+        self.pay("alice", "1.50")
+        stop_writer(self.ledger)
+        with open(self.ledger.wal_path, "rb+") as wal:
+            data = wal.read()
+            # Cut the last record short, as a crash part way through a write would
+            wal.truncate(data.rindex(b"\n", 0, len(data) - 1) + 1 + 20)
+
+        recovery = self.recover_after_crash()
+        self.assertEqual(recovery["records_replayed"], 1)
+        self.assertEqual(self.account_state("alice"), before)
+
+    def test_partial_record_after_the_last_newline_is_ignored(self):
+        self.pay("alice", "4.33")
+        before = self.account_state("alice")
+        stop_writer(self.ledger)
+        with open(self.ledger.wal_path, "ab") as wal:
+            wal.write(b'{"type":"payment","account_id":"alice","transac')
+        recovery = self.recover_after_crash()
+        self.assertEqual(recovery["records_replayed"], 1)
+        self.assertEqual(self.account_state("alice"), before)
+        with open(self.ledger.wal_path, "rb") as wal:
+            self.assertTrue(wal.read().endswith(b"}\n"))
+        # Records appended after recovery aren't glued onto the torn one
+        self.pay("alice", "1.00")
+        self.assertEqual(self.restart(crash=True)["records_replayed"], 2)
+
+    def test_recovers_acknowledged_payments_after_kill_9(self):
+        directory = os.path.join(self.directory, "killed")
+        port = free_port()
+        process = start_server_process(directory, port, self)
+        balances = []
+        for amount in ("4.33", "12.01", "0.99"):
+            status, body = http_json(port, "POST", "/api/payment?account=alice", {"merchant": "Tesco", "amount": amount})
+            self.assertEqual(status, 200)
+            balances.append(body["new_balance"])
+        process.kill()
+        process.wait()
+
+        start_server_process(directory, port, self)
+        self.assertEqual(http_json(port, "GET", "/api/account?account=alice")[1]["balance"], balances[-1])
+        rows = http_json(port, "GET", "/api/transactions?account=alice")[1]["transactions"]
+        self.assertEqual([row["amount"] for row in rows], [0.99, 12.01, 4.33])
+
+    def recover_after_crash(self):
+        self.reset_state()
+        recovery = self.ledger.recover()
+        self.start_ledger()
+        return recovery
+
+
+class LedgerFailureTest(ServerTest):
+    def fail_ledger_writes(self):
+        def wait(handle, timeout=10.0):
+            raise OSError(5, "Input/output error")
+        self.patch(self.ledger, "wait", wait)
+
+    def test_unconfirmed_payment_answers_500_and_is_replayed(self):
+        self.fail_ledger_writes()
+        payment = {"merchant": "Tesco", "amount": "4.33"}
+        headers = {"Idempotency-Key": "order-1"}
+        status, response_headers, first = self.post_json("/api/payment?account=alice", payment, headers)
+        self.assertEqual(status, 500)
+        self.assertEqual(first["status"], "unconfirmed")
+        self.assertEqual(response_headers["Idempotent-Replayed"], "false")
+
+        status, response_headers, retry = self.post_json("/api/payment?account=alice", payment, headers)
+        self.assertEqual(status, 500)
+        self.assertEqual(response_headers["Idempotent-Replayed"], "true")
+        self.assertEqual(retry, first)
+        # Charged once, and the payment stands in memory
+        account = self.get_json("/api/account?account=alice")
+        self.assertEqual(server.to_pence(account["balance"]), server.OPENING_BALANCE - 433)
+
+    def test_unconfirmed_settings_change_answers_500(self):
+        self.fail_ledger_writes()
+        status, _, body = self.post_json("/api/settings?account=alice", {"round_to_pound": False})
+        self.assertEqual(status, 500)
+        self.assertEqual(body["status"], "unconfirmed")
+        self.assertFalse(body["settings"]["round_to_pound"])
+
+
+class LedgerFollowerTest(ServerStateTest):
+    def test_applies_only_committed_records(self):
+        self.start_ledger()
+        shared = self.ledger.share_commits()
+        self.pay("alice", "4.33")
+        self.assertEqual(shared.value, 1)
+        self.pay("alice", "12.01", merchant="Waterstones")
+        self.assertEqual(shared.value, 2)
+        primary = self.account_state("alice")
+        stop_writer(self.ledger)
+
+        # A follower's fresh state, with the second record written but not yet committed
+        self.reset_state()
+        committed = types.SimpleNamespace(value=1)
+        follower = server.LedgerFollower(self.ledger, committed=committed)
+        follower.catch_up()
+        self.assertEqual(follower.seq, 1)
+        self.assertEqual([row["amount"] for row in self.account_state("alice")["transactions"]], [4.33])
+
+        # Nothing new committed: returns without waiting for the lock
+        with follower.lock:
+            caller = threading.Thread(target=follower.catch_up)
+            caller.start()
+            caller.join(timeout=5)
+            self.assertFalse(caller.is_alive())
+
+        committed.value = 2
+        follower.catch_up()
+        self.assertEqual(follower.seq, 2)
+        self.assertEqual(self.account_state("alice"), primary)
+
+    @unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "worker processes need SO_REUSEPORT")
+    def test_writes_are_visible_through_every_worker(self):
+        port = free_port()
+        start_server_process(self.directory, port, self, PROCESSES=2)
+        for count, amount in enumerate(("4.33", "12.01", "0.99", "7.50"), start=1):
+            status, payment = http_json(port, "POST", "/api/payment?account=alice",
+                                        {"merchant": "Tesco", "amount": amount})
+            self.assertEqual(status, 200)
+            # Each read opens a new connection, so the kernel spreads them over both workers
+            for _ in range(6):
+                self.assertEqual(http_json(port, "GET", "/api/account?account=alice")[1]["balance"],
+                                 payment["new_balance"])
+                rows = http_json(port, "GET", "/api/transactions?account=alice")[1]["transactions"]
+                self.assertEqual(len(rows), count)
+
+
+class PaymentBatchTest(ServerTest):
+    def post_batch(self, body, content_type="application/x-ndjson"):
+        status, _, response = self.request("POST", "/api/payments/batch?account=alice", body.encode("utf-8"),
+                                           {"Content-Type": content_type})
+        return status, json.loads(response) if status == 200 else response
+
+    def transaction_count(self):
+        return len(self.get_json("/api/transactions?account=alice")["transactions"])
+
+    def test_json_lines_report_each_row(self):
+        status, response = self.post_batch("\n".join([
+            '{"merchant": "Tesco", "amount": 4.33}',
+            '',
+            'not json',
+            '[1, 2]',
+            '{"merchant": "", "amount": 1}',
+            '{"merchant": "Boots", "amount": "-2"}',
+            '{"merchant": "Greggs", "amount": "0.99"}',
+        ]))
+        self.assertEqual(status, 200)
+        self.assertEqual((response["accepted"], response["rejected"]), (2, 4))
+        results = response["results"]
+        # Blank lines are skipped, not numbered
+        self.assertEqual([result["row"] for result in results], [1, 2, 3, 4, 5, 6])
+        self.assertEqual([result["status"] for result in results],
+                         ["success", "error", "error", "error", "error", "success"])
+        self.assertTrue(results[1]["message"].startswith("Invalid JSON"))
+        self.assertEqual(results[2]["message"], "Each line must be a JSON object")
+        self.assertTrue(results[3]["message"].startswith("Invalid payment"))
+        self.assertTrue(results[4]["message"].startswith("Invalid payment"))
+        self.assertEqual((results[0]["amount"], results[5]["amount"]), (4.33, 0.99))
+        self.assertEqual(self.transaction_count(), 2)
+
+    def test_csv_rows(self):
+        status, response = self.post_batch("\ufeffmerchant,amount\nTfL Travel,2.80\nBoots,oops\n\"Smith, Jones & Co\",10\n",
+                                           "text/csv")
+        self.assertEqual(status, 200)
+        self.assertEqual((response["accepted"], response["rejected"]), (2, 1))
+        self.assertEqual([result["status"] for result in response["results"]], ["success", "error", "success"])
+        self.assertEqual([result.get("amount") for result in response["results"]], [2.8, None, 10.0])
+        self.assertEqual(self.transaction_count(), 2)
+
+    def test_more_rows_than_the_cap_are_refused_whole(self):
+        self.patch(server, "BATCH_MAX_ROWS", 3)
+        status, _ = self.post_batch("merchant,amount\n" + "Tesco,1.00\n" * 4, "text/csv")
+        self.assertEqual(status, 400)
+        self.assertEqual(self.transaction_count(), 0)
+        status, response = self.post_batch("merchant,amount\n" + "Tesco,1.00\n" * 3, "text/csv")
+        self.assertEqual((status, response["accepted"]), (200, 3))
+
+    def test_oversized_body_is_refused_before_it_is_read(self):
+        self.patch(server, "BATCH_MAX_BYTES", 1000)
+        with socket.create_connection(("127.0.0.1", self.port), timeout=5) as sock:
+            # Only the headers are sent; waiting for the body would time out
+            sock.sendall(b"POST /api/payments/batch?account=alice HTTP/1.1\r\nHost: test\r\n"
+                         b"Content-Type: text/csv\r\nContent-Length: 1001\r\n\r\n")
+            response = http.client.HTTPResponse(sock)
+            response.begin()
+            self.assertEqual(response.status, 413)
+            response.read()
+            self.assertEqual(sock.recv(1), b"")  # closed, since the body was never read
+        self.assertEqual(self.transaction_count(), 0)
+
+
+class ClassifierTest(ServerTest):
+    examples = [
+        (merchant, charity, 90)
+        for charity, merchants in (
+            ("FareShare", ("Tesco", "Sainsbury's", "Greggs", "Pret A Manger", "Costa Coffee")),
+            ("Teach First", ("Waterstones", "WHSmith", "Blackwell's", "Foyles", "Ryman")),
+        )
+        for merchant in merchants
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.patch(server, "DECISION_CACHE", server.DecisionCache(path=None))
+        self.classifier = self.patch(server, "LOCAL_CLASSIFIER",
+                                     server.LocalClassifier(path=None, threshold=85, min_examples=2))
+        self.classifier.retrain(self.examples)
+        # Claude is "available", but any call to it goes here instead
+        self.patch(server, "CLAUDE_API_KEY", "test-key")
+        self.patch(server, "ANTHROPIC_AVAILABLE", True)
+        self.claude = self.patch(server, "fetch_claude_charity",
+                                 mock.Mock(return_value=("Teach First", 80, "asked Claude")))
+
+    def test_confident_local_prediction_skips_claude(self):
+        self.classifier.threshold = 0
+        charity, _, reasoning = server.ai_select_charity_claude("Waterstones", 8.99)
+        self.assertEqual(charity, "Teach First")
+        self.assertTrue(reasoning.startswith("Local model"))
+        self.claude.assert_not_called()
+        self.assertEqual(self.classifier.metrics()["served_locally"], 1)
+
+    def test_unsure_local_prediction_falls_through_to_claude(self):
+        self.classifier.threshold = 101
+        self.assertEqual(server.ai_select_charity_claude("Waterstones", 8.99), ("Teach First", 80, "asked Claude"))
+        self.claude.assert_called_once_with("Waterstones", 8.99)
+        self.assertEqual(self.classifier.metrics()["escalated"], 1)
+
+    def test_unseen_merchant_falls_through_to_claude(self):
+        self.classifier.threshold = 0
+        server.ai_select_charity_claude("Zzqx Vvkj", 3.00)
+        self.claude.assert_called_once()
+        self.assertEqual(self.classifier.metrics()["unseen"], 1)
+
+    def test_commands_are_refused_without_an_admin_token(self):
+        self.patch(server, "ADMIN_TOKEN", None)
+        with mock.patch.object(self.classifier, "retrain") as retrain:
+            status, _, _ = self.request("POST", "/api/classifier/retrain")
+        self.assertEqual(status, 403)
+        retrain.assert_not_called()
+
+    def test_commands_need_the_admin_token(self):
+        self.patch(server, "ADMIN_TOKEN", "s3cret")
+        for headers in ({}, {"Authorization": "Bearer wrong"}, {"Authorization": "Basic s3cret"}):
+            with self.subTest(headers=headers):
+                self.assertEqual(self.request("POST", "/api/classifier/reload", headers=headers)[0], 403)
+        # Authorized, and then refused on its merits: there is no saved model
+        status, _, body = self.request("POST", "/api/classifier/reload", headers={"Authorization": "Bearer s3cret"})
+        self.assertEqual(status, 400)
+        self.assertIn(b"No saved classifier", body)
+
+
+class EventStreamTest(ServerTest):
+    def open_stream(self, account_id, last_event_id=None):
+        connection = self.connect()
+        headers = {"Last-Event-ID": str(last_event_id)} if last_event_id is not None else {}
+        connection.request("GET", f"/api/stream?account={account_id}", headers=headers)
+        response = connection.getresponse()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers["Content-Type"], "text/event-stream")
+        return response
+
+    def next_event(self, response):
+        """The next event's fields, skipping the retry hint and heartbeats"""
+        while True:
+            fields = {}
+            for line in iter(response.fp.readline, b"\n"):
+                name, _, value = line.decode("utf-8").rstrip("\n").partition(": ")
+                fields[name] = value
+            if "event" in fields:
+                return {"id": int(fields["id"]), "event": fields["event"], "data": json.loads(fields["data"])}
+
+    def wait_for_subscribers(self, count):
+        deadline = time.monotonic() + 5
+        while server.EVENT_BROKER.metrics()["subscribers"] < count:
+            self.assertLess(time.monotonic(), deadline, "the stream never subscribed")
+            time.sleep(0.01)
+
+    def test_subscriber_gets_a_snapshot_then_its_account_events(self):
+        stream = self.open_stream("alice")
+        snapshot = self.next_event(stream)
+        self.assertEqual(snapshot["event"], "snapshot")
+        self.assertEqual(snapshot["data"]["transactions"], [])
+        self.wait_for_subscribers(1)
+
+        self.pay("bob", "1.00")  # another account's payment is not sent to alice
+        payment = self.pay("alice", "4.33")
+        transaction = self.next_event(stream)
+        self.assertEqual(transaction["event"], "transaction")
+        self.assertEqual(transaction["data"]["id"], payment["transaction"]["id"])
+        account = self.next_event(stream)
+        self.assertEqual(account["event"], "account")
+        self.assertEqual(account["data"]["balance"], payment["new_balance"])
+        self.assertGreater(account["id"], transaction["id"])
+
+    def test_reconnect_with_last_event_id_replays_what_was_missed(self):
+        stream = self.open_stream("alice")
+        self.next_event(stream)
+        self.wait_for_subscribers(1)
+        self.pay("alice", "4.33")
+        seen = self.next_event(stream)
+        self.next_event(stream)
+        stream.close()
+
+        self.pay("alice", "0.99")
+        replayed = self.open_stream("alice", last_event_id=seen["id"])
+        events = [self.next_event(replayed) for _ in range(3)]
+        self.assertEqual([event["event"] for event in events], ["account", "transaction", "account"])
+        self.assertEqual([event["id"] for event in events], list(range(seen["id"] + 1, seen["id"] + 4)))
+        self.assertEqual(events[1]["data"]["amount"], 0.99)
+        self.assertEqual(server.EVENT_BROKER.metrics()["replays"], 1)
+
+
+class EventBrokerTest(ServerStateTest):
+    def test_slow_consumer_is_dropped(self):
+        self.patch(server, "SSE_WRITE_TIMEOUT", 0.2)
+        reader, writer = socket.socketpair()
+        self.addCleanup(reader.close)
+        reader.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        broker = server.EVENT_BROKER
+        broker.subscribe(writer, "alice")
+        deadline = time.monotonic() + 10
+        # The reader never reads, so the broker's writes soon stop fitting
+        while broker.metrics()["dropped"] == 0:
+            self.assertLess(time.monotonic(), deadline, "the slow subscriber was never dropped")
+            broker.publish("alice", "transaction", {"padding": "x" * 65536})
+            time.sleep(0.05)
+        deadline = time.monotonic() + 5
+        while broker.metrics()["subscribers"]:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.assertEqual(writer.fileno(), -1)  # closed by the broker
+
+        # Other subscribers carry on
+        other_reader, other_writer = socket.socketpair()
+        self.addCleanup(other_reader.close)
+        broker.subscribe(other_writer, "alice")
+        broker.publish("alice", "settings", {"round_to_pound": False})
+        other_reader.settimeout(5)
+        received = b""
+        while b"event: settings" not in received:
+            received += other_reader.recv(65536)
+        self.addCleanup(other_writer.close)
+
+
+class ResponseCacheTest(ServerTest):
+    def get(self, path, **headers):
+        return self.request("GET", path, headers={name.replace("_", "-"): value for name, value in headers.items()})
+
+    def test_unchanged_resource_answers_304(self):
+        status, headers, body = self.get("/api/account?account=alice")
+        self.assertEqual(status, 200)
+        etag = headers["ETag"]
+        status, headers, body = self.get("/api/account?account=alice", If_None_Match=etag)
+        self.assertEqual((status, body), (304, b""))
+        self.assertEqual(headers["ETag"], etag)
+        status, _, _ = self.get("/api/account?account=alice", If_None_Match=f'"stale", {etag}')
+        self.assertEqual(status, 304)
+        self.assertEqual(server.RESPONSE_CACHE.metrics()["not_modified"], 2)
+
+    def test_writes_invalidate_only_what_they_change(self):
+        etags = {path: self.get(path)[1]["ETag"] for path in (
+            "/api/account?account=alice", "/api/transactions?account=alice", "/api/settings?account=alice",
+            "/api/account?account=bob")}
+        self.pay("alice", "4.33")
+        changed = {path for path, etag in etags.items() if self.get(path, If_None_Match=etag)[0] == 200}
+        self.assertEqual(changed, {"/api/account?account=alice", "/api/transactions?account=alice"})
+
+        server.update_settings("alice", {"round_to_pound": False})
+        status, headers, body = self.get("/api/settings?account=alice", If_None_Match=etags["/api/settings?account=alice"])
+        self.assertEqual(status, 200)
+        self.assertNotEqual(headers["ETag"], etags["/api/settings?account=alice"])
+        self.assertFalse(json.loads(body)["settings"]["round_to_pound"])
+
+    def test_gzip_is_negotiated(self):
+        _, headers, identity = self.get("/api/charities")
+        self.assertIsNone(headers["Content-Encoding"])
+        status, headers, compressed = self.get("/api/charities", Accept_Encoding="gzip, deflate")
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["Content-Encoding"], "gzip")
+        self.assertEqual(headers["Vary"], "Accept-Encoding")
+        self.assertEqual(gzip.decompress(compressed), identity)
+        self.assertLess(len(compressed), len(identity))
+        self.assertIsNone(self.get("/api/charities", Accept_Encoding="gzip;q=0")[1]["Content-Encoding"])
+
+    @unittest.skipUnless(server.BROTLI_AVAILABLE, "brotli is not installed")
+    def test_brotli_is_preferred(self):
+        import brotli
+        _, _, identity = self.get("/api/charities")
+        _, headers, compressed = self.get("/api/charities", Accept_Encoding="gzip, br")
+        self.assertEqual(headers["Content-Encoding"], "br")
+        self.assertEqual(brotli.decompress(compressed), identity)
+
+    def test_choose_encoding(self):
+        cases = [
+            (True, "gzip, br", "br"),
+            (True, "br;q=0, gzip", "gzip"),
+            (True, "*", "br"),
+            (True, "identity", None),
+            (True, None, None),
+            (False, "br", None),
+            (False, "br, gzip;q=0.5", "gzip"),
+            (False, "GZIP", "gzip"),
+            (False, "gzip;q=nonsense", None),
+        ]
+        for brotli_available, accept_encoding, expected in cases:
+            with self.subTest(brotli=brotli_available, accept_encoding=accept_encoding), \
+                    mock.patch.object(server, "BROTLI_AVAILABLE", brotli_available):
+                self.assertEqual(server.choose_encoding(accept_encoding), expected)
+
+
+class TransactionStoreTest(ServerTest):
+    memory_limit = 10
+
+    def page(self, account_id, cursor=None, limit=4):
+        query = f"account={account_id}&limit={limit}" + (f"&cursor={cursor}" if cursor is not None else "")
+        return self.get_json(f"/api/transactions?{query}")
+
+    def test_cursor_pages_stay_stable_across_a_spill(self):
+        for i in range(8):
+            self.pay("alice", f"{i + 1}.00")
+            self.pay("bob", "0.50")
+        first = self.page("alice")
+        self.assertEqual([row["amount"] for row in first["transactions"]], [8.0, 7.0, 6.0, 5.0])
+        self.assertGreater(server.TRANSACTIONS.metrics()["spilled"], 0)
+
+        # Enough new rows to push every row alice has seen so far out to disk
+        for _ in range(20):
+            self.pay("bob", "0.50")
+        self.assertGreater(server.TRANSACTIONS.first_memory_id, first["latest_id"])
+        pages = [first]
+        while pages[-1]["next_cursor"] is not None:
+            pages.append(self.page("alice", pages[-1]["next_cursor"]))
+        rows = [row for page in pages for row in page["transactions"]]
+        self.assertEqual([row["amount"] for row in rows], [float(amount) for amount in range(8, 0, -1)])
+        self.assertEqual(len({row["id"] for row in rows}), 8)
+        self.assertTrue(all(row["merchant"] == "Tesco" for row in rows))
+
+    def test_rows_read_the_same_from_memory_and_disk(self):
+        paid = [self.pay("alice", f"{i + 1}.25")["transaction"] for i in range(25)]
+        store = server.TRANSACTIONS
+        self.assertGreater(store.first_memory_id, 1)
+        for transaction in paid:
+            with self.subTest(id=transaction["id"]):
+                row = store.get(transaction["id"])
+                self.assertEqual((row["id"], row["amount"], row["roundup"]),
+                                 (transaction["id"], transaction["amount"], transaction["roundup"]))
+        boundary = store.first_memory_id
+        across = store.rows_between(boundary - 3, boundary + 2)
+        self.assertEqual([row["id"] for row in across], list(range(boundary + 2, boundary - 4, -1)))
+        self.assertEqual([row["id"] for row in store], list(range(1, 26)))
+
+
+class ReclassifyTest(ServerStateTest):
+    memory_limit = 2
+    chunk = 2
+
+    def setUp(self):
+        super().setUp()
+        self.patch(server, "RECLASSIFY_CHECKPOINT", os.path.join(self.directory, "reclassify.checkpoint.json"))
+        self.patch(server, "RECLASSIFY_SPILL", os.path.join(self.directory, "transactions.jsonl.reclassify"))
+        self.patch(server, "DECISION_CACHE", server.DecisionCache(path=None))
+        self.start_ledger()
+        for i in range(8):
+            self.pay("alice", "3.40", merchant=f"Shop {i + 1}")
+        self.ledger.close()
+        self.stored = {row["merchant"]: row["charity"] for row in server.TRANSACTIONS}
+        self.calls = []
+
+    def reclassify(self, select, *args):
+        """Run the command as a new process would, over state recovered from disk"""
+        self.reset_state()
+        output = io.StringIO()
+        with mock.patch.object(server, "_select_charity", select), contextlib.redirect_stdout(output), \
+                contextlib.redirect_stderr(io.StringIO()):
+            status = server.reclassify_command(["--chunk", str(self.chunk), *args])
+        return status, output.getvalue()
+
+    def select(self, outcomes):
+        def select(merchant, amount):
+            self.calls.append(merchant)
+            return ("Into University", 0.9, "test"), outcomes.get(merchant, "ai")
+        return select
+
+    def test_resume_skips_checkpointed_rows_and_keeps_failed_rows(self):
+        self.assertEqual(server.TRANSACTIONS.metrics()["spilled"], 6)
+        self.assertNotEqual(self.stored["Shop 2"], "Into University")
+
+        # Spilled rows 1-2 and 3-4 are checkpointed before the circuit opens on row 5
+        status, _ = self.reclassify(self.select({"Shop 2": "error", "Shop 5": "circuit_open"}))
+        self.assertEqual(status, 1)
+        self.assertEqual(sorted(self.calls[:4]), ["Shop 1", "Shop 2", "Shop 3", "Shop 4"])
+        self.assertIn("Shop 5", self.calls)
+
+        self.calls.clear()
+        status, output = self.reclassify(self.select({"Shop 2": "error"}))
+        self.assertEqual(status, 0)
+        self.assertEqual(sorted(self.calls), [f"Shop {i}" for i in range(5, 9)])
+        self.assertIn("(8 rows, 8 merchants classified, 1 failed", output)
+        self.assertFalse(os.path.exists(server.RECLASSIFY_CHECKPOINT))
+
+        self.reset_state()
+        self.ledger.recover()
+        charities = {row["merchant"]: row["charity"] for row in server.TRANSACTIONS}
+        self.assertEqual(charities, {**{merchant: "Into University" for merchant in self.stored},
+                                     "Shop 2": self.stored["Shop 2"]})
+
+    def test_fallback_keeps_stored_charity_unless_allowed(self):
+        self.assertNotEqual(self.stored["Shop 1"], "Into University")
+        status, _ = self.reclassify(self.select({"Shop 1": "fallback"}))
+        self.assertEqual(status, 0)
+        self.assertEqual(server.TRANSACTIONS.get(1)["charity"], self.stored["Shop 1"])
+
+        status, _ = self.reclassify(self.select({"Shop 1": "fallback"}), "--allow-fallback")
+        self.assertEqual(status, 0)
+        self.assertEqual(server.TRANSACTIONS.get(1)["charity"], "Into University")
+
+
+class KeepAliveTest(ServerTest):
+    def raw_connection(self):
+        sock = socket.create_connection(("127.0.0.1", self.port), timeout=5)
+        self.addCleanup(sock.close)
+        return sock
+
+    def raw_get(self, sock, path, extra=b""):
+        sock.sendall(f"GET {path} HTTP/1.1\r\nHost: test\r\n".encode("ascii") + extra + b"\r\n")
+        response = http.client.HTTPResponse(sock)
+        response.begin()
+        response.read()
+        return response
+
+    def test_requests_share_one_connection(self):
+        connection = self.connect()
+        self.assertEqual(self.request("GET", "/api/account?account=alice", connection=connection)[0], 200)
+        sock = connection.sock
+        status, _, _ = self.request("POST", "/api/payment?account=alice", {"merchant": "Tesco", "amount": "4.33"},
+                                    {"Content-Type": "application/json"}, connection=connection)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.request("GET", "/api/account?account=alice", connection=connection)[0], 200)
+        self.assertIs(connection.sock, sock)
+        metrics = self.httpd.metrics()
+        self.assertEqual(metrics["connections_accepted"], 1)
+        self.assertEqual(metrics["keepalive_requests"], 2)
+
+    def test_idle_connection_is_closed_after_the_timeout(self):
+        self.httpd.idle.timeout = 0.3
+        sock = self.raw_connection()
+        self.raw_get(sock, "/healthz")
+        started = time.monotonic()
+        self.assertEqual(sock.recv(1), b"")
+        self.assertGreaterEqual(time.monotonic() - started, 0.25)
+        self.assertEqual(self.httpd.metrics()["idle_closed"], 1)
+
+    def test_connection_close_is_honoured(self):
+        sock = self.raw_connection()
+        response = self.raw_get(sock, "/healthz", b"Connection: close\r\n")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(sock.recv(1), b"")
+
+    def test_connection_closes_after_the_request_limit(self):
+        self.patch(server, "KEEPALIVE_MAX_REQUESTS", 2)
+        sock = self.raw_connection()
+        self.assertIsNone(self.raw_get(sock, "/healthz").getheader("Connection"))
+        self.assertEqual(self.raw_get(sock, "/healthz").getheader("Connection"), "close")
+        self.assertEqual(sock.recv(1), b"")
+
+
+class AdmissionQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patch = mock.patch.object(server.time, "monotonic", self.clock)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.shed = []
+
+    def waiting(self, request_line):
+        """The server end of a connection whose client has sent ``request_line``"""
+        client, sock = socket.socketpair()
+        self.addCleanup(client.close)
+        self.addCleanup(sock.close)
+        if request_line:
+            client.sendall(request_line + b"\r\n\r\n")
+        return sock, ("127.0.0.1", 0)
+
+    def test_requests_are_classified_from_their_request_line(self):
+        cases = [
+            (b"POST /api/payment HTTP/1.1", "write"),
+            (b"GET /api/account HTTP/1.1", "read"),
+            (b"HEAD /api/transactions HTTP/1.1", "read"),
+            (b"GET /bank HTTP/1.1", "other"),
+            (b"GET /healthz HTTP/1.1", "other"),
+            (b"", "other"),
+        ]
+        for request_line, expected in cases:
+            with self.subTest(request_line=request_line):
+                self.assertEqual(server.admission_class(self.waiting(request_line)[0]), expected)
+
+    def test_writes_are_served_first_and_reads_last(self):
+        admission = server.AdmissionQueue(10, self.shed.append)
+        read = self.waiting(b"GET /api/account HTTP/1.1")
+        other = self.waiting(b"GET /bank HTTP/1.1")
+        write = self.waiting(b"POST /api/payment HTTP/1.1")
+        for item in (read, other, write):
+            admission.put_nowait(item)
+        self.assertEqual([admission.get() for _ in range(3)], [write, other, read])
+
+    def test_full_queue_refuses_reads_and_makes_room_for_writes(self):
+        admission = server.AdmissionQueue(2, self.shed.append)
+        reads = [self.waiting(b"GET /api/account HTTP/1.1") for _ in range(3)]
+        writes = [self.waiting(b"POST /api/payment HTTP/1.1") for _ in range(3)]
+        admission.put_nowait(reads[0])
+        admission.put_nowait(reads[1])
+        with self.assertRaises(queue.Full):
+            admission.put_nowait(reads[2])
+        # Each write takes the place of the newest queued read
+        admission.put_nowait(writes[0])
+        admission.put_nowait(writes[1])
+        self.assertEqual(self.shed, [reads[1], reads[0]])
+        with self.assertRaises(queue.Full):
+            admission.put_nowait(writes[2])
+        metrics = admission.metrics()
+        self.assertEqual((metrics["read"]["shed"], metrics["write"]["shed"]), (3, 1))
+
+    def test_stale_reads_are_shed_instead_of_served(self):
+        admission = server.AdmissionQueue(10, self.shed.append, read_max_wait=0.5)
+        stale = self.waiting(b"GET /api/account HTTP/1.1")
+        fresh = self.waiting(b"GET /api/account HTTP/1.1")
+        admission.put_nowait(stale)
+        self.clock.advance(0.6)
+        admission.put_nowait(fresh)
+        self.assertEqual(admission.get(), fresh)
+        self.assertEqual(self.shed, [stale])
+
+
+class AdmissionTest(ServerTest):
+    workers = 1
+    queue_size = 1
+
+    def wait_until(self, condition, message):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, message)
+            time.sleep(0.01)
+
+    def test_over_capacity_gets_503_and_queued_requests_are_still_served(self):
+        self.httpd.pending.read_max_wait = 30  # the queued read must not go stale meanwhile
+        body = json.dumps({"merchant": "Tesco", "amount": "4.33"}).encode("utf-8")
+        busy = socket.create_connection(("127.0.0.1", self.port), timeout=10)
+        self.addCleanup(busy.close)
+        # The only worker waits for the rest of this payment's body
+        busy.sendall(b"POST /api/payment?account=alice HTTP/1.1\r\nHost: test\r\nContent-Type: application/json\r\n"
+                     + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii") + body[:5])
+        self.wait_until(lambda: server.LIFECYCLE.in_flight == 1, "the payment never reached a worker")
+        queued = self.connect()
+        queued.request("GET", "/api/account?account=alice")
+        self.wait_until(lambda: self.httpd.pending.qsize() == 1, "the read was never queued")
+
+        status, headers, _ = self.request("GET", "/api/account?account=alice")
+        self.assertEqual(status, 503)
+        self.assertEqual(headers["Retry-After"], "1")
+        self.assertEqual(self.httpd.metrics()["rejected"], 1)
+
+        busy.sendall(body[5:])
+        response = http.client.HTTPResponse(busy)
+        response.begin()
+        self.assertEqual(response.status, 200)
+        response.read()
+        account = queued.getresponse()
+        self.assertEqual(account.status, 200)
+        self.assertEqual(server.to_pence(json.loads(account.read())["balance"]), server.OPENING_BALANCE - 433)
+
+
+class IdempotencyTest(ServerTest):
+    payment = {"merchant": "Tesco", "amount": "4.33"}
+
+    def pay_with_key(self, key, payment=None):
+        return self.post_json("/api/payment?account=alice", payment or self.payment, {"Idempotency-Key": key})
+
+    def balance(self):
+        return server.to_pence(self.get_json("/api/account?account=alice")["balance"])
+
+    def test_retry_gets_the_stored_response_and_is_not_charged(self):
+        status, headers, first = self.pay_with_key("order-1")
+        self.assertEqual((status, headers["Idempotent-Replayed"]), (200, "false"))
+        status, headers, retry = self.pay_with_key("order-1")
+        self.assertEqual((status, headers["Idempotent-Replayed"]), (200, "true"))
+        self.assertEqual(retry, first)
+        self.assertEqual(self.balance(), server.OPENING_BALANCE - 433)
+        self.assertEqual(len(self.get_json("/api/transactions?account=alice")["transactions"]), 1)
+
+    def test_keys_are_per_account(self):
+        self.pay_with_key("order-1")
+        status, headers, _ = self.post_json("/api/payment?account=bob", self.payment, {"Idempotency-Key": "order-1"})
+        self.assertEqual((status, headers["Idempotent-Replayed"]), (200, "false"))
+
+    def test_same_key_with_a_different_body_is_422(self):
+        self.pay_with_key("order-1")
+        status, _, body = self.pay_with_key("order-1", {"merchant": "Tesco", "amount": "9.99"})
+        self.assertEqual(status, 422)
+        self.assertEqual(body["status"], "error")
+        self.assertEqual(self.balance(), server.OPENING_BALANCE - 433)
+
+    def test_rejected_payments_are_not_stored(self):
+        status, _, _ = self.pay_with_key("order-1", {"merchant": "Tesco", "amount": "-1"})
+        self.assertEqual(status, 400)
+        self.assertEqual(len(server.IDEMPOTENCY_KEYS.entries), 0)
+
+    def test_concurrent_requests_with_one_key_are_charged_once(self):
+        started = threading.Barrier(3)
+        select_charity = server.select_charity
+
+        def slow_select_charity(*args):
+            time.sleep(0.2)  # long enough for every request to arrive while the first runs
+            return select_charity(*args)
+
+        self.patch(server, "select_charity", slow_select_charity)
+        results = []
+
+        def pay():
+            started.wait()
+            status, headers, body = self.pay_with_key("order-1")
+            results.append((status, headers["Idempotent-Replayed"], body))
+
+        threads = [threading.Thread(target=pay) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(replayed for _, replayed, _ in results), ["false", "true", "true"])
+        self.assertEqual({status for status, _, _ in results}, {200})
+        self.assertEqual(len({json.dumps(body) for _, _, body in results}), 1)
+        self.assertEqual(self.balance(), server.OPENING_BALANCE - 433)
+
+
+class IdempotencyStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(server.time, "monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.calls = 0
+
+    def execute(self, status=200):
+        def run():
+            self.calls += 1
+            return status, f"response {self.calls}".encode()
+        return run
+
+    def test_entries_expire_after_the_ttl(self):
+        store = server.IdempotencyStore(ttl=60)
+        self.assertEqual(store.run("key", "body", self.execute()), (200, b"response 1", False))
+        self.clock.advance(59)
+        self.assertEqual(store.run("key", "body", self.execute()), (200, b"response 1", True))
+        self.clock.advance(1)
+        self.assertEqual(store.run("key", "body", self.execute()), (200, b"response 2", False))
+        self.assertEqual(store.metrics()["expirations"], 1)
+
+    def test_least_recently_used_key_is_evicted(self):
+        store = server.IdempotencyStore(max_size=2)
+        store.run("a", "body", self.execute())
+        store.run("b", "body", self.execute())
+        store.run("a", "body", self.execute())
+        store.run("c", "body", self.execute())
+        self.assertEqual(list(store.entries), ["a", "c"])
+        self.assertEqual(store.metrics()["evictions"], 1)
+
+    def test_only_stored_statuses_are_kept(self):
+        store = server.IdempotencyStore()
+        store.run("key", "body", self.execute(400))
+        self.assertEqual(store.run("key", "body", self.execute())[2], False)
+        self.assertEqual(self.calls, 2)
+        store.run("unconfirmed", "body", self.execute(500))
+        self.assertEqual(store.run("unconfirmed", "body", self.execute())[:2], (500, b"response 3"))
+
+
+# =============================================================================
+# LIFECYCLE
+# =============================================================================
+
+@unittest.skipUnless(hasattr(socket, "SO_REUSEPORT"), "worker processes need SO_REUSEPORT")
+class DrainTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix="goodcents-test-", dir=_TEST_DATA_DIR)
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def status_once_answered(self, port, method, path, data=None, timeout=5):
+        """The status of the first answer; a worker that has already drained resets its queued connections"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return http_json(port, method, path, data)[0]
+            except (ConnectionError, http.client.RemoteDisconnected):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def test_workers_fail_readyz_and_finish_writes_on_sigterm(self):
+        port = free_port()
+        process = start_server_process(self.directory, port, self, PROCESSES=2, DRAIN_TIMEOUT=10)
+        # A payment whose body is only half sent keeps a write running on a worker
+        body = json.dumps({"merchant": "Tesco", "amount": "4.33"}).encode("utf-8")
+        payment = socket.create_connection(("127.0.0.1", port), timeout=10)
+        self.addCleanup(payment.close)
+        payment.sendall(b"POST /api/payment HTTP/1.1\r\nHost: test\r\nContent-Type: application/json\r\n"
+                        + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii") + body[:10])
+        time.sleep(0.5)
+
+        process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + 5
+        statuses = set()
+        while 503 not in statuses and time.monotonic() < deadline:
+            statuses.add(self.status_once_answered(port, "GET", "/readyz"))
+            time.sleep(0.05)
+        self.assertIn(503, statuses)
+        self.assertEqual(self.status_once_answered(port, "POST", "/api/payment",
+                                                   {"merchant": "Tesco", "amount": "1.00"}), 503)
+
+        payment.sendall(body[10:])
+        response = http.client.HTTPResponse(payment)
+        response.begin()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(json.loads(response.read())["status"], "success")
+        self.assertEqual(process.wait(timeout=30), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()